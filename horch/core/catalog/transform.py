@@ -1,7 +1,7 @@
 from horch.core.catalog.catalog import register_op
 from torchvision.transforms import RandomHorizontalFlip, RandomCrop, ToTensor, ColorJitter, Resize, RandomVerticalFlip, \
-    Normalize, Pad, RandomResizedCrop
-from horch.transforms.classification import Cutout, CIFAR10Policy
+    Normalize, Pad, RandomResizedCrop, CenterCrop, Grayscale
+from horch.transforms.classification import Cutout, CIFAR10Policy, PadToSquare
 
 ops = [
     RandomHorizontalFlip,
@@ -19,4 +19,17 @@ ops = [
 
 
 for cls in ops:
-    register_op(cls)
\ No newline at end of file
+    register_op(cls)
+
+
+# Transforms that always give the same output for the same input,
+# whose outputs may be cached (see horch.transforms.cache)
+deterministic_ops = [
+    ToTensor,
+    Resize,
+    Normalize,
+    Pad,
+    CenterCrop,
+    Grayscale,
+    PadToSquare,
+]
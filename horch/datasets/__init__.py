@@ -1,9 +1,11 @@
 import math
+import uuid
 
 import numpy as np
 from torch.utils.data import Dataset
 from torchvision.transforms import Compose
 from horch.transforms import InputTransform
+from horch.transforms.cache import sample_index
 
 BACKENDS = {
     'PIL': 0,
@@ -23,7 +25,8 @@ def set_backend(name):
     __BACKEND__ = BACKENDS[name]
 
 
-from horch.datasets.captcha import Captcha, CaptchaDetectionOnline, CaptchaOnline, CaptchaSegmentationOnline
+from horch.datasets.captcha import Captcha, CaptchaCorpus, CaptchaDetectionOnline, CaptchaOnline, \
+    CaptchaSegmentationOnline
 from horch.datasets.coco import CocoDetection
 from horch.datasets.voc import VOCDetection, VOCSegmentation, VOCDetectionConcat
 from horch.datasets.svhn import SVHNDetection
@@ -134,6 +137,56 @@ class CachedDataset(Dataset):
         return self.cache[idx]
 
 
+class IndexedDataset(Dataset):
+    """
+    Expose sample indices to the transform caches of `dataset` (see horch.transforms.cache),
+    so that cached outputs are looked up by index instead of by hashing the inputs.
+
+    Subsets (e.g. from a random `train_test_split`) are followed down to the dataset holding
+    the samples, and the samples are identified by their indices there and by the type, root,
+    split and length of that dataset, so a cache kept across runs with different splits
+    still serves the outputs of the same images.
+
+    Arguments:
+        dataset (Dataset): The dataset with a cached transform
+        name (str): Identifies the dataset in the cache. Must be set to reuse a disk cache
+            across runs, and distinct for datasets sharing a cache.
+    """
+
+    def __init__(self, dataset, name=None):
+        self.dataset = dataset
+        self.name = name or uuid.uuid4().hex[:8]
+        self._fingerprint = dataset_fingerprint(base_dataset(dataset)[0])
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        _, base_idx = base_dataset(self.dataset, idx)
+        with sample_index((self.name, self._fingerprint, base_idx)):
+            return self.dataset[idx]
+
+
+def base_dataset(dataset, idx=None):
+    """
+    The dataset under subsets (of horch or torch) of `dataset`, and the index there of `idx`.
+    """
+    while hasattr(dataset, 'dataset') and hasattr(dataset, 'indices'):
+        if idx is not None:
+            idx = dataset.indices[idx]
+        dataset = dataset.dataset
+    return dataset, None if idx is None else int(idx)
+
+
+def dataset_fingerprint(dataset):
+    """
+    A string identifying `dataset` by its type, root, split and length.
+    """
+    return "%s.%s(root=%r, train=%r, split=%r, len=%d)" % (
+        type(dataset).__module__, type(dataset).__qualname__, str(getattr(dataset, 'root', None)),
+        getattr(dataset, 'train', None), getattr(dataset, 'split', None), len(dataset))
+
+
 def batchify(ds, batch_size):
     n = len(ds)
     n_batches = math.ceil(n / batch_size)
@@ -1,8 +1,12 @@
 import os
+import json
 import pickle
 import random
 import string
+import threading
 from copy import deepcopy
+from multiprocessing import Pool
+from pathlib import Path
 
 import numpy as np
 from PIL import Image
@@ -51,11 +55,207 @@ class Captcha(Dataset):
         return len(self.data)
 
 
+class CaptchaCorpus:
+    r"""
+    Pregenerated CAPTCHAs stored as memory-mapped arrays in `root`, so that they
+    can be shared by DataLoader workers and reused across runs.
+
+    The corpus consists of
+
+        - images.npy: (size, height, width, 3) uint8 images.
+        - labels.npy: (size, nchars) int64 indices of the characters in `letters`.
+        - bboxes.npy: (size, nchars, 4) float32 bounding boxes of [l, t, w, h].
+        - instances.npy: (size, height, width) uint8 maps of character instances,
+          where 0 is background and k is the k-th character.
+        - meta.json: the generating config. The corpus is regenerated if it differs.
+
+    Parameters
+    ----------
+    root : ``str``
+        Directory to store the corpus.
+    image : ``ImageCaptcha``
+        CAPTCHA generator.
+    size : ``int``
+        Number of CAPTCHAs.
+    nchars : ``int``
+        Number of characters of each CAPTCHA.
+    letters : ``str``
+        Characters to be sampled from.
+    num_workers : ``int``
+        Number of processes to generate with.
+    """
+
+    files = ["images", "labels", "bboxes", "instances"]
+
+    def __init__(self, root, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, num_workers=1,
+                 noise_dots=.3, noise_curve=.3, **kwargs):
+        self.root = Path(root).expanduser().absolute()
+        self.image = image
+        self.size = size
+        self.nchars = nchars
+        self.letters = letters
+        self.num_workers = num_workers
+        self.kwargs = {"noise_dots": noise_dots, "noise_curve": noise_curve, **kwargs}
+
+        self._refresh_thread = None
+        self._refresh_indices = None
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        if self._load_meta() != self.meta():
+            self._create()
+        self._open()
+
+    def meta(self):
+        # As loaded from meta.json, e.g. with lists for tuples, to compare with it
+        return json.loads(json.dumps({
+            "size": self.size,
+            "nchars": self.nchars,
+            "letters": self.letters,
+            "width": self.image._width,
+            "height": self.image._height,
+            "fonts": [str(f) for f in self.image._fonts],
+            "font_sizes": list(self.image._font_sizes),
+            "kwargs": self.kwargs,
+        }))
+
+    def _load_meta(self):
+        fp = self.root / "meta.json"
+        if not fp.exists():
+            return None
+        with open(fp) as f:
+            return json.load(f)
+
+    def _create(self):
+        meta_fp = self.root / "meta.json"
+        if meta_fp.exists():
+            meta_fp.unlink()
+        _create_arrays(self.root, "", self.size, self.nchars, self.image._height, self.image._width)
+        self._fill("", self.size)
+        with open(meta_fp, 'w') as f:
+            json.dump(self.meta(), f)
+
+    def _open(self):
+        for name in self.files:
+            setattr(self, name, np.load(str(self.root / ("%s.npy" % name)), mmap_mode='r'))
+
+    def _fill(self, prefix, n):
+        # Generate `n` samples into the arrays of `prefix` in parallel.
+        num_workers = max(min(self.num_workers, n), 1)
+        args = [(self.image, str(self.root), prefix, positions,
+                 self.nchars, self.letters, random.getrandbits(32), self.kwargs)
+                for positions in np.array_split(np.arange(n), num_workers)]
+        if num_workers == 1:
+            for arg in args:
+                _fill_chunk(arg)
+        else:
+            with Pool(num_workers) as pool:
+                pool.map(_fill_chunk, args)
+
+    def refresh(self, fraction):
+        """Regenerate a random `fraction` of the corpus in the background.
+        The new samples are written to staging arrays and only replace the old
+        ones when `swap` is called."""
+        assert self._refresh_thread is None, "A refresh is in progress, call `swap` first"
+        n = int(self.size * fraction)
+        if n == 0:
+            return
+        indices = np.sort(np.random.choice(self.size, n, replace=False))
+        _create_arrays(self.root, "staging_", n, self.nchars, self.image._height, self.image._width)
+        self._refresh_indices = indices
+        self._refresh_thread = threading.Thread(target=self._fill, args=("staging_", n), daemon=True)
+        self._refresh_thread.start()
+
+    def swap(self):
+        """Wait for the background refresh and copy the new samples into the corpus.
+        It should only be called when no DataLoader worker is reading, e.g. between epochs."""
+        if self._refresh_thread is None:
+            return
+        self._refresh_thread.join()
+        indices = self._refresh_indices
+        for name in self.files:
+            src = self.root / ("staging_%s.npy" % name)
+            dst = np.load(str(self.root / ("%s.npy" % name)), mmap_mode='r+')
+            dst[indices] = np.load(str(src), mmap_mode='r')
+            dst.flush()
+            del dst
+            src.unlink()
+        self._refresh_thread = None
+        self._refresh_indices = None
+        self._open()
+
+    def attach(self, engine, fraction):
+        r"""
+        Rolling refresh: replace `fraction` of the corpus in the background every epoch.
+        """
+        from ignite.engine import Events
+
+        def rolling_refresh(_engine):
+            self.swap()
+            self.refresh(fraction)
+
+        engine.add_event_handler(Events.EPOCH_STARTED, rolling_refresh)
+
+    def get_image(self, index):
+        return Image.fromarray(np.asarray(self.images[index]))
+
+    def get_segmentation(self, index):
+        instances = np.asarray(self.instances[index])
+        table = np.concatenate([[0], self.labels[index] + 1]).astype(np.uint8)
+        return Image.fromarray(table[instances])
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_refresh_thread'] = None
+        for name in self.files:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+def _create_arrays(root, prefix, size, nchars, height, width):
+    shapes = {
+        "images": ((size, height, width, 3), np.uint8),
+        "labels": ((size, nchars), np.int64),
+        "bboxes": ((size, nchars, 4), np.float32),
+        "instances": ((size, height, width), np.uint8),
+    }
+    for name, (shape, dtype) in shapes.items():
+        fp = str(Path(root) / ("%s%s.npy" % (prefix, name)))
+        np.lib.format.open_memmap(fp, mode='w+', dtype=dtype, shape=shape).flush()
+
+
+def _fill_chunk(args):
+    image, root, prefix, positions, nchars, letters, seed, kwargs = args
+    random.seed(seed)
+    np.random.seed(seed)
+    arrays = {
+        name: np.load(str(Path(root) / ("%s%s.npy" % (prefix, name))), mmap_mode='r+')
+        for name in CaptchaCorpus.files
+    }
+    for i, (img, anns, labels) in zip(positions, image.generate_batch(len(positions), nchars, letters, **kwargs)):
+        arrays["images"][i] = np.asarray(img.convert("RGB"))
+        arrays["labels"][i] = labels
+        instances = np.zeros(img.size[::-1], dtype=np.uint8)
+        for k, ann in enumerate(anns):
+            arrays["bboxes"][i, k] = ann['bbox']
+            instances[np.asarray(ann['segmentation'], dtype=np.bool_)] = k + 1
+        arrays["instances"][i] = instances
+    for arr in arrays.values():
+        arr.flush()
+
+
 class CaptchaOnline(Dataset):
 
-    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True, **kwargs):
+    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True,
+                 num_workers=0, corpus=None, **kwargs):
         self.image = image
-        self.size = size
+        self.size = len(corpus) if corpus is not None else size
         self.nchars = nchars
         self.letters = letters
         self.transform = transform
@@ -63,21 +263,28 @@ class CaptchaOnline(Dataset):
         self.num_classes = len(self.letters)
         self.online = online
         self.kwargs = kwargs
+        self.corpus = corpus
 
-        if not self.online:
-            self.data = [self.gen_captcha(nchars) for _ in range(size)]
+        if not self.online and self.corpus is None:
+            self.data = [
+                (img, labels)
+                for img, _anns, labels in self.image.generate_batch(
+                    size, nchars, letters, num_workers, noise_dots=.3, noise_curve=.3, **kwargs)
+            ]
 
     def gen_captcha(self, nchars):
         labels = [random.randrange(self.num_classes) for _ in range(nchars)]
         labels = np.array(labels, dtype=np.int64)
         chars = [self.letters[i] for i in labels]
-        img = self.image.generate_image(
+        img, _anns = self.image.generate_image(
             chars, noise_dots=.3, noise_curve=.3, **self.kwargs)
         return img, labels
 
     def __getitem__(self, index):
         if self.online:
             img, target = self.gen_captcha(self.nchars)
+        elif self.corpus is not None:
+            img, target = self.corpus.get_image(index), np.array(self.corpus.labels[index])
         else:
             img, target = self.data[index]
 
@@ -92,9 +299,10 @@ class CaptchaOnline(Dataset):
 
 class CaptchaDetectionOnline(Dataset):
 
-    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True, **kwargs):
+    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True,
+                 num_workers=0, corpus=None, **kwargs):
         self.image = image
-        self.size = size
+        self.size = len(corpus) if corpus is not None else size
         self.nchars = nchars
         self.letters = letters
         self.num_classes = len(self.letters)
@@ -108,9 +316,13 @@ class CaptchaDetectionOnline(Dataset):
         from hpycocotools.mask import area, encode
         self.area_fn = area
         self.encode_fn = encode
+        self.corpus = corpus
 
-        if not self.online:
-            self.data = [self.gen_captcha(self.nchars, i) for i in range(size)]
+        if not self.online and self.corpus is None:
+            batch = self.image.generate_batch(
+                size, nchars, letters, num_workers, noise_dots=.3, noise_curve=.3, **kwargs)
+            self.data = [(img, self.encode_anns(anns, labels, i))
+                         for i, (img, anns, labels) in enumerate(batch)]
 
     def to_coco(self):
         categories = []
@@ -125,7 +337,7 @@ class CaptchaDetectionOnline(Dataset):
         assert not self.online, "Only non-online dataset could be transformed to coco style"
         ann_id = 0
         for i in range(self.size):
-            anns = self.data[i][1]
+            anns = self.corpus_anns(i) if self.corpus is not None else self.data[i][1]
             img = {
                 "file_name": "%d.jpg" % i,
                 "height": self.image._height,
@@ -150,20 +362,32 @@ class CaptchaDetectionOnline(Dataset):
         chars = [self.letters[i] for i in labels]
         img, anns = self.image.generate_image(
             chars, noise_dots=.3, noise_curve=.3, **self.kwargs)
+        return img, self.encode_anns(anns, labels, image_id)
+
+    def encode_anns(self, anns, labels, image_id=None):
         for ann, label in zip(anns, labels):
             ann['image_id'] = image_id
-            ann['category_id'] = label + 1
+            ann['category_id'] = int(label) + 1
             segm = np.asfortranarray(ann['segmentation'], dtype=np.uint8)
             segm = self.encode_fn(segm)
             ann['segmentation'] = segm
             ann['area'] = self.area_fn(segm)
             ann['iscrowd'] = 0
+        return anns
 
-        return img, anns
+    def corpus_anns(self, index):
+        instances = np.asarray(self.corpus.instances[index])
+        anns = [{
+            'bbox': self.corpus.bboxes[index, k].tolist(),
+            'segmentation': instances == k + 1,
+        } for k in range(self.nchars)]
+        return self.encode_anns(anns, self.corpus.labels[index], index)
 
     def __getitem__(self, index):
         if self.online:
             img, target = self.gen_captcha(self.nchars)
+        elif self.corpus is not None:
+            img, target = self.corpus.get_image(index), self.corpus_anns(index)
         else:
             img, target = self.data[index]
 
@@ -178,34 +402,47 @@ class CaptchaDetectionOnline(Dataset):
 
 class CaptchaSegmentationOnline(Dataset):
 
-    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True, **kwargs):
+    def __init__(self, image, size=50000, nchars=4, letters=ALPHABET_DIGITS, transform=None, online=True,
+                 num_workers=0, corpus=None, **kwargs):
         self.image = image
-        self.size = size
+        self.size = len(corpus) if corpus is not None else size
         self.nchars = nchars
         self.letters = letters
         self.num_classes = len(self.letters)
         self.transform = transform
         self.online = online
         self.kwargs = kwargs
-        self.table = [0] * 256
-        for i, c in enumerate(letters):
-            self.table[ord(c)] = i+1
+        self.corpus = corpus
 
-        if not self.online:
-            self.data = [self.gen_captcha(self.nchars, i) for i in range(size)]
+        if not self.online and self.corpus is None:
+            self.data = [
+                (img, self.anns_to_mask(anns, labels))
+                for img, anns, labels in self.image.generate_batch(
+                    size, nchars, letters, num_workers, noise_dots=.3, noise_curve=.3, **kwargs)
+            ]
 
     def gen_captcha(self, nchars, image_id=None):
         labels = [random.randrange(self.num_classes) for _ in range(nchars)]
         chars = [self.letters[i] for i in labels]
-        img, bboxes, mask = self.image.generate_image(
-            chars, noise_dots=.3, noise_curve=.3, return_bbox=True, return_mask=True, **self.kwargs)
-        mask = mask.point(self.table)
+        img, anns = self.image.generate_image(
+            chars, noise_dots=.3, noise_curve=.3, **self.kwargs)
+        return img, self.anns_to_mask(anns, labels)
 
-        return img, mask
+    @staticmethod
+    def anns_to_mask(anns, labels):
+        mask = None
+        for ann, label in zip(anns, labels):
+            segm = np.asarray(ann['segmentation'], dtype=np.bool_)
+            if mask is None:
+                mask = np.zeros(segm.shape, dtype=np.uint8)
+            mask[segm] = label + 1
+        return Image.fromarray(mask)
 
     def __getitem__(self, index):
         if self.online:
             img, target = self.gen_captcha(self.nchars)
+        elif self.corpus is not None:
+            img, target = self.corpus.get_image(index), self.corpus.get_segmentation(index)
         else:
             img, target = self.data[index]
 
@@ -6,8 +6,12 @@
     Generate Image CAPTCHAs, just the normal image CAPTCHAs you are using.
 """
 
-import os
+import math
 import random
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
 from PIL import Image
 from PIL import ImageFilter
 from PIL.ImageDraw import Draw
@@ -19,10 +23,6 @@ DEFAULT_FONTS = []
 __all__ = ['ImageCaptcha']
 
 
-table = [i * 1.97 for i in range(256)]
-m_table = [0] + [255] * 255
-
-
 class _Captcha(object):
     def generate(self, chars, format='png'):
         """Generate an Image Captcha of the given characters.
@@ -74,6 +74,7 @@ class ImageCaptcha(_Captcha):
         self._fonts = fonts
         self._font_sizes = font_sizes or (42, 50, 56)
         self._truefonts = []
+        self._glyphs = None
 
     @property
     def truefonts(self):
@@ -86,6 +87,12 @@ class ImageCaptcha(_Captcha):
         ])
         return self._truefonts
 
+    @property
+    def glyphs(self):
+        if self._glyphs is None:
+            self._glyphs = GlyphCache(self.truefonts)
+        return self._glyphs
+
     @staticmethod
     def create_noise_curve(image, color):
         w, h = image.size
@@ -101,28 +108,28 @@ class ImageCaptcha(_Captcha):
 
     @staticmethod
     def create_noise_dots(image, color, width=3, number=30):
-        draw = Draw(image)
         w, h = image.size
-        while number:
-            x1 = random.randint(0, w)
-            y1 = random.randint(0, h)
-            draw.line(((x1, y1), (x1 - 1, y1 - 1)), fill=color, width=width)
-            number -= 1
+        xs = np.random.randint(0, w + 1, size=(number, 1))
+        ys = np.random.randint(0, h + 1, size=(number, 1))
+        stamp = _line_stamp(width)
+        xs = (xs + stamp[:, 0]).ravel()
+        ys = (ys + stamp[:, 1]).ravel()
+        keep = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        Draw(image).point(list(zip(xs[keep].tolist(), ys[keep].tolist())), fill=color)
         return image
 
-    def _draw_character(self, draw, c, color, rotate):
-        font = random.choice(self.truefonts)
-        w, h = draw.textsize(c, font=font)
-
-        dx = random.randint(0, 4)
-        dy = random.randint(0, 6)
-        im = Image.new('RGBA', (w + dx, h + dy))
-        Draw(im).text((dx, dy), c, font=font, fill=color)
+    def _draw_character(self, c, rotate):
+        font_idx = random.randrange(len(self.truefonts))
+        w, h, glyph = self.glyphs.get(font_idx, c)
+        if glyph is None:
+            return np.zeros((h, w), dtype=np.uint8)
 
         # rotate
-        im = im.crop(im.getbbox())
-        im = im.rotate(random.uniform(-rotate, rotate),
-                       Image.BILINEAR, expand=1)
+        theta = math.radians(random.uniform(-rotate, rotate))
+        cos, sin = math.cos(theta), math.sin(theta)
+        gh, gw = glyph.shape[0] - 2, glyph.shape[1] - 2
+        rw = int(math.ceil(gw * abs(cos) + gh * abs(sin)))
+        rh = int(math.ceil(gw * abs(sin) + gh * abs(cos)))
 
         # warp
         dx = w * random.uniform(0.1, 0.3)
@@ -133,15 +140,19 @@ class ImageCaptcha(_Captcha):
         y2 = int(random.uniform(-dy, dy))
         w2 = w + abs(x1) + abs(x2)
         h2 = h + abs(y1) + abs(y2)
-        data = (
-            x1, y1,
-            -x1, h2 - y2,
-            w2 + x2, h2 + y2,
-            w2 - x2, -y1,
-        )
-        im = im.resize((w2, h2))
-        im = im.transform((w, h), Image.QUAD, data)
-        return im
+
+        # Compose quad warp -> resize -> rotation into a single inverse map,
+        # so that the glyph is resampled only once.
+        nw, sw, se, ne = (x1, y1), (-x1, h2 - y2), (w2 + x2, h2 + y2), (w2 - x2, -y1)
+        u = (np.arange(w, dtype=np.float32) + 0.5) / w
+        v = (np.arange(h, dtype=np.float32)[:, None] + 0.5) / h
+        qx = nw[0] + (ne[0] - nw[0]) * u + (sw[0] - nw[0]) * v + (se[0] - sw[0] - ne[0] + nw[0]) * u * v
+        qy = nw[1] + (ne[1] - nw[1]) * u + (sw[1] - nw[1]) * v + (se[1] - sw[1] - ne[1] + nw[1]) * u * v
+        rx = qx * (rw / w2) - rw / 2
+        ry = qy * (rh / h2) - rh / 2
+        sx = cos * rx - sin * ry + gw / 2 - 0.5
+        sy = sin * rx + cos * ry + gh / 2 - 0.5
+        return np.rint(_bilinear_sample(glyph, sx, sy)).astype(np.uint8)
 
     def create_captcha_image(self, chars, color, background, rotate):
         """Create the CAPTCHA image itself.
@@ -152,57 +163,62 @@ class ImageCaptcha(_Captcha):
 
         The color should be a tuple of 3 numbers, such as (0, 255, 255).
         """
-        image = Image.new('RGB', (self._width, self._height), background)
-        draw = Draw(image)
-
-        images = []
-        all_bboxes = []
+        glyphs = []
+        is_char = []
         for c in chars:
             if random.random() > 0.5:
-                images.append(self._draw_character(draw, " ", color, rotate))
-                all_bboxes.append(None)
-            img = self._draw_character(draw, c, color, rotate)
-            images.append(img)
-            bbox = list(img.getbbox())
-            bbox[2] -= bbox[0]
-            bbox[3] -= bbox[1]
-            all_bboxes.append(bbox)
-        images.append(self._draw_character(draw, " ", color, rotate))
-        all_bboxes.append(None)
-
-        text_width = sum([im.size[0] for im in images])
+                glyphs.append(self._draw_character(" ", rotate))
+                is_char.append(False)
+            glyphs.append(self._draw_character(c, rotate))
+            is_char.append(True)
+        glyphs.append(self._draw_character(" ", rotate))
+        is_char.append(False)
+
+        text_width = sum([g.shape[1] for g in glyphs])
 
         width = max(text_width, self._width)
-        image = image.resize((width, self._height))
+        height = self._height
+        image = np.empty((height, width, 3), dtype=np.float32)
+        image[...] = background[:3]
 
         average = int(text_width / len(chars))
         rand = int(0.25 * average)
         x_offset = int(average * 0.1)
 
+        rgb = np.array(color[:3], dtype=np.float32)
+        lum = (rgb[0] * 299 + rgb[1] * 587 + rgb[2] * 114) / 1000
+
         anns = []
-        for i, im in enumerate(images):
-            w, h = im.size
+        for g, char in zip(glyphs, is_char):
+            h, w = g.shape
             x_offset = min(x_offset, width - 1 - w)
-            im_l = im.convert('L')
-            cmask = im_l.point(table)
-            y_offset = (self._height - h) // 2
-            image.paste(im, (x_offset, y_offset), cmask)
-            if all_bboxes[i]:
-                bbox = all_bboxes[i]
-                bbox[0] += x_offset
-                bbox[1] += y_offset
-                ann = {
+            y_offset = (height - h) // 2
+            t, b = max(y_offset, 0), min(y_offset + h, height)
+            l, r = max(x_offset, 0), min(x_offset + w, width)
+            g = g[t - y_offset:b - y_offset, l - x_offset:r - x_offset]
+
+            cov = g.astype(np.float32) / 255
+            alpha = np.minimum(cov * (lum * 1.97 / 255), 1)[..., None]
+            region = image[t:b, l:r]
+            region += (cov[..., None] * rgb - region) * alpha
+
+            if char:
+                ys, xs = np.nonzero(g)
+                if len(xs):
+                    bbox = [int(xs.min()) + l, int(ys.min()) + t,
+                            int(xs.max() - xs.min()) + 1, int(ys.max() - ys.min()) + 1]
+                else:
+                    bbox = [x_offset, y_offset, 0, 0]
+                mask = np.zeros((height, width), dtype=np.bool_)
+                mask[t:b, l:r] = cov * lum >= 0.5
+                anns.append({
                     'bbox': bbox,
-                }
-                c = chars[len(anns)]
-                mask = Image.new('1', (width, self._height), 0)
-                mask.paste(im_l.point(m_table).convert(
-                    '1'), (x_offset, y_offset))
-                ann['segmentation'] = mask
-                anns.append(ann)
+                    'segmentation': Image.fromarray(mask),
+                })
 
             x_offset += w + random.randint(-rand, rand)
 
+        image = Image.fromarray(np.rint(image).astype(np.uint8))
         if width > self._width:
             image = image.resize((self._width, self._height))
             sw = self._width / width
@@ -232,6 +248,116 @@ class ImageCaptcha(_Captcha):
 
         return img, anns
 
+    def generate_batch(self, n, nchars, letters, num_workers=0, **kwargs):
+        """Generate `n` CAPTCHAs of `nchars` random characters drawn from `letters`.
+
+        :param n: number of CAPTCHAs.
+        :param nchars: number of characters of each CAPTCHA.
+        :param letters: characters to be sampled from.
+        :param num_workers: number of processes to generate with, 0 for the current process.
+
+        Returns a list of `(img, anns, labels)`, where `labels` are the indices of the
+        characters in `letters`. Keyword arguments are passed to `generate_image`.
+        """
+        if num_workers == 0:
+            return _generate_chunk((self, n, nchars, letters, None, kwargs))
+        chunks = [n // num_workers + (i < n % num_workers) for i in range(num_workers)]
+        args = [(self, m, nchars, letters, random.getrandbits(32), kwargs) for m in chunks if m]
+        with Pool(num_workers) as pool:
+            results = pool.map(_generate_chunk, args)
+        return [x for r in results for x in r]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_truefonts'] = []
+        state['_glyphs'] = None
+        return state
+
+
+class GlyphCache:
+    """Cache of pre-rendered glyph coverage bitmaps.
+
+    Glyphs are keyed by (font, char), where each font of `truefonts` is a
+    (font file, font size) pair. A glyph is rendered once at full coverage
+    and cropped to its bounding box; colors are applied at composition time.
+
+    :param truefonts: loaded fonts.
+    """
+
+    def __init__(self, truefonts):
+        self.truefonts = truefonts
+        self._cache = {}
+
+    def get(self, font_idx, c):
+        """Return `(w, h, glyph)`, where (w, h) is the text size of `c` and
+        `glyph` is a float32 coverage array with a one pixel zero border,
+        or None for blank characters."""
+        key = (font_idx, c)
+        if key not in self._cache:
+            font = self.truefonts[font_idx]
+            w, h = _text_size(font, c)
+            im = Image.new('L', (w, h))
+            Draw(im).text((0, 0), c, font=font, fill=255)
+            bbox = im.getbbox()
+            glyph = None
+            if bbox:
+                glyph = np.pad(np.asarray(im.crop(bbox), dtype=np.float32), 1)
+            self._cache[key] = (w, h, glyph)
+        return self._cache[key]
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def _text_size(font, c):
+    if hasattr(font, 'getsize'):
+        return font.getsize(c)
+    l, t, r, b = font.getbbox(c)
+    return r, b
+
+
+def _bilinear_sample(padded, xs, ys):
+    # `padded` has a one pixel zero border, coordinates are of the unpadded image.
+    h, w = padded.shape
+    xs = np.clip(xs + 1, 0, w - 1.001)
+    ys = np.clip(ys + 1, 0, h - 1.001)
+    x0 = xs.astype(np.int32)
+    y0 = ys.astype(np.int32)
+    fx = xs - x0
+    fy = ys - y0
+    flat = padded.ravel()
+    idx = y0 * w + x0
+    top = flat[idx] * (1 - fx) + flat[idx + 1] * fx
+    bottom = flat[idx + w] * (1 - fx) + flat[idx + w + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+@lru_cache(None)
+def _line_stamp(width):
+    # Pixels covered by a `width` wide line from (0, 0) to (-1, -1).
+    r = width / 2
+    d = np.arange(-int(r) - 1, int(r) + 1)
+    xs, ys = np.meshgrid(d, d)
+    xs, ys = xs.ravel(), ys.ravel()
+    t = np.clip(-(xs + ys) / 2, 0, 1)
+    dist = np.hypot(xs + t, ys + t)
+    keep = dist <= r
+    return np.stack([xs[keep], ys[keep]], axis=1)
+
+
+def _generate_chunk(args):
+    image, n, nchars, letters, seed, kwargs = args
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    results = []
+    for _ in range(n):
+        labels = np.array([random.randrange(len(letters)) for _ in range(nchars)], dtype=np.int64)
+        chars = [letters[i] for i in labels]
+        img, anns = image.generate_image(chars, **kwargs)
+        results.append((img, anns, labels))
+    return results
+
 
 def random_color(start, end, opacity=None):
     red = random.randint(start, end)
@@ -0,0 +1,255 @@
+r"""
+Throughput and latency benchmark of the models, installed as `horch-bench`.
+
+    horch-bench ResNet -a depth=20 -s 32 -b 128 -o resnet20.json
+    horch-bench efficientnet.EfficientNet -s 224 -b 32 --compare resnet20_old.json
+
+A model is a class in `horch.models.cifar`, a full import path or `module.Class` in `horch.models`,
+created with the arguments given by `-a`. For every combination of precision and memory format,
+it measures training images/s, inference latency percentiles at batch 1 and at the batch size,
+peak CUDA memory and, on CPU, inference throughput by the number of threads. The results are written
+as JSON with the versions and commit, and `--compare` prints the ratios to an earlier file.
+"""
+import argparse
+import ast
+import copy
+import importlib
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from horch.train.trainer_base import autocast
+
+MEMORY_FORMATS = {
+    'contiguous': torch.contiguous_format,
+    'channels_last': torch.channels_last,
+}
+
+
+def resolve_model(name):
+    r"""
+    The model class of `name`: a class in `horch.models.cifar`, a full import path,
+    or `module.Class` in `horch.models`.
+    """
+    if '.' not in name:
+        import horch.models.cifar
+        return getattr(horch.models.cifar, name)
+    module, cls = name.rsplit('.', 1)
+    try:
+        return getattr(importlib.import_module(module), cls)
+    except (ImportError, AttributeError):
+        # Not a full path, or a module of horch.models named like a top-level one (e.g. `re`)
+        if module.startswith('horch.'):
+            raise
+    return getattr(importlib.import_module('horch.models.' + module), cls)
+
+
+def parse_kwargs(items):
+    kwargs = {}
+    for item in items:
+        k, v = item.split('=', 1)
+        try:
+            kwargs[k] = ast.literal_eval(v)
+        except (ValueError, SyntaxError):
+            kwargs[k] = v
+    return kwargs
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _timings(f, device, warmup, iterations):
+    for _ in range(warmup):
+        f()
+    _sync(device)
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        f()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def _input(batch_size, size, device, memory_format):
+    x = torch.randn(batch_size, 3, size, size, device=device)
+    return x.contiguous(memory_format=memory_format)
+
+
+def bench_train(model, size, batch_size, device, precision, memory_format, warmup, iterations):
+    r"""
+    Training images/s with SGD and cross entropy on random inputs.
+    """
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+    x = _input(batch_size, size, device, memory_format)
+    with torch.no_grad():
+        num_classes = model(x[:2]).size(1)
+    y = torch.randint(num_classes, (batch_size,), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device, precision):
+            loss = F.cross_entropy(model(x).float(), y)
+        loss.backward()
+        optimizer.step()
+
+    times = _timings(step, device, warmup, iterations)
+    return batch_size / float(np.median(times))
+
+
+def bench_latency(model, size, batch_size, device, precision, memory_format, warmup, iterations):
+    r"""
+    Percentiles (50, 90, 99) of the inference latency in milliseconds.
+    """
+    model.eval()
+    x = _input(batch_size, size, device, memory_format)
+
+    def forward():
+        with torch.no_grad(), autocast(device, precision):
+            model(x)
+
+    times = _timings(forward, device, warmup, iterations)
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+    return {"p50": p50, "p90": p90, "p99": p99, "images_per_sec": batch_size / float(np.median(times))}
+
+
+def thread_scaling(model, size, batch_size, precision, memory_format, warmup, iterations, threads=None):
+    r"""
+    Inference images/s on CPU by the number of threads, powers of 2 up to the number of cores.
+    """
+    if threads is None:
+        n = os.cpu_count() or 1
+        threads = sorted({2 ** i for i in range(n.bit_length()) if 2 ** i <= n} | {n})
+    num_threads = torch.get_num_threads()
+    results = {}
+    try:
+        for t in threads:
+            torch.set_num_threads(t)
+            results[str(t)] = bench_latency(
+                model, size, batch_size, torch.device('cpu'), precision, memory_format,
+                warmup, iterations)["images_per_sec"]
+    finally:
+        torch.set_num_threads(num_threads)
+    return results
+
+
+def bench_variant(model, size, batch_size, device, precision, memory_format, warmup, iterations, threads):
+    memory_format = MEMORY_FORMATS[memory_format]
+    # A copy so that every variant starts from the same untrained weights
+    model = copy.deepcopy(model).to(device, memory_format=memory_format)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    result = {
+        "train_images_per_sec": bench_train(
+            model, size, batch_size, device, precision, memory_format, warmup, iterations),
+    }
+    if device.type == 'cuda':
+        result["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    result["latency_ms_batch_1"] = bench_latency(
+        model, size, 1, device, precision, memory_format, warmup, iterations)
+    result["latency_ms_batch_%d" % batch_size] = bench_latency(
+        model, size, batch_size, device, precision, memory_format, warmup, iterations)
+    if device.type == 'cpu' and threads != [0]:
+        result["thread_scaling_images_per_sec"] = thread_scaling(
+            model, size, batch_size, precision, memory_format, warmup, iterations, threads or None)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(d, prefix=''):
+    items = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            items.update(_flatten(v, prefix + k + '/'))
+        else:
+            items[prefix + k] = v
+    return items
+
+
+def compare(results, baseline):
+    r"""
+    Print the ratio of every number of `results` to that of `baseline`, for the variants in both.
+    """
+    print("Compared to %s:" % (baseline.get("commit") or baseline.get("time")))
+    for name, result in results["variants"].items():
+        if name not in baseline["variants"]:
+            continue
+        old = _flatten(baseline["variants"][name])
+        for k, v in _flatten(result).items():
+            if old.get(k):
+                print("  %-20s %-45s %10.2f -> %10.2f (%.2fx)" % (name, k, old[k], v, v / old[k]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput and latency of a model.')
+    parser.add_argument('model', help='class in horch.models.cifar, module.Class in horch.models or a full path')
+    parser.add_argument('-a', '--arg', action='append', default=[], help='argument of the model as key=value')
+    parser.add_argument('-s', '--size', type=int, default=32, help='size of the square images')
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-p', '--precision', nargs='+', default=['fp32', 'bf16'], choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('-m', '--memory-format', nargs='+', default=list(MEMORY_FORMATS),
+                        choices=list(MEMORY_FORMATS))
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--threads', type=int, nargs='*',
+                        help='numbers of CPU threads to scale, default to powers of 2, 0 to skip')
+    parser.add_argument('-o', '--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of earlier results to compare with')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    kwargs = parse_kwargs(args.arg)
+    model = resolve_model(args.model)(**kwargs)
+    results = {
+        "model": args.model,
+        "kwargs": kwargs,
+        "size": args.size,
+        "batch_size": args.batch_size,
+        "device": str(device),
+        "device_name": torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "params": sum(p.numel() for p in model.parameters()),
+        "torch": torch.__version__,
+        "commit": _git_commit(),
+        "time": datetime.now().isoformat(timespec='seconds'),
+        "variants": {},
+    }
+    for precision in args.precision:
+        for memory_format in args.memory_format:
+            name = "%s/%s" % (precision, memory_format)
+            results["variants"][name] = result = bench_variant(
+                model, args.size, args.batch_size, device, precision, memory_format,
+                args.warmup, args.iterations, args.threads)
+            print("%-20s train %8.1f images/s, latency batch 1 %7.2f ms, batch %d %8.2f ms" % (
+                name, result["train_images_per_sec"], result["latency_ms_batch_1"]["p50"], args.batch_size,
+                result["latency_ms_batch_%d" % args.batch_size]["p50"]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
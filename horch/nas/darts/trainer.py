@@ -3,7 +3,8 @@ from ignite.engine import Engine
 from ignite.utils import convert_tensor
 from torch import nn as nn
 
-from horch.train.trainer_base import backward, TrainerBase
+from horch.train.profiler import record
+from horch.train.trainer_base import backward, TrainerBase, autocast, create_grad_scaler, unscale, optimizer_step
 
 
 def requires_grad(network: nn.Module, arch: bool, model: bool):
@@ -14,34 +15,44 @@ def requires_grad(network: nn.Module, arch: bool, model: bool):
 
 
 def create_darts_trainer(
-        network, criterion, optimizer_arch, optimizer_model, metrics, device, clip_grad_norm=5, fp16=False):
+        network, criterion, optimizer_arch, optimizer_model, metrics, device, clip_grad_norm=5,
+        precision='fp32', scaler=None):
+
+    if scaler is None:
+        scaler = create_grad_scaler(device, precision)
 
     def step(engine, batch):
         network.train()
 
-        (input, target), (input_search, target_search) = convert_tensor(batch, device)
+        with record("h2d"):
+            (input, target), (input_search, target_search) = convert_tensor(batch, device)
 
         optimizer_arch.zero_grad()
         requires_grad(network, arch=True, model=False)
-        logits = network(input)
-        loss = criterion(logits, target)
-        backward(loss, optimizer_arch, fp16)
-        optimizer_arch.step()
+        with record("forward"), autocast(device, precision):
+            logits = network(input)
+            loss = criterion(logits, target)
+        backward(loss, scaler)
+        optimizer_step(optimizer_arch, scaler)
 
         optimizer_model.zero_grad()
         requires_grad(network, arch=False, model=True)
-        logits_search = network(input_search)
-        loss_search = criterion(logits_search, target_search)
-        backward(loss_search, optimizer_model, fp16)
+        with record("forward"), autocast(device, precision):
+            logits_search = network(input_search)
+            loss_search = criterion(logits_search, target_search)
+        backward(loss_search, scaler)
         if clip_grad_norm:
+            unscale(optimizer_model, scaler)
             nn.utils.clip_grad_norm_(network.parameters(), clip_grad_norm)
-        optimizer_model.step()
+        optimizer_step(optimizer_model, scaler)
+        if scaler is not None:
+            scaler.update()
 
         return {
-            "loss": loss.item(),
+            "loss": loss.detach(),
             "batch_size": input.size(0),
             "y_true": target_search,
-            "y_pred": logits_search.detach(),
+            "y_pred": logits_search.detach().float(),
         }
 
     engine = Engine(step)
@@ -52,18 +63,19 @@ def create_darts_trainer(
     return engine
 
 
-def create_darts_evaluator(network, metrics, device):
+def create_darts_evaluator(network, metrics, device, precision='fp32'):
 
     def step(engine, batch):
         network.eval()
-        input, target = convert_tensor(batch, device)
-        with torch.no_grad():
+        with record("h2d"):
+            input, target = convert_tensor(batch, device)
+        with torch.no_grad(), record("forward"), autocast(device, precision):
             output = network(input)
 
         return {
             "batch_size": input.size(0),
             "y_true": target,
-            "y_pred": output,
+            "y_pred": output.float(),
         }
 
     engine = Engine(step)
@@ -79,9 +91,9 @@ class DARTSTrainer(TrainerBase):
     def _create_train_engine(self):
         engine = create_darts_trainer(
             self.model, self.criterion, self.optimizers[0], self.optimizers[1],
-            self.metrics, self.device, fp16=self.fp16)
+            self.metrics, self.device, precision=self.precision, scaler=self.scaler)
         return engine
 
     def _create_eval_engine(self):
-        engine = create_darts_evaluator(self.model, self.test_metrics, self.device)
+        engine = create_darts_evaluator(self.model, self.test_metrics, self.device, self.precision)
         return engine
\ No newline at end of file
@@ -182,6 +182,8 @@ class CrossEntropyLoss(nn.Module):
         self.label_smoothing, self.reduction = label_smoothing, reduction
 
     def forward(self, output, target):
+        if target.is_floating_point():
+            return self._soft_forward(output, target)
         if self.label_smoothing:
             c = output.size(1)
             log_probs = F.log_softmax(output, dim=1)
@@ -194,4 +196,18 @@ class CrossEntropyLoss(nn.Module):
             loss = loss * self.label_smoothing / c + (1 - self.label_smoothing) * F.nll_loss(log_probs, target, reduction=self.reduction)
             return loss - calculate_gain(self.label_smoothing, c)
         else:
-            return F.cross_entropy(output, target, reduction=self.reduction)
\ No newline at end of file
+            return F.cross_entropy(output, target, reduction=self.reduction)
+
+    def _soft_forward(self, output, target):
+        # target: class probabilities of size (N, C), e.g. mixed by Mixup or CutMix
+        c = output.size(1)
+        if self.label_smoothing:
+            target = target * (1 - self.label_smoothing) + self.label_smoothing / c
+        loss = -(target * F.log_softmax(output, dim=1)).sum(dim=1)
+        if self.reduction == 'sum':
+            loss = loss.sum()
+        elif self.reduction == 'mean':
+            loss = loss.mean()
+        if self.label_smoothing:
+            loss = loss - calculate_gain(self.label_smoothing, c)
+        return loss
\ No newline at end of file
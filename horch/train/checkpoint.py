@@ -0,0 +1,476 @@
+import atexit
+import copy
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+import torch
+from ignite.handlers.checkpoint import BaseSaveHandler
+
+LATEST = "latest"
+TENSORS = "tensors.bin"
+META = "meta.pkl"
+DELTA = "delta.bin"
+CHAIN = "chain.pkl"
+ALIGNMENT = 64
+# Float tensors from this size are restored as views of the mapped file, the others copied
+MIN_MAPPED_BYTES = 1 << 16
+
+
+def atomic_save(obj, path):
+    r"""
+    Save `obj` by torch.save to a temporary file in the directory of `path` and rename it,
+    so `path` is never left partially written.
+    """
+    tmp = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(path))
+    try:
+        torch.save(obj, tmp.file)
+    except BaseException:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+    else:
+        tmp.close()
+        os.replace(tmp.name, path)
+
+
+class TensorRef:
+    r"""
+    Placeholder of a tensor in the metadata of a flat checkpoint, at `offset` of the tensor file.
+    """
+
+    def __init__(self, offset, dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * torch.empty((), dtype=self.dtype).element_size()
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _flatten(obj, tensors, offset):
+    if torch.is_tensor(obj):
+        ref = TensorRef(offset, obj.dtype, tuple(obj.shape))
+        tensors.append(obj)
+        return ref, _align(offset + ref.nbytes)
+    if isinstance(obj, dict):
+        d = obj.__class__()
+        for k, v in obj.items():
+            d[k], offset = _flatten(v, tensors, offset)
+        return d, offset
+    if isinstance(obj, (list, tuple)):
+        xs = []
+        for v in obj:
+            v, offset = _flatten(v, tensors, offset)
+            xs.append(v)
+        return obj.__class__(xs), offset
+    return obj, offset
+
+
+def save_flat(obj, path):
+    r"""
+    Save `obj` to directory `path` as a flat checkpoint: the bytes of all tensors, aligned,
+    in one file that can be memory-mapped, and the rest of `obj` with TensorRefs in a small
+    metadata file. The directory is written elsewhere and renamed into place.
+    """
+    path = Path(path)
+    tensors = []
+    meta, _ = _flatten(obj, tensors, 0)
+    tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=".tmp_"))
+    try:
+        with open(tmp / TENSORS, 'wb') as f:
+            for t in tensors:
+                f.seek(_align(f.tell()))
+                f.write(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(tmp / META, 'wb') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _restore(obj, data):
+    if isinstance(obj, TensorRef):
+        t = data[obj.offset:obj.offset + obj.nbytes].view(obj.dtype).view(obj.shape)
+        if not t.is_floating_point() or obj.nbytes < MIN_MAPPED_BYTES:
+            t = t.clone()
+        return t
+    if isinstance(obj, dict):
+        return obj.__class__((k, _restore(v, data)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_restore(v, data) for v in obj)
+    return obj
+
+
+def load_flat(path):
+    r"""
+    Load a flat checkpoint saved by `save_flat` with the large float tensors memory-mapped
+    copy-on-write. Nothing of them is read until they are used, e.g. copied into the parameters
+    by `load_state_dict`, and in-place updates only copy the pages they touch. They are views
+    with an offset into the mapping; the other tensors, e.g. RNG states and step counters,
+    are copied into tensors of their own.
+    """
+    path = Path(path)
+    with open(path / META, 'rb') as f:
+        meta = pickle.load(f)
+    size = os.path.getsize(path / TENSORS)
+    if size == 0:
+        data = torch.empty(0, dtype=torch.uint8)
+    else:
+        data = torch.from_numpy(np.memmap(path / TENSORS, dtype=np.uint8, mode='c', shape=(size,)))
+    return _restore(meta, data)
+
+
+def is_flat(path):
+    return (Path(path) / META).exists()
+
+
+def is_delta(path):
+    return (Path(path) / CHAIN).exists()
+
+
+def _write_dir(path, files):
+    # Write `files` (name -> bytes-like) to a temporary directory and rename it to `path`
+    path = Path(path)
+    tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=".tmp_"))
+    try:
+        for name, data in files.items():
+            with open(tmp / name, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _read_chain(path):
+    with open(Path(path) / CHAIN, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_delta(path):
+    r"""
+    Load a delta checkpoint saved by `DeltaDiskSaver`, reading its base snapshot and
+    applying the deltas of the chain up to it in order.
+    """
+    path = Path(path)
+    chain = [path]
+    while is_delta(chain[-1]):
+        chain.append(path.parent / _read_chain(chain[-1])['parent'])
+    base = chain.pop()
+    head = _read_chain(path)
+    chunk_size = head['chunk_size']
+    data = np.zeros(_ceil_to(os.path.getsize(base / TENSORS), chunk_size), dtype=np.uint8)
+    with open(base / TENSORS, 'rb') as f:
+        f.readinto(memoryview(data))
+    for p in reversed(chain):
+        d = _read_chain(p)
+        if d['size'] > len(data):
+            data = np.concatenate([data, np.zeros(_ceil_to(d['size'], chunk_size) - len(data), dtype=np.uint8)])
+        with open(p / DELTA, 'rb') as f:
+            for i, length, compressed in d['chunks']:
+                x = f.read(length)
+                if compressed:
+                    x = zlib.decompress(x)
+                chunk = data[i * chunk_size:(i + 1) * chunk_size]
+                np.bitwise_xor(chunk, np.frombuffer(x, dtype=np.uint8), out=chunk)
+    with open(path / META, 'rb') as f:
+        meta = pickle.load(f)
+    return _restore(meta, torch.from_numpy(data[:head['size']]))
+
+
+def _ceil_to(n, m):
+    return (n + m - 1) // m * m
+
+
+def write_latest(dirname, filename):
+    r"""
+    Atomically point the `latest` file in `dirname` to checkpoint `filename`.
+    """
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(fd, 'w') as f:
+        f.write(filename)
+    os.replace(tmp, os.path.join(dirname, LATEST))
+
+
+def read_latest(dirname):
+    r"""
+    Path of the checkpoint pointed by the `latest` file in `dirname`, or None.
+    """
+    try:
+        with open(os.path.join(dirname, LATEST)) as f:
+            filename = f.read().strip()
+    except FileNotFoundError:
+        return None
+    path = Path(dirname) / filename
+    return path if path.exists() else None
+
+
+def load_checkpoint(path, map_location=None):
+    r"""
+    Load a checkpoint saved by torch.save, `save_flat` or `DeltaDiskSaver`.
+    """
+    if is_delta(path):
+        return load_delta(path)
+    if is_flat(path):
+        return load_flat(path)
+    return torch.load(path, map_location=map_location)
+
+
+class AsyncDiskSaver(BaseSaveHandler):
+    r"""
+    Save handler of ignite's Checkpoint writing in a background thread.
+
+    Every save copies the tensors of the checkpoint into CPU staging buffers, which are
+    reused by later saves, and returns while a thread writes them atomically to `dirname`.
+    The removals of Checkpoint (for `n_saved`) are queued after the writes, and pending
+    writes are flushed by `wait`, `close` or at exit. The `latest` file is pointed to
+    every checkpoint after it is written.
+
+    Args:
+        dirname (str): Directory of the checkpoints.
+        atomic (bool): Whether to write to a temporary file and rename it.
+        create_dir (bool): Whether to create `dirname` if it doesn't exist.
+        pin_memory (bool): Whether to allocate the staging buffers in pinned memory,
+            which speeds up copies from CUDA.
+        flat (bool): Whether to save in the memory-mappable layout of `save_flat`,
+            which is always atomic.
+    """
+
+    def __init__(self, dirname, atomic=True, create_dir=True, pin_memory=False, flat=False):
+        self.dirname = Path(dirname).expanduser()
+        self.atomic = atomic
+        self.flat = flat
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        if create_dir:
+            self.dirname.mkdir(parents=True, exist_ok=True)
+        if not self.dirname.exists():
+            raise ValueError("Directory path '%s' is not found" % self.dirname)
+
+        self._buffers = {}
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                f, args = task
+                f(*args)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _snapshot(self, obj, key):
+        if torch.is_tensor(obj):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory)
+                self._buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=self.pin_memory)
+            return buf
+        if isinstance(obj, dict):
+            return obj.__class__((k, self._snapshot(v, key + (k,))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return obj.__class__(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def _write(self, checkpoint, path):
+        if self.flat:
+            save_flat(checkpoint, path)
+        elif self.atomic:
+            atomic_save(checkpoint, path)
+        else:
+            torch.save(checkpoint, path)
+        write_latest(self.dirname, os.path.basename(path))
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def __call__(self, checkpoint, filename, metadata=None):
+        # The buffers are being written by the last save
+        self.wait()
+        snapshot = self._snapshot(checkpoint, ())
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        self._queue.put((self._write, (snapshot, str(self.dirname / filename))))
+
+    def remove(self, filename):
+        self._queue.put((self._remove, (str(self.dirname / filename),)))
+
+    def wait(self):
+        r"""
+        Block until all pending writes and removals are done.
+        """
+        self._queue.join()
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+
+class DeltaDiskSaver(AsyncDiskSaver):
+    r"""
+    Save handler of ignite's Checkpoint writing a full snapshot every `full_every` saves,
+    and in between only the chunks of the tensors changed since the last save, which makes
+    frequent checkpoints (e.g. `save_freq=Iters(n)`) cheap to write.
+
+    The tensors are laid out as in `save_flat` and split into chunks of `chunk_size` bytes,
+    compared with the last save kept in memory. A changed chunk is written as its XOR with
+    the old one compressed by zlib, which also shrinks chunks where only the low bytes of
+    the floats moved. Every delta refers to the save before it, and `load_checkpoint`
+    reconstructs it from the base snapshot of its chain, so resuming reads at most
+    `full_every` saves. The saves removed by Checkpoint (for `n_saved`) are deleted once no
+    remaining chain depends on them. Note that Adam-family moments change everywhere at
+    every step, so the savings come from frozen or sparsely updated tensors and compression.
+
+    Bytes written by every save are printed and recorded in `history` as
+    (filename, bytes, whether it is a full snapshot).
+
+    Args:
+        dirname (str): Directory of the checkpoints.
+        full_every (int): Number of saves per chain, starting with a full snapshot.
+        chunk_size (int): Size of the compared chunks in bytes, a multiple of 8.
+        compress_level (int): zlib compression level of the changed chunks.
+        create_dir (bool): Whether to create `dirname` if it doesn't exist.
+        pin_memory (bool): Whether to allocate the staging buffers in pinned memory.
+        verbose (bool): Whether to print the bytes written by every save.
+    """
+
+    def __init__(self, dirname, full_every=10, chunk_size=1 << 20, compress_level=1,
+                 create_dir=True, pin_memory=False, verbose=True):
+        if chunk_size % 8 != 0:
+            raise ValueError("chunk_size must be a multiple of 8, got %d" % chunk_size)
+        self.full_every = full_every
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+        self.verbose = verbose
+        self.history = []
+
+        self._cur = None
+        self._prev = None
+        self._head = None
+        self._count = 0
+        self._parents = {}
+        self._live = set()
+        super().__init__(dirname, atomic=True, create_dir=create_dir, pin_memory=pin_memory, flat=True)
+
+    def _pack(self, checkpoint):
+        tensors = []
+        meta, size = _flatten(checkpoint, tensors, 0)
+        n = _ceil_to(size, self.chunk_size)
+        if self._cur is None or len(self._cur) != n:
+            self._cur = np.zeros(n, dtype=np.uint8)
+        for t, ref in zip(tensors, _refs(meta)):
+            if ref.nbytes:
+                self._cur[ref.offset:ref.offset + ref.nbytes] = t.contiguous().view(-1).view(torch.uint8).numpy()
+        return meta, size
+
+    def _write(self, checkpoint, path):
+        meta, size = self._pack(checkpoint)
+        cur, prev = self._cur, self._prev
+        filename = os.path.basename(path)
+        files = {META: pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)}
+        full = prev is None or len(prev) != len(cur) or self._count % self.full_every == 0
+        chunks = []
+        if full:
+            files[TENSORS] = memoryview(cur[:size])
+            self._count = 0
+        else:
+            cs = self.chunk_size
+            changed = np.flatnonzero((cur.view(np.uint64).reshape(-1, cs // 8) !=
+                                      prev.view(np.uint64).reshape(-1, cs // 8)).any(axis=1))
+            blobs = []
+            for i in changed:
+                x = np.bitwise_xor(cur[i * cs:(i + 1) * cs], prev[i * cs:(i + 1) * cs]).tobytes()
+                z = zlib.compress(x, self.compress_level)
+                compressed = len(z) < len(x)
+                blobs.append(z if compressed else x)
+                chunks.append((int(i), len(blobs[-1]), compressed))
+            files[DELTA] = b''.join(blobs)
+            files[CHAIN] = pickle.dumps({'parent': self._head, 'size': size, 'chunk_size': cs, 'chunks': chunks},
+                                        protocol=pickle.HIGHEST_PROTOCOL)
+        _write_dir(path, files)
+        write_latest(self.dirname, filename)
+
+        self._parents[filename] = None if full else self._head
+        self._live.add(filename)
+        self._head = filename
+        self._count += 1
+        self._prev, self._cur = cur, prev
+        self._collect()
+
+        nbytes = sum(len(data) for data in files.values())
+        self.history.append((filename, nbytes, full))
+        if self.verbose:
+            print("Checkpoint %s: %.2f MB written (%s)" % (
+                filename, nbytes / 2 ** 20, "full" if full else "delta of %d/%d chunks" % (
+                    len(chunks), len(cur) // self.chunk_size)))
+
+    def _collect(self):
+        # Delete the saves neither kept nor in the chain of a kept save or of the next delta
+        needed = set()
+        for name in self._live | {self._head}:
+            while name is not None and name not in needed:
+                needed.add(name)
+                name = self._parents[name]
+        for name in list(self._parents):
+            if name not in needed:
+                del self._parents[name]
+                super()._remove(str(self.dirname / name))
+
+    def _remove(self, path):
+        name = os.path.basename(path)
+        if name not in self._parents:
+            super()._remove(path)
+            return
+        self._live.discard(name)
+        self._collect()
+
+
+def _refs(meta):
+    if isinstance(meta, TensorRef):
+        yield meta
+    elif isinstance(meta, dict):
+        for v in meta.values():
+            yield from _refs(v)
+    elif isinstance(meta, (list, tuple)):
+        for v in meta:
+            yield from _refs(v)
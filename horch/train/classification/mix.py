@@ -1,7 +1,8 @@
 import math
-import numpy as np
 
 import torch
+import torch.nn.functional as F
+from torch.distributions import Beta
 
 
 class MixBase:
@@ -12,90 +13,188 @@ class MixBase:
     def __call__(self, x, y):
         pass
 
-    def loss(self, criterion, y_pred, y_true):
+    def loss(self, criterion, y_pred, y_true, lam=None):
         pass
 
 
 def calculate_gain(p):
+    # Entropy of the mixing weights, averaged over the samples if `p` is a tensor
+    if torch.is_tensor(p):
+        return -(torch.special.xlogy(p, p) + torch.special.xlogy(1 - p, 1 - p)).mean()
     if p == 0 or p == 1:
         return 0
     return -p * math.log(p) - (1 - p) * math.log(1 - p)
 
 
-class Mixup(MixBase):
+def sample_beta(alpha, shape, device):
+    # Beta(alpha, alpha) drawn by the generator of `device`, without syncing with the host
+    alpha = torch.tensor(float(alpha), device=device)
+    return Beta(alpha, alpha).sample(shape)
+
+
+def mix_loss(criterion, y_pred, y_a, y_b, lam, fused=False):
+    r"""
+    Loss of `y_pred` against the targets `y_a` and `y_b` mixed by `lam` (a scalar or per sample).
 
-    def __init__(self, alpha):
+    With `fused`, `criterion` is called once with the soft targets, which requires it to accept
+    class probabilities (as `nn.CrossEntropyLoss` and `horch.nn.loss.CrossEntropyLoss` do).
+    Otherwise it is called for each of the targets, which only supports a scalar `lam`.
+    """
+    if fused:
+        c = y_pred.size(1)
+        lam = lam.view(-1, 1).to(y_pred.dtype)
+        target = F.one_hot(y_b, c).to(y_pred.dtype)
+        target.lerp_(F.one_hot(y_a, c).to(y_pred.dtype), lam)
+        loss = criterion(y_pred, target)
+    else:
+        loss = lam * criterion(y_pred, y_a) + (1 - lam) * criterion(y_pred, y_b)
+    return loss - calculate_gain(lam)
+
+
+class Mixup(MixBase):
+    r"""
+    Mixup, mixing the batch with a permutation of itself in place, so the input batch is
+    modified. Pass a clone to keep it.
+
+    Args:
+        alpha (float): Parameter of the Beta distribution of the mixing weights.
+        per_sample (bool): Whether to draw a weight for every sample instead of one for the batch,
+            which computes the loss with soft targets as `fused`.
+        fused (bool): Whether to compute the loss by one call of the criterion with soft targets,
+            which the criterion must accept as class probabilities.
+    """
+
+    def __init__(self, alpha, per_sample=False, fused=False):
         super().__init__()
         self.alpha = alpha
+        self.per_sample = per_sample
+        self.fused = fused
         self.lam = None
 
     def __call__(self, x, y):
-        lam = np.random.beta(self.alpha, self.alpha) if self.alpha > 0 else 1
-
-        batch_size = x.size()[0]
+        batch_size = x.size(0)
+        if self.alpha > 0:
+            lam = sample_beta(self.alpha, (batch_size,) if self.per_sample else (), x.device)
+        else:
+            lam = x.new_ones(())
         index = torch.randperm(batch_size, device=x.device)
 
-        mixed_x = lam * x + (1 - lam) * x[index, :]
-        y_a, y_b = y, y[index]
+        weight = (1 - lam).view(-1, *(1,) * (x.dim() - 1)).to(x.dtype)
+        x.lerp_(x[index], weight)
         self.lam = lam
-        return mixed_x, (y_a, y_b)
+        return x, (y, y[index])
 
-    def loss(self, criterion, y_pred, y_true):
+    def loss(self, criterion, y_pred, y_true, lam=None):
+        # `lam` overrides the weights of the last batch, e.g. for a micro-batch of it
+        lam = self.lam if lam is None else lam
         y_a, y_b = y_true
-        loss = self.lam * criterion(y_pred, y_a) + (1 - self.lam) * criterion(y_pred, y_b)
-        return loss - calculate_gain(self.lam)
+        return mix_loss(criterion, y_pred, y_a, y_b, lam, self.fused or self.per_sample)
 
 
 def rand_bbox(size, lam):
     w = size[2]
     h = size[3]
-    cut_rat = np.sqrt(1. - lam)
-    cut_w = np.int(w * cut_rat)
-    cut_h = np.int(h * cut_rat)
+    cut_rat = (1. - lam) ** 0.5
+    cut_w = int(w * cut_rat)
+    cut_h = int(h * cut_rat)
 
     # uniform
-    cx = np.random.randint(w)
-    cy = np.random.randint(h)
+    cx = int(torch.randint(w, ()))
+    cy = int(torch.randint(h, ()))
 
-    bbx1 = np.clip(cx - cut_w // 2, 0, w)
-    bby1 = np.clip(cy - cut_h // 2, 0, h)
-    bbx2 = np.clip(cx + cut_w // 2, 0, w)
-    bby2 = np.clip(cy + cut_h // 2, 0, h)
+    bbx1 = min(max(cx - cut_w // 2, 0), w)
+    bby1 = min(max(cy - cut_h // 2, 0), h)
+    bbx2 = min(max(cx + cut_w // 2, 0), w)
+    bby2 = min(max(cy + cut_h // 2, 0), h)
 
     return bbx1, bby1, bbx2, bby2
 
 
-class CutMix(MixBase):
+def rand_bbox_mask(size, lam):
+    # Boxes of rand_bbox drawn per sample, as a (N, 1, W, H) mask, and the fractions of the images outside
+    n, _, w, h = size
+    cut_rat = (1. - lam).sqrt()
+    half_w = (w * cut_rat).long() // 2
+    half_h = (h * cut_rat).long() // 2
+    cx = torch.randint(w, (n,), device=lam.device)
+    cy = torch.randint(h, (n,), device=lam.device)
+
+    bbx1 = (cx - half_w).clamp(0, w)
+    bby1 = (cy - half_h).clamp(0, h)
+    bbx2 = (cx + half_w).clamp(0, w)
+    bby2 = (cy + half_h).clamp(0, h)
+
+    xs = torch.arange(w, device=lam.device)
+    ys = torch.arange(h, device=lam.device)
+    in_x = (xs >= bbx1[:, None]) & (xs < bbx2[:, None])
+    in_y = (ys >= bby1[:, None]) & (ys < bby2[:, None])
+    mask = (in_x[:, :, None] & in_y[:, None, :])[:, None]
+    lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1)).float() / (w * h)
+    return mask, lam
 
-    def __init__(self, beta, prob):
+
+class CutMix(MixBase):
+    r"""
+    CutMix, pasting boxes of a permutation of the batch in place, so the input batch is
+    modified. Pass a clone to keep it.
+
+    Args:
+        beta (float): Parameter of the Beta distribution of the box areas.
+        prob (float): Probability to mix the batch, or every sample if `per_sample`.
+        per_sample (bool): Whether to draw a box for every sample instead of one for the batch,
+            which computes the loss with soft targets as `fused`.
+        fused (bool): Whether to compute the loss by one call of the criterion with soft targets,
+            which the criterion must accept as class probabilities.
+    """
+
+    def __init__(self, beta, prob, per_sample=False, fused=False):
         super().__init__()
         self.beta = beta
         self.prob = prob
+        self.per_sample = per_sample
+        self.fused = fused
         self.lam = None
 
     def __call__(self, x, y):
-        r = np.random.rand()
-        if r > self.prob:
+        batch_size = x.size(0)
+        if self.per_sample:
+            return self._mix_per_sample(x, y)
+
+        if float(torch.rand(())) > self.prob:
             self.lam = None
             return x, y
 
-        lam = np.random.beta(self.beta, self.beta) if self.beta > 0 else 1
-
-        batch_size = x.size()[0]
+        lam = float(sample_beta(self.beta, (), 'cpu')) if self.beta > 0 else 1
         index = torch.randperm(batch_size, device=x.device)
 
         y_a, y_b = y, y[index]
         bbx1, bby1, bbx2, bby2 = rand_bbox(x.size(), lam)
         x[:, :, bbx1:bbx2, bby1:bby2] = x[index, :, bbx1:bbx2, bby1:bby2]
         lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (x.size()[-1] * x.size()[-2]))
-        self.lam = lam
+        self.lam = x.new_tensor(lam, dtype=torch.float)
         return x, (y_a, y_b)
 
-    def loss(self, criterion, y_pred, y_true):
-        if self.lam:
+    def _mix_per_sample(self, x, y):
+        batch_size = x.size(0)
+        if self.beta > 0:
+            lam = sample_beta(self.beta, (batch_size,), x.device)
+        else:
+            lam = x.new_ones(batch_size, dtype=torch.float)
+        # Samples not mixed get empty boxes
+        lam = torch.where(torch.rand(batch_size, device=x.device) < self.prob, lam, torch.ones_like(lam))
+        index = torch.randperm(batch_size, device=x.device)
+
+        mask, lam = rand_bbox_mask(x.size(), lam)
+        x_b = x[index]
+        x_b.mul_(mask).add_(x.mul_(~mask))
+        self.lam = lam
+        return x_b, (y, y[index])
+
+    def loss(self, criterion, y_pred, y_true, lam=None):
+        if self.lam is not None:
+            lam = self.lam if lam is None else lam
             y_a, y_b = y_true
-            loss = self.lam * criterion(y_pred, y_a) + (1 - self.lam) * criterion(y_pred, y_b)
-            return loss - calculate_gain(self.lam)
+            return mix_loss(criterion, y_pred, y_a, y_b, lam, self.fused or self.per_sample)
         else:
             return criterion(y_pred, y_true)
 
@@ -107,4 +206,3 @@ def get_mix(cfg):
     cfg.pop("type")
     mix = eval(mix_type)(**cfg)
     return mix
-
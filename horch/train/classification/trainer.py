@@ -1,6 +1,7 @@
 from typing import Callable, Sequence, Dict, Optional
 
 from ignite.metrics import Metric
+from ignite.metrics.metric import MetricUsage
 from toolz.curried import get
 
 import numpy as np
@@ -15,7 +16,11 @@ from torch.optim import Optimizer
 
 from horch.functools import pick
 from horch.train.classification.mix import MixBase
-from horch.train.trainer_base import backward, TrainerBase
+from horch.train.distributed import no_sync
+from horch.train.prefetch import is_staged
+from horch.train.profiler import record
+from horch.train.trainer_base import backward, TrainerBase, autocast, create_grad_scaler, unscale, optimizer_step, \
+    split_batch, micro_batch_size_for
 
 
 def create_supervised_trainer(
@@ -24,52 +29,122 @@ def create_supervised_trainer(
         optimizer: Optimizer,
         metrics: Dict[str, Metric],
         device: torch.device,
-        mix: Optional[MixBase] = None, clip_grad_norm=None, accumulation_steps=1, fp16=False):
+        mix: Optional[MixBase] = None, clip_grad_norm=None, accumulation_steps=1,
+        batch_transform: Optional[Callable] = None, precision='fp32', scaler=None,
+        micro_batch_size=None, memory_budget=None):
+    r"""
+    Create the engine of supervised training.
+
+    Args:
+        accumulation_steps (int): Accumulate the gradients of this number of iterations
+            before every optimizer step. The metrics are updated once per update, by the
+            outputs of the last of the iterations.
+        micro_batch_size (int, optional): Split every batch into micro-batches of this size,
+            whose gradients are accumulated, so one iteration still updates once.
+        memory_budget (int, optional): Bytes of activations of a micro-batch. If given without
+            `micro_batch_size`, it is decided by the first batch with `micro_batch_size_for`.
+    """
+
+    if scaler is None:
+        scaler = create_grad_scaler(device, precision)
+    state = {"micro_batch_size": micro_batch_size}
+
+    def forward(x, y_true, lam):
+        with record("forward"), autocast(device, precision):
+            logits = model(x)
+            if mix and mix.lam is not None:
+                loss = mix.loss(criterion, logits, y_true, lam)
+            else:
+                loss = criterion(logits, y_true)
+        return logits, loss
 
     def step(engine, batch):
         model.train()
-        x, y_true = convert_tensor(batch, device)
+        with record("h2d"):
+            x, y_true = convert_tensor(batch, device)
+        if batch_transform:
+            with torch.no_grad():
+                x = batch_transform(x)
 
         if mix:
+            # Mixes in place, so not the tensor of the loader if neither the step nor
+            # the DevicePrefetcher copied it to the device
+            if x is batch[0] and not is_staged(x):
+                x = x.clone()
             x, y_true = mix(x, y_true)
-            logits = model(x)
-            loss = mix.loss(criterion, logits, y_true)
-        else:
-            logits = model(x)
-            loss = criterion(logits, y_true)
 
-        backward(loss, optimizer, fp16)
-        if engine.state.iteration % accumulation_steps == 0:
-            optimizer.step()
+        lam = mix.lam if mix else None
+        batch_size = x.size(0)
+        size = state["micro_batch_size"]
+        if size is None and memory_budget:
+            size = state["micro_batch_size"] = micro_batch_size_for(model, x, memory_budget, precision)
+
+        # Under DDP, all-reduce the gradients only in the last backward before the update
+        update = engine.state.iteration % accumulation_steps == 0
+        if size is None or size >= batch_size:
+            with no_sync(model, update):
+                logits, loss = forward(x, y_true, lam)
+                backward(loss / accumulation_steps, scaler)
+            loss = loss.detach()
+        else:
+            # Weight the mean loss of every micro-batch by its share of the batch
+            xs = x.split(size)
+            lams = lam.split(size) if lam is not None and lam.dim() != 0 else [lam] * len(xs)
+            logits, loss = [], 0
+            for i, (x_m, y_m, lam_m) in enumerate(zip(xs, split_batch(y_true, size), lams)):
+                with no_sync(model, update and i == len(xs) - 1):
+                    logits_m, loss_m = forward(x_m, y_m, lam_m)
+                    weight = x_m.size(0) / batch_size
+                    backward(loss_m * (weight / accumulation_steps), scaler)
+                logits.append(logits_m.detach())
+                loss = loss + loss_m.detach() * weight
+            logits = torch.cat(logits)
+
+        if update:
+            if clip_grad_norm:
+                unscale(optimizer, scaler)
+                clip_grad_norm_(model.parameters(), clip_grad_norm)
+            optimizer_step(optimizer, scaler)
+            if scaler is not None:
+                scaler.update()
             optimizer.zero_grad()
-        if clip_grad_norm:
-            clip_grad_norm_(model.parameters(), clip_grad_norm)
         outs = {
-            "loss": loss.item(),
-            "batch_size": x.size(0),
+            "loss": loss,
+            "batch_size": batch_size,
             "y_true": y_true,
-            "y_pred": logits.detach(),
+            "y_pred": logits.detach().float(),
             "lr": optimizer.param_groups[0]['lr'],
         }
         return outs
 
     engine = Engine(step)
-    for name, metric in metrics.items():
-        metric.attach(engine, name)
+    if accumulation_steps > 1:
+        # Once per logical batch, with the outputs of its last iteration
+        usage = MetricUsage(Events.EPOCH_STARTED, Events.EPOCH_COMPLETED,
+                            Events.ITERATION_COMPLETED(every=accumulation_steps))
+        for name, metric in metrics.items():
+            metric.attach(engine, name, usage)
+    else:
+        for name, metric in metrics.items():
+            metric.attach(engine, name)
 
     return engine
 
 
-def create_supervised_evaluator(model, metrics, device):
+def create_supervised_evaluator(model, metrics, device, batch_transform=None, precision='fp32'):
     def step(engine, batch):
         model.eval()
-        x, y_true = convert_tensor(batch, device)
+        with record("h2d"):
+            x, y_true = convert_tensor(batch, device)
         with torch.no_grad():
-            logits = model(x)
+            if batch_transform:
+                x = batch_transform(x)
+            with record("forward"), autocast(device, precision):
+                logits = model(x)
         output = {
-            "y_pred": logits,
+            "y_pred": logits.float(),
             "y_true": y_true,
-            'batch_size': x[0].size(0),
+            'batch_size': x.size(0),
         }
         return output
 
@@ -85,14 +160,22 @@ class Trainer(TrainerBase):
     def _attach_prograss_bar(self, train_engine: Engine):
         pb = ProgressBar()
         # pb.attach(train_engine, output_transform=lambda x: print(x))
-        pb.attach(train_engine, output_transform=pick(['lr', 'loss']))
+        # Read the loss from the device only every `log_freq` iterations
+        pb.attach(train_engine, output_transform=pick(['lr', 'loss']),
+                  event_name=Events.ITERATION_COMPLETED(every=self._kwargs.get('log_freq', 10)))
 
     def _create_train_engine(self):
         engine = create_supervised_trainer(
             self.model, self.criterion, self.optimizers[0], self.metrics, self.device,
-            self._kwargs.get('mix'), fp16=self.fp16)
+            self._kwargs.get('mix'), clip_grad_norm=self._kwargs.get('clip_grad_norm'),
+            accumulation_steps=self._kwargs.get('accumulation_steps', 1),
+            batch_transform=self._kwargs.get('batch_transform'),
+            precision=self.precision, scaler=self.scaler,
+            micro_batch_size=self._kwargs.get('micro_batch_size'),
+            memory_budget=self._kwargs.get('memory_budget'))
         return engine
 
     def _create_eval_engine(self):
-        engine = create_supervised_evaluator(self.model, self.test_metrics, self.device)
+        engine = create_supervised_evaluator(
+            self.model, self.test_metrics, self.device, self._kwargs.get('test_batch_transform'), self.precision)
         return engine
@@ -0,0 +1,262 @@
+r"""
+Distributed data parallel training.
+
+Launch a training script on N local processes (and optionally several nodes) with
+
+    python -m horch.train.distributed -n 4 tools/train_cifar10.py -c config.yaml
+
+which sets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT for every process.
+The script calls `init_distributed`, after which TrainerBase wraps the model in
+DistributedDataParallel, shards the loaders, all-reduces the metrics and only writes
+logs and checkpoints on rank 0. Use `launch` to spawn a function instead of a script.
+"""
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import ignite.distributed as idist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from horch.common import CUDA
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    r"""
+    Initialize the default process group from the environment variables set by the
+    launcher, with "nccl" if CUDA is available and "gloo" otherwise.
+    Do nothing if not launched or already initialized.
+
+    Returns:
+        Whether the process is in distributed mode.
+    """
+    if is_distributed():
+        return True
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if backend is None:
+        backend = 'nccl' if CUDA else 'gloo'
+    if CUDA:
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend, init_method="env://")
+    # Ignite creates its context lazily with collectives, which would hang if only rank 0 does it
+    idist.sync()
+    return True
+
+
+def get_device():
+    r"""
+    Device of the current process: the GPU of the local rank if CUDA is available.
+    """
+    if CUDA:
+        return torch.device('cuda', get_local_rank())
+    return torch.device('cpu')
+
+
+def wrap_model(model, device):
+    if not is_distributed():
+        return model
+    device_ids = [device] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def no_sync(model, sync=False):
+    r"""
+    Context in which the backward passes of `model` accumulate gradients locally without
+    all-reducing them, unless `sync`. Does nothing if `model` isn't DistributedDataParallel.
+    """
+    if isinstance(model, DistributedDataParallel) and not sync:
+        return model.no_sync()
+    return contextlib.ExitStack()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce(value):
+    r"""
+    Sum `value` (a number, numpy array or tensor) over all processes, returning the
+    same type. Tensors are reduced on a device the backend supports.
+    """
+    if not is_distributed():
+        return value
+    device = get_device() if dist.get_backend() == 'nccl' else torch.device('cpu')
+    if torch.is_tensor(value):
+        t = value.detach().to(device, torch.float64 if value.is_floating_point() else torch.int64)
+        dist.all_reduce(t)
+        return t.to(value.device, value.dtype)
+    if isinstance(value, np.ndarray):
+        t = torch.from_numpy(value).to(device)
+        dist.all_reduce(t)
+        return t.cpu().numpy()
+    t = torch.tensor(value, dtype=torch.float64 if isinstance(value, float) else torch.int64, device=device)
+    dist.all_reduce(t)
+    return type(value)(t.item())
+
+
+def _sharded(sampler, shuffle):
+    dataset = sampler.data_source if hasattr(sampler, 'data_source') else None
+    if dataset is None:
+        raise TypeError("Can't shard sampler %s without `data_source`" % type(sampler))
+    return DistributedSampler(dataset, shuffle=shuffle)
+
+
+def distribute_loader(loader: DataLoader, shuffle=None):
+    r"""
+    Shard `loader` over the processes with DistributedSampler, replacing its sampler, or
+    the sampler inside its batch sampler (e.g. IterSampler or ProgressiveBatchSampler).
+    Return `loader` as it is if not in distributed mode or already sharded.
+
+    Args:
+        loader (DataLoader): The DataLoader.
+        shuffle (bool, optional): Whether to shuffle. Default to whether the sampler is random.
+    """
+    if not is_distributed() or isinstance(find_sampler(loader), DistributedSampler):
+        return loader
+
+    batch_sampler = loader.batch_sampler
+    if type(batch_sampler) is BatchSampler:
+        sampler = _sharded(loader.sampler, isinstance(loader.sampler, RandomSampler) if shuffle is None else shuffle)
+        return DataLoader(
+            loader.dataset, batch_size=loader.batch_size, sampler=sampler, num_workers=loader.num_workers,
+            collate_fn=loader.collate_fn, pin_memory=loader.pin_memory, drop_last=loader.drop_last,
+            timeout=loader.timeout, worker_init_fn=loader.worker_init_fn, **_loader_kwargs(loader))
+
+    # Custom batch samplers are kept and their samplers sharded in place
+    owner = batch_sampler
+    while hasattr(owner, 'batch_sampler'):
+        owner = owner.batch_sampler
+    owner.sampler = _sharded(owner.sampler, isinstance(owner.sampler, RandomSampler) if shuffle is None else shuffle)
+    return DataLoader(
+        loader.dataset, batch_sampler=batch_sampler, num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn, pin_memory=loader.pin_memory, timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn, **_loader_kwargs(loader))
+
+
+def _loader_kwargs(loader):
+    # Other arguments of `loader` to keep, of which prefetch_factor is only valid with workers
+    kwargs = dict(persistent_workers=loader.persistent_workers, generator=loader.generator,
+                  multiprocessing_context=loader.multiprocessing_context)
+    if loader.num_workers > 0:
+        kwargs['prefetch_factor'] = loader.prefetch_factor
+    return kwargs
+
+
+def find_sampler(loader):
+    r"""
+    The innermost sampler of `loader`, which draws the indices.
+    """
+    owner = loader.batch_sampler
+    if owner is None:
+        return loader.sampler
+    while hasattr(owner, 'batch_sampler'):
+        owner = owner.batch_sampler
+    return getattr(owner, 'sampler', loader.sampler)
+
+
+def set_epoch(loader, epoch):
+    r"""
+    Set the epoch of the DistributedSampler of `loader` to shuffle differently every epoch.
+    """
+    sampler = find_sampler(loader)
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+def _worker(local_rank, fn, args, nprocs, node_rank, nnodes, master_addr, master_port, backend):
+    os.environ.update({
+        "RANK": str(node_rank * nprocs + local_rank),
+        "LOCAL_RANK": str(local_rank),
+        "WORLD_SIZE": str(nnodes * nprocs),
+        "MASTER_ADDR": master_addr,
+        "MASTER_PORT": str(master_port),
+    })
+    init_distributed(backend)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, nprocs, args=(), node_rank=0, nnodes=1, master_addr="127.0.0.1", master_port=29500, backend=None):
+    r"""
+    Spawn `nprocs` processes on this node calling `fn(*args)` in distributed mode.
+
+    Args:
+        fn (callable): Function to call, which must be picklable.
+        nprocs (int): Number of processes on this node, usually the number of GPUs.
+        args (tuple): Arguments of `fn`.
+        node_rank (int): Rank of this node.
+        nnodes (int): Number of nodes.
+        master_addr (str): Address of the node of rank 0.
+        master_port (int): Free port of the node of rank 0.
+        backend (str, optional): "gloo" or "nccl". Default to "nccl" if CUDA is available.
+    """
+    mp.spawn(_worker, args=(fn, args, nprocs, node_rank, nnodes, master_addr, master_port, backend),
+             nprocs=nprocs, join=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch a training script on multiple processes.')
+    parser.add_argument('-n', '--nproc', type=int, default=max(torch.cuda.device_count(), 1),
+                        help='number of processes on this node')
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node-rank', type=int, default=0)
+    parser.add_argument('--master-addr', default="127.0.0.1")
+    parser.add_argument('--master-port', type=int, default=29500)
+    parser.add_argument('script', help='training script')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    processes = []
+    for local_rank in range(args.nproc):
+        env = {
+            **os.environ,
+            "RANK": str(args.node_rank * args.nproc + local_rank),
+            "LOCAL_RANK": str(local_rank),
+            "WORLD_SIZE": str(args.nnodes * args.nproc),
+            "MASTER_ADDR": args.master_addr,
+            "MASTER_PORT": str(args.master_port),
+        }
+        processes.append(subprocess.Popen([sys.executable, args.script] + args.script_args, env=env))
+    code = 0
+    for p in processes:
+        code = p.wait() or code
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
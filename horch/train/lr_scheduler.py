@@ -1,7 +1,9 @@
+import copy
 import math
 
 import warnings
 
+import numpy as np
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
 
@@ -701,4 +703,121 @@ class CosineAnnealingLR(_LRScheduler):
     # def _get_closed_form_lr(self):
     #     return [self.eta_min + (base_lr - self.eta_min) *
     #             (1 + math.cos(math.pi * self.last_epoch / self.T_max)) / 2
-    #             for base_lr in self.base_lrs]
\ No newline at end of file
+    #             for base_lr in self.base_lrs]
+
+HYPERPARAMS = ['lr', 'momentum', 'betas', 'weight_decay']
+
+
+def _get_hyperparam(group, key):
+    return group['betas'][0] if key == 'betas' else group[key]
+
+
+def _set_hyperparam(group, key, value):
+    if key == 'betas':
+        betas = group['betas']
+        group['betas'] = betas.__class__([value, *betas[1:]])
+    else:
+        group[key] = value
+
+
+class CompiledLR:
+    r"""
+    Table of the learning rates (and other hyperparameters changed, e.g. momentum) of every
+    parameter group produced by `lr_scheduler` at every step of the run, so that stepping is a
+    lookup of a row instead of evaluating the schedule for every group in Python.
+
+    The table is built by replaying `lr_scheduler` on a copy of the optimizer without parameters,
+    with the arguments `step` receives in training: `i / steps_per_epoch` (fractional epochs) for
+    step i, or i if `steps_per_epoch` is None. Arguments off the table (e.g. epochs of variable
+    lengths or beyond `num_steps`) fall back to `lr_scheduler` itself.
+
+    The state dict is that of `lr_scheduler` with the step, so checkpoints can be loaded by
+    either of them.
+
+    Args:
+        lr_scheduler (_LRScheduler): The scheduler, stepped with explicit arguments.
+        num_steps (int): Number of steps of the run.
+        steps_per_epoch (int, optional): Steps per epoch if stepped with fractional epochs.
+    """
+
+    def __init__(self, lr_scheduler, num_steps, steps_per_epoch=None):
+        self.lr_scheduler = lr_scheduler
+        self.optimizer = lr_scheduler.optimizer
+        self.num_steps = num_steps
+        self.steps_per_epoch = steps_per_epoch
+        self.tables = self._compile()
+        self.last_epoch = lr_scheduler.last_epoch
+        self._last_lr = [g['lr'] for g in self.optimizer.param_groups]
+
+    def _detached(self):
+        # Copy of the scheduler stepping a copy of the optimizer without parameters
+        optimizer = copy.copy(self.optimizer)
+        optimizer.param_groups = [{**{k: v for k, v in g.items() if k != 'params'}, 'params': []}
+                                  for g in self.optimizer.param_groups]
+        scheduler = copy.copy(self.lr_scheduler)
+        scheduler.optimizer = optimizer
+        return scheduler
+
+    def _compile(self):
+        scheduler = self._detached()
+        optimizer = scheduler.optimizer
+        keys = [k for k in HYPERPARAMS if all(k in g for g in optimizer.param_groups)]
+
+        tables = {k: np.empty((self.num_steps + 1, len(optimizer.param_groups))) for k in keys}
+        with warnings.catch_warnings():
+            # Stepping by epochs is deprecated by PyTorch, but is how the schedulers are used
+            warnings.simplefilter("ignore")
+            for i in range(self.num_steps + 1):
+                if i > 0:
+                    scheduler.step(self._argument(i))
+                for k in keys:
+                    tables[k][i] = [_get_hyperparam(g, k) for g in optimizer.param_groups]
+        return {k: t for k, t in tables.items() if k == 'lr' or (t != t[:1]).any()}
+
+    def _argument(self, i):
+        return i if self.steps_per_epoch is None else i / self.steps_per_epoch
+
+    def _index(self, epoch):
+        i = epoch if self.steps_per_epoch is None else round(epoch * self.steps_per_epoch)
+        if i == int(i) and 0 < i <= self.num_steps and self._argument(int(i)) == epoch:
+            return int(i)
+        return None
+
+    def step(self, epoch):
+        i = self._index(epoch)
+        if i is None:
+            self.lr_scheduler.step(epoch)
+        else:
+            for k, table in self.tables.items():
+                for group, value in zip(self.optimizer.param_groups, table[i].tolist()):
+                    _set_hyperparam(group, k, value)
+        self.last_epoch = epoch
+        self._last_lr = [g['lr'] for g in self.optimizer.param_groups]
+
+    def get_last_lr(self):
+        return self._last_lr
+
+    def state_dict(self):
+        # The state of `lr_scheduler` as if it had been stepped, e.g. T_cur of warm restarts
+        scheduler = self._detached()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            scheduler.step(self.last_epoch)
+        d = scheduler.state_dict()
+        d['last_epoch'] = self.last_epoch
+        d['_last_lr'] = self._last_lr
+        return d
+
+    def load_state_dict(self, state_dict):
+        self.lr_scheduler.load_state_dict(state_dict)
+        self.last_epoch = state_dict['last_epoch']
+        self._last_lr = [g['lr'] for g in self.optimizer.param_groups]
+
+
+def compile_schedule(lr_scheduler, num_steps, steps_per_epoch=None):
+    r"""
+    CompiledLR of `lr_scheduler`, recompiled for `num_steps` if it is compiled already.
+    """
+    if isinstance(lr_scheduler, CompiledLR):
+        lr_scheduler = lr_scheduler.lr_scheduler
+    return CompiledLR(lr_scheduler, num_steps, steps_per_epoch)
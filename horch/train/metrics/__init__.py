@@ -5,8 +5,17 @@ import torch
 from ignite.exceptions import NotComputableError
 from ignite.metrics.metric import Metric
 
+from horch.train.distributed import all_reduce
+
 
 class Average(Metric):
+    r"""
+    Average of values weighted by the numbers of examples, given by `output_transform` as (value, n).
+
+    Values may be tensors on the device, which are summed on the device without
+    syncing with the host until `compute` is called. In distributed mode, `compute`
+    averages over all processes.
+    """
 
     def __init__(self, output_transform):
         super().__init__(output_transform)
@@ -19,14 +28,18 @@ class Average(Metric):
 
     def update(self, output):
         val, n = output
-        self._sum += val * n
+        if torch.is_tensor(val):
+            val = val.detach()
+        self._sum = self._sum + val * n
         self._num_examples += n
 
     def compute(self):
-        if self._num_examples == 0:
+        num_examples = all_reduce(self._num_examples)
+        if num_examples == 0:
             raise NotComputableError(
                 'Metric must have at least one example before it can be computed')
-        return self._sum / self._num_examples
+        avg = all_reduce(self._sum) / num_examples
+        return avg.item() if torch.is_tensor(avg) else avg
 
 
 class TrainLoss(Average):
@@ -54,5 +67,5 @@ class Loss(Average):
 
     def output_transform(self, output):
         y_pred, y_true, batch_size = get(["y_pred", "y_true", "batch_size"], output)
-        loss = self.criterion(y_pred, y_true).item()
+        loss = self.criterion(y_pred, y_true).detach()
         return loss, batch_size
\ No newline at end of file
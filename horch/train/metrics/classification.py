@@ -2,7 +2,6 @@ from typing import Optional
 
 from toolz.curried import get
 
-import numpy as np
 from sklearn.metrics import roc_auc_score
 
 import torch
@@ -10,34 +9,34 @@ from torch.nn import functional as F
 
 from ignite.metrics import Metric
 
-from horch.train.classification.mix import MixBase, Mixup, CutMix
+from horch.train.classification.mix import MixBase
 from horch.train.metrics import Average
 
 
 def topk_accuracy(y_true, y_pred, k=5):
-    num_examples = np.prod(y_true.size())
+    # The accuracy is a tensor on the device of y_pred to avoid syncing
+    num_examples = y_true.numel()
     topk_pred = torch.topk(y_pred, k=k, dim=1)[1]
-    num_corrects = torch.sum(topk_pred == y_true.unsqueeze(1)).item()
+    num_corrects = torch.sum(topk_pred == y_true.unsqueeze(1))
     accuracy = num_corrects / num_examples
     return accuracy, num_examples
 
 
 class TopKAccuracy(Average):
-    _required_output_keys = ["y_pred", "y_true"]
 
     def __init__(self, k=5):
         self.k = k
         super().__init__(output_transform=self.output_transform)
 
     def output_transform(self, output):
-        y_pred, y_true = output
+        y_pred, y_true = get(["y_pred", "y_true"], output)
         return topk_accuracy(y_true, y_pred, k=self.k)
 
 
 def accuracy(y_true, y_pred):
-    num_examples = np.prod(y_true.size())
+    num_examples = y_true.numel()
     pred = torch.argmax(y_pred, dim=1)
-    num_corrects = torch.sum(pred == y_true).item()
+    num_corrects = torch.sum(pred == y_true)
     acc = num_corrects / num_examples
     return acc, num_examples
 
@@ -49,19 +48,18 @@ class Accuracy(Average):
         super().__init__(output_transform=self.output_transform)
 
     def output_transform(self, output):
-        if self.mix:
-            if isinstance(self.mix, Mixup) or (isinstance(self.mix, CutMix) and self.mix.lam):
-                y_pred, y_true, batch_size = get(["y_pred", "y_true", "batch_size"], output)
-                y_a, y_b = y_true
-                y_pred = torch.topk(y_pred, k=2, dim=1)[1]
-                y_a_p = y_pred[:, 0]
-                y_b_p = y_pred[:, 1]
-                if self.mix.lam < 0.5:
-                    y_a_p, y_b_p = y_b_p, y_a_p
-                num_corrects = (self.mix.lam * y_a_p.eq(y_a).sum().cpu().float()
-                                + (1 - self.mix.lam) * y_b_p.eq(y_b).sum().cpu().float())
-                acc = num_corrects / batch_size
-                return acc, batch_size
+        if self.mix and self.mix.lam is not None:
+            y_pred, y_true, batch_size = get(["y_pred", "y_true", "batch_size"], output)
+            y_a, y_b = y_true
+            y_pred = torch.topk(y_pred, k=2, dim=1)[1]
+            # The mixing weights are per sample or one for the batch
+            lam = self.mix.lam.expand(batch_size)
+            swap = lam < 0.5
+            y_a_p = torch.where(swap, y_pred[:, 1], y_pred[:, 0])
+            y_b_p = torch.where(swap, y_pred[:, 0], y_pred[:, 1])
+            num_corrects = (lam * y_a_p.eq(y_a) + (1 - lam) * y_b_p.eq(y_b)).sum()
+            acc = num_corrects / batch_size
+            return acc, batch_size
         y_pred, y_true = get(["y_pred", "y_true"], output)
         return accuracy(y_true, y_pred)
 
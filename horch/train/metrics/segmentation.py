@@ -6,6 +6,7 @@ import numpy as np
 import torch
 from ignite.metrics import Metric
 
+from horch.train.distributed import all_reduce
 from horch.train.metrics import Average
 
 
@@ -17,12 +18,19 @@ class MeanIoU(Metric):
         super().__init__(self.output_transform)
 
     def reset(self):
-        self.total_cm = np.zeros(self.num_classes, self.num_classes)
+        self.total_cm = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
 
     def update(self, output):
         cm = output
         self.total_cm += cm
 
+    def compute(self):
+        cm = all_reduce(self.total_cm)
+        tp = np.diag(cm)
+        union = cm.sum(axis=0) + cm.sum(axis=1) - tp
+        valid = union > 0
+        return float(np.mean(tp[valid] / union[valid]))
+
     def output_transform(self, output):
         y_true, y_pred = get(["y_true", "y_pred"], output)
         c = self.num_classes
@@ -64,15 +72,10 @@ class PixelAccuracy(Average):
 
         y_pred = y_pred.argmax(dim=1)
 
-        accs = []
-        for i in range(batch_size):
-            y = y_true[i]
-            p = y_pred[i]
-            tp = (y == p).sum()
-            if self.ignore_index is not None:
-                tp += (y == self.ignore_index).sum()
-            accs.append(tp.cpu().item() / np.prod(y.shape))
-        acc = np.mean(accs)
+        correct = y_true == y_pred
+        if self.ignore_index is not None:
+            correct |= y_true == self.ignore_index
+        acc = correct.reshape(batch_size, -1).float().mean(dim=1).mean()
         return acc, batch_size
 
 
@@ -99,8 +102,9 @@ class F1Score(Metric):
         self.fn += fn
 
     def compute(self):
-        p = self.tp / (self.tp + self.fp + self.eps)
-        r = self.tp / (self.tp + self.fn + self.eps)
+        tp, fp, fn = all_reduce(self.tp), all_reduce(self.fp), all_reduce(self.fn)
+        p = tp / (tp + fp + self.eps)
+        r = tp / (tp + fn + self.eps)
 
         f1 = 2 * p * r / (p + r + self.eps)
         return f1
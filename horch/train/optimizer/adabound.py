@@ -2,6 +2,9 @@ import math
 import torch
 from torch.optim import Optimizer
 
+from horch.train.optimizer.utils import params_with_grad, full_like, STATE_DTYPES, init_state, load_state, \
+    store_state, restore_state_dtypes, rounding_generator, generator_states, foreach_chunks
+
 
 class AdaBound(Optimizer):
     """
@@ -32,10 +35,20 @@ class AdaBound(Optimizer):
         Default: 0
     amsbound : boolean, optional
         whether to use the AMSBound variant of this algorithm
+    foreach : boolean, optional
+        whether to update the parameters of every group together by multi-tensor ops
+        with the same results
+        Default: False
+    state_dtype : str, optional
+        dtype of the moments, 'bfloat16', or 'int8' for blockwise 8-bit quantization with
+        a float32 scale per block of 256 elements, dequantized to float32 in the update and
+        rounded stochastically back. Tensors of less than 4096 elements keep float32 moments
+        with 'int8'.
+        Default: None, the dtype of the parameters
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), final_lr=0.1, gamma=1e-3,
-                 eps=1e-8, weight_decay=0, amsbound=False):
+                 eps=1e-8, weight_decay=0, amsbound=False, foreach=False, state_dtype=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -48,8 +61,10 @@ class AdaBound(Optimizer):
             raise ValueError("Invalid final learning rate: {}".format(final_lr))
         if not 0.0 <= gamma < 1.0:
             raise ValueError("Invalid gamma parameter: {}".format(gamma))
-        defaults = dict(lr=lr, betas=betas, final_lr=final_lr, gamma=gamma, eps=eps,
-                        weight_decay=weight_decay, amsbound=amsbound)
+        if state_dtype not in STATE_DTYPES:
+            raise ValueError("Invalid state dtype: {}".format(state_dtype))
+        defaults = dict(lr=lr, betas=betas, final_lr=final_lr, gamma=gamma, eps=eps, weight_decay=weight_decay,
+                        amsbound=amsbound, foreach=foreach, state_dtype=state_dtype)
         super(AdaBound, self).__init__(params, defaults)
 
         self.base_lrs = list(map(lambda group: group['lr'], self.param_groups))
@@ -58,6 +73,15 @@ class AdaBound(Optimizer):
         super(AdaBound, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsbound', False)
+            group.setdefault('foreach', False)
+            group.setdefault('state_dtype', None)
+
+    def load_state_dict(self, state_dict):
+        super(AdaBound, self).load_state_dict(state_dict)
+        restore_state_dtypes(self, state_dict)
+
+    def state_dict(self):
+        return dict(super(AdaBound, self).state_dict(), **generator_states(self))
 
     def step(self, closure=None):
         """
@@ -73,6 +97,9 @@ class AdaBound(Optimizer):
             loss = closure()
 
         for group, base_lr in zip(self.param_groups, self.base_lrs):
+            if group['foreach']:
+                self._step_foreach(group, base_lr)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -88,16 +115,17 @@ class AdaBound(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg', p.data, group['state_dtype'])
                     # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg_sq', p.data, group['state_dtype'], signed=False)
                     if amsbound:
                         # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+                        init_state(state, 'max_exp_avg_sq', p.data, group['state_dtype'], signed=False)
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg = load_state(state, 'exp_avg', p.data)
+                exp_avg_sq = load_state(state, 'exp_avg_sq', p.data, signed=False)
                 if amsbound:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
+                    max_exp_avg_sq = load_state(state, 'max_exp_avg_sq', p.data, signed=False)
                 beta1, beta2 = group['betas']
 
                 state['step'] += 1
@@ -115,6 +143,11 @@ class AdaBound(Optimizer):
                     denom = max_exp_avg_sq.sqrt().add_(group['eps'])
                 else:
                     denom = exp_avg_sq.sqrt().add_(group['eps'])
+                generator = rounding_generator(self, p.device) if group['state_dtype'] else None
+                store_state(state, 'exp_avg', exp_avg, generator=generator)
+                store_state(state, 'exp_avg_sq', exp_avg_sq, signed=False, generator=generator)
+                if amsbound:
+                    store_state(state, 'max_exp_avg_sq', max_exp_avg_sq, signed=False, generator=generator)
 
                 bias_correction1 = 1 - beta1 ** state['step']
                 bias_correction2 = 1 - beta2 ** state['step']
@@ -132,6 +165,63 @@ class AdaBound(Optimizer):
 
         return loss
 
+    def _step_foreach(self, group, base_lr):
+        params, grads, states = params_with_grad(group, self.state)
+        for chunk in foreach_chunks(params, grads, states, group['state_dtype']):
+            self._update_foreach(group, *chunk, base_lr)
+
+    def _update_foreach(self, group, params, grads, states, base_lr):
+        amsbound = group['amsbound']
+        beta1, beta2 = group['betas']
+
+        for p, state in zip(params, states):
+            if len(state) == 0:
+                state['step'] = 0
+                init_state(state, 'exp_avg', p, group['state_dtype'])
+                init_state(state, 'exp_avg_sq', p, group['state_dtype'], signed=False)
+                if amsbound:
+                    init_state(state, 'max_exp_avg_sq', p, group['state_dtype'], signed=False)
+            state['step'] += 1
+        exp_avgs = [load_state(state, 'exp_avg', p) for p, state in zip(params, states)]
+        exp_avg_sqs = [load_state(state, 'exp_avg_sq', p, signed=False) for p, state in zip(params, states)]
+
+        if group['weight_decay'] != 0:
+            grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        if amsbound:
+            max_exp_avg_sqs = [load_state(state, 'max_exp_avg_sq', p, signed=False)
+                               for p, state in zip(params, states)]
+            torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+            denom = torch._foreach_sqrt(max_exp_avg_sqs)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denom, group['eps'])
+        for i, state in enumerate(states):
+            generator = rounding_generator(self, params[i].device) if group['state_dtype'] else None
+            store_state(state, 'exp_avg', exp_avgs[i], generator=generator)
+            store_state(state, 'exp_avg_sq', exp_avg_sqs[i], signed=False, generator=generator)
+            if amsbound:
+                store_state(state, 'max_exp_avg_sq', max_exp_avg_sqs[i], signed=False, generator=generator)
+
+        # Applies bounds on actual learning rate
+        final_lr = group['final_lr'] * group['lr'] / base_lr
+        step_sizes, lower_bounds, upper_bounds = [], [], []
+        for state in states:
+            step = state['step']
+            step_sizes.append(group['lr'] * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step))
+            lower_bounds.append(final_lr * (1 - 1 / (group['gamma'] * step + 1)))
+            upper_bounds.append(final_lr * (1 + 1 / (group['gamma'] * step)))
+        step_size = full_like(denom, step_sizes)
+        torch._foreach_div_(step_size, denom)
+        torch._foreach_clamp_min_(step_size, lower_bounds)
+        torch._foreach_clamp_max_(step_size, upper_bounds)
+        torch._foreach_mul_(step_size, exp_avgs)
+        torch._foreach_sub_(params, step_size)
+
 
 class AdaBoundW(Optimizer):
     """
@@ -159,10 +249,20 @@ class AdaBoundW(Optimizer):
         Default: 0
     amsbound : boolean, optional
         whether to use the AMSBound variant of this algorithm
+    foreach : boolean, optional
+        whether to update the parameters of every group together by multi-tensor ops
+        with the same results
+        Default: False
+    state_dtype : str, optional
+        dtype of the moments, 'bfloat16', or 'int8' for blockwise 8-bit quantization with
+        a float32 scale per block of 256 elements, dequantized to float32 in the update and
+        rounded stochastically back. Tensors of less than 4096 elements keep float32 moments
+        with 'int8'.
+        Default: None, the dtype of the parameters
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), final_lr=0.1, gamma=1e-3,
-                 eps=1e-8, weight_decay=0, amsbound=False):
+                 eps=1e-8, weight_decay=0, amsbound=False, foreach=False, state_dtype=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -175,8 +275,10 @@ class AdaBoundW(Optimizer):
             raise ValueError("Invalid final learning rate: {}".format(final_lr))
         if not 0.0 <= gamma < 1.0:
             raise ValueError("Invalid gamma parameter: {}".format(gamma))
-        defaults = dict(lr=lr, betas=betas, final_lr=final_lr, gamma=gamma, eps=eps,
-                        weight_decay=weight_decay, amsbound=amsbound)
+        if state_dtype not in STATE_DTYPES:
+            raise ValueError("Invalid state dtype: {}".format(state_dtype))
+        defaults = dict(lr=lr, betas=betas, final_lr=final_lr, gamma=gamma, eps=eps, weight_decay=weight_decay,
+                        amsbound=amsbound, foreach=foreach, state_dtype=state_dtype)
         super(AdaBoundW, self).__init__(params, defaults)
 
         self.base_lrs = list(map(lambda group: group['lr'], self.param_groups))
@@ -185,6 +287,15 @@ class AdaBoundW(Optimizer):
         super(AdaBoundW, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsbound', False)
+            group.setdefault('foreach', False)
+            group.setdefault('state_dtype', None)
+
+    def load_state_dict(self, state_dict):
+        super(AdaBoundW, self).load_state_dict(state_dict)
+        restore_state_dtypes(self, state_dict)
+
+    def state_dict(self):
+        return dict(super(AdaBoundW, self).state_dict(), **generator_states(self))
 
     def step(self, closure=None):
         """
@@ -200,6 +311,9 @@ class AdaBoundW(Optimizer):
             loss = closure()
 
         for group, base_lr in zip(self.param_groups, self.base_lrs):
+            if group['foreach']:
+                self._step_foreach(group, base_lr)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -215,16 +329,17 @@ class AdaBoundW(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg', p.data, group['state_dtype'])
                     # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg_sq', p.data, group['state_dtype'], signed=False)
                     if amsbound:
                         # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+                        init_state(state, 'max_exp_avg_sq', p.data, group['state_dtype'], signed=False)
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg = load_state(state, 'exp_avg', p.data)
+                exp_avg_sq = load_state(state, 'exp_avg_sq', p.data, signed=False)
                 if amsbound:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
+                    max_exp_avg_sq = load_state(state, 'max_exp_avg_sq', p.data, signed=False)
                 beta1, beta2 = group['betas']
 
                 state['step'] += 1
@@ -239,6 +354,11 @@ class AdaBoundW(Optimizer):
                     denom = max_exp_avg_sq.sqrt().add_(group['eps'])
                 else:
                     denom = exp_avg_sq.sqrt().add_(group['eps'])
+                generator = rounding_generator(self, p.device) if group['state_dtype'] else None
+                store_state(state, 'exp_avg', exp_avg, generator=generator)
+                store_state(state, 'exp_avg_sq', exp_avg_sq, signed=False, generator=generator)
+                if amsbound:
+                    store_state(state, 'max_exp_avg_sq', max_exp_avg_sq, signed=False, generator=generator)
 
                 bias_correction1 = 1 - beta1 ** state['step']
                 bias_correction2 = 1 - beta2 ** state['step']
@@ -257,4 +377,62 @@ class AdaBoundW(Optimizer):
                     p.data.sub_(weight_decay, p.data)
                 p.data.add_(-step_size)
 
-        return loss
\ No newline at end of file
+        return loss
+
+    def _step_foreach(self, group, base_lr):
+        params, grads, states = params_with_grad(group, self.state)
+        for chunk in foreach_chunks(params, grads, states, group['state_dtype']):
+            self._update_foreach(group, *chunk, base_lr)
+
+    def _update_foreach(self, group, params, grads, states, base_lr):
+        amsbound = group['amsbound']
+        beta1, beta2 = group['betas']
+
+        for p, state in zip(params, states):
+            if len(state) == 0:
+                state['step'] = 0
+                init_state(state, 'exp_avg', p, group['state_dtype'])
+                init_state(state, 'exp_avg_sq', p, group['state_dtype'], signed=False)
+                if amsbound:
+                    init_state(state, 'max_exp_avg_sq', p, group['state_dtype'], signed=False)
+            state['step'] += 1
+        exp_avgs = [load_state(state, 'exp_avg', p) for p, state in zip(params, states)]
+        exp_avg_sqs = [load_state(state, 'exp_avg_sq', p, signed=False) for p, state in zip(params, states)]
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        if amsbound:
+            max_exp_avg_sqs = [load_state(state, 'max_exp_avg_sq', p, signed=False)
+                               for p, state in zip(params, states)]
+            torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+            denom = torch._foreach_sqrt(max_exp_avg_sqs)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denom, group['eps'])
+        for i, state in enumerate(states):
+            generator = rounding_generator(self, params[i].device) if group['state_dtype'] else None
+            store_state(state, 'exp_avg', exp_avgs[i], generator=generator)
+            store_state(state, 'exp_avg_sq', exp_avg_sqs[i], signed=False, generator=generator)
+            if amsbound:
+                store_state(state, 'max_exp_avg_sq', max_exp_avg_sqs[i], signed=False, generator=generator)
+
+        # Applies bounds on actual learning rate
+        final_lr = group['final_lr'] * group['lr'] / base_lr
+        step_sizes, lower_bounds, upper_bounds = [], [], []
+        for state in states:
+            step = state['step']
+            step_sizes.append(group['lr'] * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step))
+            lower_bounds.append(final_lr * (1 - 1 / (group['gamma'] * step + 1)))
+            upper_bounds.append(final_lr * (1 + 1 / (group['gamma'] * step)))
+        step_size = full_like(denom, step_sizes)
+        torch._foreach_div_(step_size, denom)
+        torch._foreach_clamp_min_(step_size, lower_bounds)
+        torch._foreach_clamp_max_(step_size, upper_bounds)
+        torch._foreach_mul_(step_size, exp_avgs)
+
+        if group['weight_decay'] != 0:
+            weight_decay = group['lr'] / group['initial_lr'] * group['weight_decay']
+            torch._foreach_sub_(params, params, alpha=weight_decay)
+        torch._foreach_sub_(params, step_size)
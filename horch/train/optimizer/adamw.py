@@ -2,6 +2,9 @@ import math
 import torch
 from torch.optim.optimizer import Optimizer
 
+from horch.train.optimizer.utils import params_with_grad, full_like, STATE_DTYPES, init_state, load_state, \
+    store_state, restore_state_dtypes, rounding_generator, generator_states, foreach_chunks
+
 
 class AdamW(Optimizer):
     r"""Implements Adam algorithm with Decoupled Weight Decay (arxiv.org/abs/1711.05101).
@@ -20,6 +23,13 @@ class AdamW(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        foreach (boolean, optional): whether to update the parameters of every group
+            together by multi-tensor ops (``torch._foreach_*``) with the same results,
+            launching much fewer kernels for models of many small tensors (default: False)
+        state_dtype (str, optional): dtype of the moments, 'bfloat16', or 'int8' for blockwise
+            8-bit quantization with a float32 scale per block of 256 elements, dequantized to
+            float32 in the update and rounded stochastically back. Tensors of less than 4096
+            elements keep float32 moments with 'int8'. (default: None, the dtype of the parameters)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -28,7 +38,7 @@ class AdamW(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, foreach=False, state_dtype=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -37,14 +47,25 @@ class AdamW(Optimizer):
             raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
-        defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+        if state_dtype not in STATE_DTYPES:
+            raise ValueError("Invalid state dtype: {}".format(state_dtype))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
+                        amsgrad=amsgrad, foreach=foreach, state_dtype=state_dtype)
         super().__init__(params, defaults)
 
     def __setstate__(self, state):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('foreach', False)
+            group.setdefault('state_dtype', None)
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        restore_state_dtypes(self, state_dict)
+
+    def state_dict(self):
+        return dict(super().state_dict(), **generator_states(self))
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -58,6 +79,9 @@ class AdamW(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if group['foreach']:
+                self._step_foreach(group)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -72,16 +96,17 @@ class AdamW(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg', p.data, group['state_dtype'])
                     # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
+                    init_state(state, 'exp_avg_sq', p.data, group['state_dtype'], signed=False)
                     if amsgrad:
                         # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+                        init_state(state, 'max_exp_avg_sq', p.data, group['state_dtype'], signed=False)
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg = load_state(state, 'exp_avg', p.data)
+                exp_avg_sq = load_state(state, 'exp_avg_sq', p.data, signed=False)
                 if amsgrad:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
+                    max_exp_avg_sq = load_state(state, 'max_exp_avg_sq', p.data, signed=False)
                 beta1, beta2 = group['betas']
 
                 state['step'] += 1
@@ -96,6 +121,11 @@ class AdamW(Optimizer):
                     denom = max_exp_avg_sq.sqrt().add_(group['eps'])
                 else:
                     denom = exp_avg_sq.sqrt().add_(group['eps'])
+                generator = rounding_generator(self, p.device) if group['state_dtype'] else None
+                store_state(state, 'exp_avg', exp_avg, generator=generator)
+                store_state(state, 'exp_avg_sq', exp_avg_sq, signed=False, generator=generator)
+                if amsgrad:
+                    store_state(state, 'max_exp_avg_sq', max_exp_avg_sq, signed=False, generator=generator)
 
                 bias_correction1 = 1 - beta1 ** state['step']
                 bias_correction2 = 1 - beta2 ** state['step']
@@ -110,3 +140,53 @@ class AdamW(Optimizer):
                 p.data.add_(-step_size)
 
         return loss
+
+    def _step_foreach(self, group):
+        params, grads, states = params_with_grad(group, self.state)
+        for chunk in foreach_chunks(params, grads, states, group['state_dtype']):
+            self._update_foreach(group, *chunk)
+
+    def _update_foreach(self, group, params, grads, states):
+        amsgrad = group['amsgrad']
+        beta1, beta2 = group['betas']
+
+        for p, state in zip(params, states):
+            if len(state) == 0:
+                state['step'] = 0
+                init_state(state, 'exp_avg', p, group['state_dtype'])
+                init_state(state, 'exp_avg_sq', p, group['state_dtype'], signed=False)
+                if amsgrad:
+                    init_state(state, 'max_exp_avg_sq', p, group['state_dtype'], signed=False)
+            state['step'] += 1
+        exp_avgs = [load_state(state, 'exp_avg', p) for p, state in zip(params, states)]
+        exp_avg_sqs = [load_state(state, 'exp_avg_sq', p, signed=False) for p, state in zip(params, states)]
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        if amsgrad:
+            max_exp_avg_sqs = [load_state(state, 'max_exp_avg_sq', p, signed=False)
+                               for p, state in zip(params, states)]
+            torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+            denom = torch._foreach_sqrt(max_exp_avg_sqs)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denom, group['eps'])
+        for i, state in enumerate(states):
+            generator = rounding_generator(self, params[i].device) if group['state_dtype'] else None
+            store_state(state, 'exp_avg', exp_avgs[i], generator=generator)
+            store_state(state, 'exp_avg_sq', exp_avg_sqs[i], signed=False, generator=generator)
+            if amsgrad:
+                store_state(state, 'max_exp_avg_sq', max_exp_avg_sqs[i], signed=False, generator=generator)
+
+        step_sizes = [group['lr'] * math.sqrt(1 - beta2 ** state['step']) / (1 - beta1 ** state['step'])
+                      for state in states]
+        step_size = full_like(denom, step_sizes)
+        torch._foreach_div_(step_size, denom)
+        torch._foreach_mul_(step_size, exp_avgs)
+
+        if group['weight_decay'] != 0:
+            weight_decay = group['lr'] / group['initial_lr'] * group['weight_decay']
+            torch._foreach_sub_(params, params, alpha=weight_decay)
+        torch._foreach_sub_(params, step_size)
@@ -1,5 +1,9 @@
+import torch
 from torch.optim import Optimizer
 
+from horch.train.optimizer.utils import params_with_grad, STATE_DTYPES, init_state, load_state, store_state, \
+    restore_state_dtypes, rounding_generator, generator_states, foreach_chunks
+
 
 class Nadam(Optimizer):
     """Implements Nadam algorithm (a variant of Adam based on Nesterov momentum).
@@ -14,16 +18,37 @@ class Nadam(Optimizer):
             numerical stability (default: 1e-8)
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         schedule_decay (float, optional): momentum schedule decay (default: 4e-3)
+        foreach (boolean, optional): whether to update the parameters of every group
+            together by multi-tensor ops with the same results (default: False)
+        state_dtype (str, optional): dtype of the moments, 'bfloat16', or 'int8' for blockwise
+            8-bit quantization with a float32 scale per block of 256 elements, dequantized to
+            float32 in the update and rounded stochastically back. Tensors of less than 4096
+            elements keep float32 moments with 'int8'. (default: None, the dtype of the parameters)
     __ http://cs229.stanford.edu/proj2015/054_report.pdf
     __ http://www.cs.toronto.edu/~fritz/absps/momentum.pdf
     """
 
     def __init__(self, params, lr=2e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, schedule_decay=4e-3):
-        defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, schedule_decay=schedule_decay)
+                 weight_decay=0, schedule_decay=4e-3, foreach=False, state_dtype=None):
+        if state_dtype not in STATE_DTYPES:
+            raise ValueError("Invalid state dtype: {}".format(state_dtype))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
+                        schedule_decay=schedule_decay, foreach=foreach, state_dtype=state_dtype)
         super(Nadam, self).__init__(params, defaults)
 
+    def __setstate__(self, state):
+        super(Nadam, self).__setstate__(state)
+        for group in self.param_groups:
+            group.setdefault('foreach', False)
+            group.setdefault('state_dtype', None)
+
+    def load_state_dict(self, state_dict):
+        super(Nadam, self).load_state_dict(state_dict)
+        restore_state_dtypes(self, state_dict)
+
+    def state_dict(self):
+        return dict(super(Nadam, self).state_dict(), **generator_states(self))
+
     def step(self, closure=None):
         """Performs a single optimization step.
         Arguments:
@@ -35,6 +60,9 @@ class Nadam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if group['foreach']:
+                self._step_foreach(group)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -45,13 +73,14 @@ class Nadam(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     state['m_schedule'] = 1.
-                    state['exp_avg'] = grad.new().resize_as_(grad).zero_()
-                    state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+                    init_state(state, 'exp_avg', grad, group['state_dtype'])
+                    init_state(state, 'exp_avg_sq', grad, group['state_dtype'], signed=False)
 
                 # Warming momentum schedule
                 m_schedule = state['m_schedule']
                 schedule_decay = group['schedule_decay']
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg = load_state(state, 'exp_avg', grad)
+                exp_avg_sq = load_state(state, 'exp_avg_sq', grad, signed=False)
                 beta1, beta2 = group['betas']
                 eps = group['eps']
 
@@ -74,6 +103,9 @@ class Nadam(Optimizer):
 
                 exp_avg.mul_(beta1).add_(1 - beta1, grad)
                 exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+                generator = rounding_generator(self, p.device) if group['state_dtype'] else None
+                store_state(state, 'exp_avg', exp_avg, generator=generator)
+                store_state(state, 'exp_avg_sq', exp_avg_sq, signed=False, generator=generator)
                 exp_avg_sq_prime = exp_avg_sq.div(1. - bias_correction2)
 
                 denom = exp_avg_sq_prime.sqrt_().add_(group['eps'])
@@ -81,4 +113,57 @@ class Nadam(Optimizer):
                 p.data.addcdiv_(-group['lr'] * (1. - momentum_cache_t) / (1. - m_schedule_new), grad, denom)
                 p.data.addcdiv_(-group['lr'] * momentum_cache_t_1 / (1. - m_schedule_next), exp_avg, denom)
 
-        return loss
\ No newline at end of file
+        return loss
+
+    def _step_foreach(self, group):
+        params, grads, states = params_with_grad(group, self.state)
+        for chunk in foreach_chunks(params, grads, states, group['state_dtype']):
+            self._update_foreach(group, *chunk)
+
+    def _update_foreach(self, group, params, grads, states):
+        schedule_decay = group['schedule_decay']
+        beta1, beta2 = group['betas']
+
+        grad_coefs, exp_avg_coefs, bias_corrections = [], [], []
+        for grad, state in zip(grads, states):
+            if len(state) == 0:
+                state['step'] = 0
+                state['m_schedule'] = 1.
+                init_state(state, 'exp_avg', grad, group['state_dtype'])
+                init_state(state, 'exp_avg_sq', grad, group['state_dtype'], signed=False)
+            state['step'] += 1
+
+            # Warming momentum schedule
+            m_schedule = state['m_schedule']
+            momentum_cache_t = beta1 * \
+                (1. - 0.5 * (0.96 ** (state['step'] * schedule_decay)))
+            momentum_cache_t_1 = beta1 * \
+                (1. - 0.5 *
+                 (0.96 ** ((state['step'] + 1) * schedule_decay)))
+            m_schedule_new = m_schedule * momentum_cache_t
+            m_schedule_next = m_schedule * momentum_cache_t * momentum_cache_t_1
+            state['m_schedule'] = m_schedule_new
+
+            bias_corrections.append(1. - (1 - beta2 ** state['step']))
+            grad_coefs.append(-group['lr'] * (1. - momentum_cache_t) / (1. - m_schedule_new))
+            exp_avg_coefs.append(-group['lr'] * momentum_cache_t_1 / (1. - m_schedule_next))
+        exp_avgs = [load_state(state, 'exp_avg', grad) for grad, state in zip(grads, states)]
+        exp_avg_sqs = [load_state(state, 'exp_avg_sq', grad, signed=False) for grad, state in zip(grads, states)]
+
+        if group['weight_decay'] != 0:
+            grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        for i, state in enumerate(states):
+            generator = rounding_generator(self, params[i].device) if group['state_dtype'] else None
+            store_state(state, 'exp_avg', exp_avgs[i], generator=generator)
+            store_state(state, 'exp_avg_sq', exp_avg_sqs[i], signed=False, generator=generator)
+        denom = torch._foreach_div(exp_avg_sqs, bias_corrections)
+        torch._foreach_sqrt_(denom)
+        torch._foreach_add_(denom, group['eps'])
+
+        torch._foreach_addcdiv_(params, grads, denom, grad_coefs)
+        torch._foreach_addcdiv_(params, exp_avgs, denom, exp_avg_coefs)
@@ -1,11 +1,13 @@
 import torch
 from torch.optim.optimizer import Optimizer, required
 
+from horch.train.optimizer.utils import params_with_grad
+
 
 class SGDW(Optimizer):
 
     def __init__(self, params, lr=required, momentum=0, dampening=0,
-                 weight_decay=0, nesterov=False):
+                 weight_decay=0, nesterov=False, foreach=False):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -14,7 +16,7 @@ class SGDW(Optimizer):
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
 
         defaults = dict(lr=lr, momentum=momentum, dampening=dampening,
-                        weight_decay=weight_decay, nesterov=nesterov)
+                        weight_decay=weight_decay, nesterov=nesterov, foreach=foreach)
         if nesterov and (momentum <= 0 or dampening != 0):
             raise ValueError("Nesterov momentum requires a momentum and zero dampening")
         super().__init__(params, defaults)
@@ -23,6 +25,7 @@ class SGDW(Optimizer):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault('nesterov', False)
+            group.setdefault('foreach', False)
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -36,6 +39,9 @@ class SGDW(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if group['foreach']:
+                self._step_foreach(group)
+                continue
             momentum = group['momentum']
             dampening = group['dampening']
             nesterov = group['nesterov']
@@ -62,3 +68,34 @@ class SGDW(Optimizer):
                 p.data.add_(-group['lr'], d_p)
 
         return loss
+
+    def _step_foreach(self, group):
+        # The same update as `step` by multi-tensor ops
+        params, d_ps, states = params_with_grad(group, self.state)
+        if not params:
+            return
+        momentum = group['momentum']
+        dampening = group['dampening']
+
+        if momentum != 0:
+            bufs, new = [], []
+            for d_p, state in zip(d_ps, states):
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.clone(d_p).detach()
+                    new.append(True)
+                else:
+                    new.append(False)
+                bufs.append(state['momentum_buffer'])
+            old = [buf for buf, n in zip(bufs, new) if not n]
+            if old:
+                torch._foreach_mul_(old, momentum)
+                torch._foreach_add_(old, [d_p for d_p, n in zip(d_ps, new) if not n], alpha=1 - dampening)
+            if group['nesterov']:
+                d_ps = torch._foreach_add(d_ps, bufs, alpha=momentum)
+            else:
+                d_ps = bufs
+
+        if group['weight_decay'] != 0:
+            weight_decay = group['lr'] / group['initial_lr'] * group['weight_decay']
+            torch._foreach_sub_(params, params, alpha=weight_decay)
+        torch._foreach_add_(params, d_ps, alpha=-group['lr'])
@@ -0,0 +1,206 @@
+import torch
+
+
+def params_with_grad(group, state):
+    r"""
+    Parameters of `group` with gradients, their gradients and states.
+    """
+    params, grads, states = [], [], []
+    for p in group['params']:
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            raise RuntimeError('Sparse gradients are not supported')
+        params.append(p.data)
+        grads.append(p.grad.data)
+        states.append(state[p])
+    return params, grads, states
+
+
+def full_like(tensors, scalars):
+    r"""
+    Tensors like `tensors` filled with `scalars` by multi-tensor ops, exactly as `torch.full_like`.
+    """
+    out = torch._foreach_mul(tensors, 0.)
+    # Zero again, as 0 * inf is nan
+    torch._foreach_zero_(out)
+    torch._foreach_add_(out, scalars)
+    return out
+
+
+STATE_DTYPES = (None, 'float32', 'bfloat16', 'int8')
+
+# Tensors smaller than this keep float32 states with `state_dtype='int8'`,
+# where the scales and the rounding would cost more than they save
+MIN_QUANTIZED_SIZE = 4096
+BLOCK_SIZE = 256
+
+# Elements of the tensors updated together by foreach steps with low precision states,
+# bounding the float32 copies of the moments to about this size
+FOREACH_CHUNK_SIZE = 1 << 22
+
+
+def _dynamic_map(signed, decades):
+    # 255 codes: zero and values (or +-values) evenly spaced in log scale from 10^-decades to 1
+    n = 127 if signed else 254
+    values = torch.logspace(-decades, 0, n, dtype=torch.float64)
+    if signed:
+        values = torch.cat([-values.flip(0), values.new_zeros(1), values])
+    else:
+        values = torch.cat([values.new_zeros(1), values])
+    return values.float()
+
+
+_CODES = {}
+
+
+def _code(signed, device):
+    key = (signed, device)
+    if key not in _CODES:
+        _CODES[key] = _dynamic_map(signed, 7 if signed else 14).to(device)
+    return _CODES[key]
+
+
+def quantize(x, signed, generator=None):
+    r"""
+    Blockwise 8-bit codes (uint8) of `x` and float32 absmax of every block of `BLOCK_SIZE`.
+    The values scaled by the absmax of their blocks are rounded to their neighbours in
+    a dynamic (log scale) map, stochastically by `generator` so that the decay of small
+    values isn't lost, or to the nearest if it is None.
+    """
+    x = x.detach().float().reshape(-1)
+    n = x.numel()
+    padded = -n % BLOCK_SIZE
+    if padded:
+        x = torch.cat([x, x.new_zeros(padded)])
+    x = x.view(-1, BLOCK_SIZE)
+    absmax = x.abs().amax(dim=1)
+    x = (x / absmax.clamp_min(1e-30)[:, None]).view(-1)
+    code = _code(signed, x.device)
+    hi = torch.searchsorted(code, x).clamp_(1, code.numel() - 1)
+    lo = hi - 1
+    frac = (x - code[lo]) / (code[hi] - code[lo])
+    if generator is None:
+        threshold = 0.5
+    else:
+        threshold = torch.rand(frac.shape, device=frac.device, generator=generator)
+    codes = torch.where(frac > threshold, hi, lo)
+    return codes.to(torch.uint8), absmax
+
+
+def dequantize(codes, absmax, signed, like):
+    r"""
+    Float32 tensor shaped as `like` of the codes and absmax from `quantize`.
+    """
+    code = _code(signed, codes.device)
+    x = code[codes.long()].view(-1, BLOCK_SIZE) * absmax[:, None]
+    return x.view(-1)[:like.numel()].view_as(like)
+
+
+def _round_bf16(x, generator=None):
+    # Stochastic rounding to bfloat16 by adding random lower 16 bits of the float32 values
+    if generator is None:
+        return x.to(torch.bfloat16)
+    bits = x.float().view(torch.int32)
+    noise = torch.randint(0, 1 << 16, bits.shape, dtype=torch.int32, device=bits.device, generator=generator)
+    bits = (bits + noise) & -65536
+    return bits.view(torch.float32).to(torch.bfloat16)
+
+
+def init_state(state, key, p, state_dtype, signed=True):
+    r"""
+    Zero moment `key` of `p` in `state`, stored in `state_dtype`.
+    """
+    if state_dtype == 'int8' and p.numel() >= MIN_QUANTIZED_SIZE:
+        state[key], state[key + '_absmax'] = quantize(torch.zeros_like(p, dtype=torch.float), signed)
+    elif state_dtype == 'bfloat16':
+        state[key] = torch.zeros_like(p, dtype=torch.bfloat16)
+    else:
+        state[key] = torch.zeros_like(p)
+
+
+def load_state(state, key, p, signed=True):
+    r"""
+    Moment `key` of `p` in `state` to compute with. It is the stored tensor itself, updated in
+    place, unless stored in low precision, in which case it is a float32 copy to `store_state`.
+    """
+    x = state[key]
+    if key + '_absmax' in state:
+        return dequantize(x, state[key + '_absmax'], signed, p)
+    if x.dtype == torch.bfloat16 and p.dtype != torch.bfloat16:
+        return x.float()
+    return x
+
+
+def store_state(state, key, x, signed=True, generator=None):
+    r"""
+    Store moment `x` of `load_state` back to `state`, rounding stochastically by `generator`.
+    """
+    if key + '_absmax' in state:
+        state[key], state[key + '_absmax'] = quantize(x, signed, generator)
+    elif state[key] is not x:
+        state[key].copy_(_round_bf16(x, generator))
+
+
+def rounding_generator(optimizer, device):
+    r"""
+    Generator of `optimizer` on `device` for the stochastic rounding of its states, separate
+    from the default one so that low precision states don't shift other random draws.
+    It is seeded by the initial seed of torch and saved by `generator_states`.
+    """
+    generators = optimizer.__dict__.setdefault('_generators', {})
+    key = str(torch.device(device))
+    if key not in generators:
+        generators[key] = torch.Generator(device).manual_seed(torch.initial_seed())
+    return generators[key]
+
+
+def generator_states(optimizer):
+    r"""
+    Entries of the rounding generators to add to the state dict of `optimizer`, if any.
+    """
+    generators = optimizer.__dict__.get('_generators')
+    if not generators:
+        return {}
+    return {'generators': {k: g.get_state() for k, g in generators.items()}}
+
+
+def set_generator_states(optimizer, states):
+    for k, s in states.items():
+        rounding_generator(optimizer, k).set_state(s.cpu().clone())
+
+
+def foreach_chunks(params, grads, states, state_dtype):
+    r"""
+    Split the lists of a foreach step into chunks of about `FOREACH_CHUNK_SIZE` elements if
+    the states are in low precision, whose float32 copies only live during their chunk.
+    """
+    if not params:
+        return
+    if state_dtype in (None, 'float32'):
+        yield params, grads, states
+        return
+    start, n = 0, 0
+    for i, p in enumerate(params):
+        n += p.numel()
+        if n >= FOREACH_CHUNK_SIZE:
+            yield params[start:i + 1], grads[start:i + 1], states[start:i + 1]
+            start, n = i + 1, 0
+    if start < len(params):
+        yield params[start:], grads[start:], states[start:]
+
+
+def restore_state_dtypes(optimizer, state_dict):
+    r"""
+    Restore the dtypes of the states loaded from `state_dict`, which `Optimizer.load_state_dict`
+    casts to those of the parameters, e.g. bfloat16 moments or uint8 codes to float32, and
+    the states of the rounding generators.
+    """
+    set_generator_states(optimizer, state_dict.get('generators', {}))
+    ids = [i for group in state_dict['param_groups'] for i in group['params']]
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    for i, p in zip(ids, params):
+        state = optimizer.state[p]
+        for k, v in state_dict['state'].get(i, {}).items():
+            if torch.is_tensor(v) and torch.is_tensor(state.get(k)) and state[k].dtype != v.dtype:
+                state[k] = state[k].to(v.dtype)
@@ -0,0 +1,149 @@
+import queue
+import threading
+
+import torch
+
+_END = object()
+_EMPTY = object()
+
+
+class _Error:
+
+    def __init__(self, e):
+        self.e = e
+
+
+class DevicePrefetcher:
+    r"""
+    Iterable over the batches of `loader` on `device`, staging batch k+1 while batch k is used.
+
+    A thread draws the batches from `loader`, applies `transform` (e.g. a conversion of layout
+    on the CPU) and pins them, and keeps up to `depth` of them ready. On CUDA, the next batch
+    is copied to the device with `non_blocking=True` on a side stream, which the current stream
+    waits for only when the batch is yielded, so the copy overlaps the computation of the last
+    one. The steps can still call `convert_tensor(batch, device)`, which does nothing to tensors
+    already on the device. The copies are the steps' own, which `is_staged` tells, so they may
+    be modified in place, unlike the tensors of `loader` yielded as they are (e.g. on the CPU).
+
+    Every iteration creates a new iterator of `loader`, as ignite does every epoch, and the
+    length and other attributes (e.g. `batch_sampler`) are those of `loader`.
+
+    Args:
+        loader (Iterable): The DataLoader or any iterable of batches.
+        device (torch.device): Device to stage the batches to.
+        transform (callable, optional): Function applied to every batch in the thread.
+        depth (int): Number of batches prepared ahead by the thread.
+        pin_memory (bool, optional): Whether to pin the batches in the thread.
+            Default to whether `device` is CUDA and `loader` doesn't pin them already.
+    """
+
+    def __init__(self, loader, device, transform=None, depth=2, pin_memory=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.transform = transform
+        self.depth = depth
+        if pin_memory is None:
+            pin_memory = self.device.type == 'cuda' and not getattr(loader, 'pin_memory', False)
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _produce(self, q, stop):
+        try:
+            for batch in self.loader:
+                if self.transform is not None:
+                    batch = self.transform(batch)
+                if self.pin_memory:
+                    batch = _apply(batch, lambda t: t if t.is_pinned() else t.pin_memory())
+                if not _put(q, batch, stop):
+                    return
+        except BaseException as e:
+            _put(q, _Error(e), stop)
+            return
+        _put(q, _END, stop)
+
+    def _get(self, q, block=True):
+        batch = q.get(block)
+        if isinstance(batch, _Error):
+            raise batch.e
+        return batch
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            batch = self._stage(self._get(q), stream)
+            while batch is not _END:
+                if stream is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_stream(stream)
+                    # The memory allocated on the side stream is used by the current one
+                    batch = _apply(batch, lambda t: t.record_stream(current) or t)
+                # Start copying the next batch if it is ready, otherwise after this one is used
+                try:
+                    next_batch = self._stage(self._get(q, False), stream)
+                except queue.Empty:
+                    next_batch = _EMPTY
+                yield batch
+                batch = self._stage(self._get(q), stream) if next_batch is _EMPTY else next_batch
+        finally:
+            stop.set()
+            # Unblock the thread waiting for a free slot
+            while thread.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+    def _stage(self, batch, stream):
+        if batch is _END:
+            return batch
+        if stream is None:
+            return _apply(batch, lambda t: _mark(t.to(self.device), t))
+        with torch.cuda.stream(stream):
+            return _apply(batch, lambda t: _mark(t.to(self.device, non_blocking=True), t))
+
+
+def is_staged(t):
+    r"""
+    Whether `t` is a copy made by DevicePrefetcher, not a tensor of the loader.
+    """
+    return getattr(t, '_staged', False)
+
+
+def _mark(staged, t):
+    if staged is not t:
+        staged._staged = True
+    return staged
+
+
+def _apply(x, f):
+    # Apply `f` to the tensors in `x`, leaving other objects as they are
+    if torch.is_tensor(x):
+        return f(x)
+    if isinstance(x, dict):
+        return x.__class__((k, _apply(v, f)) for k, v in x.items())
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        return x.__class__(*(_apply(v, f) for v in x))
+    if isinstance(x, (list, tuple)):
+        return x.__class__(_apply(v, f) for v in x)
+    return x
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
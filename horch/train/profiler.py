@@ -0,0 +1,198 @@
+r"""
+Breakdown of the step time of ignite engines.
+
+`StepProfiler.attach` times, at every iteration, the wait for the batch ("data"), the process
+function ("step") and the handlers of the iteration events (metrics by "metrics", others by
+their names), and the handlers of the epoch events once per epoch. Inside the process function,
+the phases recorded by `record` are timed as well, which the trainers do for "h2d", "forward",
+"backward" and "optimizer". `record` does nothing unless a profiled engine is running.
+
+With `sync`, the device is synchronized at the boundaries of the phases, so the time of
+asynchronous CUDA kernels is attributed to the phase launching them. This slows down training
+and is only done while profiling.
+"""
+import functools
+import inspect
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from ignite.engine import Engine, Events
+from ignite.metrics import Metric
+
+ITERATION_EVENTS = [Events.GET_BATCH_STARTED, Events.GET_BATCH_COMPLETED,
+                    Events.ITERATION_STARTED, Events.ITERATION_COMPLETED]
+EPOCH_EVENTS = [Events.EPOCH_STARTED, Events.EPOCH_COMPLETED]
+
+_active = None
+
+
+@contextmanager
+def record(name):
+    r"""
+    Time the enclosed code as phase `name` of the current iteration of the profiled engine.
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    profiler.start(name)
+    try:
+        with torch.profiler.record_function(name):
+            yield
+    finally:
+        profiler.stop(name)
+
+
+def _handler_name(handler):
+    f = inspect.unwrap(handler, stop=lambda f: hasattr(f, '__self__'))
+    if isinstance(getattr(f, '__self__', None), Metric):
+        return "metrics"
+    # Curried or partial functions, and callable objects by their classes
+    f = getattr(f, 'func', f)
+    name = getattr(f, '__name__', type(f).__name__)
+    return "handlers" if name == "<lambda>" else name.strip('_')
+
+
+class StepProfiler:
+    r"""
+    Rolling percentiles of the time of the phases of the iterations of an engine.
+
+    Args:
+        device (torch.device): Device to synchronize.
+        window (int): Number of the last iterations for the percentiles.
+        sync (bool): Whether to synchronize the device (if CUDA) at the boundaries of the phases.
+    """
+
+    def __init__(self, device, window=200, sync=True):
+        self.device = torch.device(device)
+        self.window = window
+        self.sync = sync and self.device.type == 'cuda'
+        self.times = defaultdict(lambda: deque(maxlen=window))
+        self.epoch_times = defaultdict(float)
+        self._current = defaultdict(float)
+        self._starts = {}
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start(self, name):
+        self._starts[name] = self._now()
+
+    def stop(self, name):
+        start = self._starts.pop(name, None)
+        if start is not None:
+            self._current[name] += self._now() - start
+
+    def end_iteration(self):
+        for name, t in self._current.items():
+            self.times[name].append(t)
+        self._current.clear()
+
+    def percentiles(self, q=(50, 90, 99)):
+        r"""
+        Percentiles `q` of the time of every phase in milliseconds, by phase.
+        """
+        return {name: np.percentile(np.array(ts), q) * 1000 for name, ts in self.times.items() if ts}
+
+    def _timed(self, handler, name, per_epoch):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = self._now()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                elapsed = self._now() - start
+                if per_epoch:
+                    self.epoch_times[name] += elapsed
+                else:
+                    self._current[name] += elapsed
+        return wrapper
+
+    def attach(self, engine: Engine, writer=None, stage='train', log_freq=10, global_step=None, verbose=True):
+        r"""
+        Profile `engine`. Call after all other handlers are added, which are wrapped to be timed.
+
+        Args:
+            engine (Engine): The engine.
+            writer (SummaryWriter, optional): Writer of the percentiles under `perf/{stage}/`.
+            stage (str): Name of the engine in the logs.
+            log_freq (int): Write the percentiles every this number of iterations, or every epoch if 0.
+            global_step (callable, optional): Step of the logs. Default to the iteration of `engine`.
+            verbose (bool): Whether to print the summary of every epoch.
+        """
+        global_step = global_step or (lambda: engine.state.iteration)
+
+        for event, per_epoch in [(e, False) for e in ITERATION_EVENTS] + [(e, True) for e in EPOCH_EVENTS]:
+            handlers = engine._event_handlers[event]
+            for i, (handler, args, kwargs) in enumerate(handlers):
+                handlers[i] = (self._timed(handler, _handler_name(handler), per_epoch), args, kwargs)
+        engine._process_function = self._timed(engine._process_function, "step", False)
+
+        def get_batch_started(_):
+            global _active
+            _active = self
+            self.start("data")
+            self.start("iteration")
+
+        def iteration_completed(engine):
+            self.stop("iteration")
+            self.end_iteration()
+            if writer and log_freq and engine.state.iteration % log_freq == 0:
+                self.log(writer, stage, global_step())
+
+        def epoch_completed(engine):
+            if writer and not log_freq:
+                self.log(writer, stage, global_step())
+            if verbose:
+                self.print_summary(stage)
+            self.epoch_times.clear()
+
+        def completed(_):
+            global _active
+            if _active is self:
+                _active = None
+
+        engine.add_event_handler(Events.GET_BATCH_STARTED, get_batch_started)
+        engine.add_event_handler(Events.GET_BATCH_COMPLETED, lambda _: self.stop("data"))
+        engine.add_event_handler(Events.ITERATION_COMPLETED, iteration_completed)
+        engine.add_event_handler(Events.EPOCH_COMPLETED, epoch_completed)
+        engine.add_event_handler(Events.COMPLETED, completed)
+        engine.add_event_handler(Events.EXCEPTION_RAISED, completed)
+
+    def log(self, writer, stage, step):
+        for name, (p50, p90, p99) in self.percentiles().items():
+            writer.add_scalar("perf/%s/%s_p50" % (stage, name), p50, step)
+            writer.add_scalar("perf/%s/%s_p90" % (stage, name), p90, step)
+            writer.add_scalar("perf/%s/%s_p99" % (stage, name), p99, step)
+
+    def print_summary(self, stage):
+        ps = self.percentiles()
+        if not ps:
+            return
+        total = ps.get("iteration", [sum(p[0] for p in ps.values())])[0]
+        print("%s step time (ms, p50/p90/p99, %% of p50 iteration):" % stage)
+        for name, (p50, p90, p99) in sorted(ps.items(), key=lambda x: -x[1][0]):
+            print("  %-20s %8.2f %8.2f %8.2f %6.1f%%" % (name, p50, p90, p99, 100 * p50 / total))
+        for name, t in self.epoch_times.items():
+            print("  %-20s %8.2f s per epoch" % (name, t))
+
+
+@contextmanager
+def trace(dirname, start, iterations):
+    r"""
+    Capture a torch.profiler trace of `iterations` iterations after the first `start` ones,
+    viewable in TensorBoard, calling `step` of the yielded profiler every iteration.
+    """
+    schedule = torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=iterations, repeat=1)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, schedule=schedule,
+                                on_trace_ready=torch.profiler.tensorboard_trace_handler(str(dirname)),
+                                record_shapes=True) as prof:
+        yield prof
@@ -0,0 +1,214 @@
+import time
+from bisect import bisect_right
+
+from torch.utils.data import Dataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.sampler import Sampler
+from ignite.engine import Events, Engine
+
+
+class ResolutionSchedule:
+    r"""
+    Schedule of image sizes by epoch for progressive resizing, with the batch size
+    scaled inversely with the number of pixels to keep the memory usage constant.
+
+    Use `progressive_loader` to create the DataLoader and pass the schedule to
+    `TrainerBase.fit`, which advances it at the start of every epoch.
+
+    Args:
+        phases (sequence): Pairs of (epoch, size), training at `size` from `epoch` (starts from 1) on.
+            The first phase must start at epoch 1.
+        batch_size (int): Batch size at the largest size.
+        keep_memory (bool): Whether to scale the batch size by (max_size / size) ** 2.
+            Otherwise `batch_size` is used in all phases.
+        max_batch_size (int, optional): Upper bound of the scaled batch sizes.
+    """
+
+    def __init__(self, phases, batch_size, keep_memory=True, max_batch_size=None):
+        phases = sorted((int(epoch), size) for epoch, size in phases)
+        if not phases or phases[0][0] != 1:
+            raise ValueError("The first phase must start at epoch 1, got %s" % phases)
+        self.epochs = [epoch for epoch, _ in phases]
+        self.sizes = [size for _, size in phases]
+        self.batch_size = batch_size
+        self.keep_memory = keep_memory
+        self.max_batch_size = max_batch_size
+        self.epoch = 1
+        # Iterations of the engine at the end of the last epoch, as epochs have different lengths
+        self.iteration = 0
+
+    def phase(self, epoch=None):
+        epoch = self.epoch if epoch is None else epoch
+        return bisect_right(self.epochs, epoch) - 1
+
+    def size(self, epoch=None):
+        return self.sizes[self.phase(epoch)]
+
+    def batch_size_at(self, epoch=None):
+        if not self.keep_memory:
+            return self.batch_size
+        size = self.size(epoch)
+        batch_size = int(self.batch_size * (_area(max(self.sizes, key=_area)) / _area(size)))
+        if self.max_batch_size:
+            batch_size = min(batch_size, self.max_batch_size)
+        return batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "iteration": self.iteration}
+
+    def load_state_dict(self, d):
+        self.epoch = d['epoch']
+        self.iteration = d.get('iteration')
+
+    def attach(self, engine: Engine, train_loader: DataLoader, writer=None):
+        r"""
+        Advance the schedule at the start of every epoch of `engine` and log the
+        throughput of every epoch and phase, to stdout and `writer` if provided.
+        """
+        stats = {"samples": 0, "start": 0., "phase_samples": 0, "phase_time": 0.}
+
+        def epoch_started(engine):
+            phase = self.phase()
+            self.set_epoch(engine.state.epoch)
+            if self.phase() != phase:
+                stats["phase_samples"], stats["phase_time"] = 0, 0.
+            # Ignite checks the epoch length at every iteration, and creates the iterator
+            # of the next epoch after this event, so both take the new batch size
+            engine.state.epoch_length = len(train_loader)
+            stats["samples"] = 0
+            stats["start"] = time.perf_counter()
+
+        def iteration_completed(engine):
+            stats["samples"] += len(engine.state.batch[0])
+
+        def epoch_completed(engine):
+            self.iteration = engine.state.iteration
+            elapsed = time.perf_counter() - stats["start"]
+            stats["phase_samples"] += stats["samples"]
+            stats["phase_time"] += elapsed
+            epoch = engine.state.epoch
+            throughput = stats["samples"] / elapsed
+            if writer:
+                writer.add_scalar("throughput/train", throughput, epoch)
+                writer.add_scalar("resolution/size", _area(self.size()) ** 0.5, epoch)
+            last = epoch == engine.state.max_epochs or self.phase(epoch + 1) != self.phase()
+            if last:
+                print("Phase %d (size %s, batch size %d): %.1f samples/s" % (
+                    self.phase() + 1, self.size(), self.batch_size_at(),
+                    stats["phase_samples"] / stats["phase_time"]))
+
+        engine.add_event_handler(Events.EPOCH_STARTED, epoch_started)
+        engine.add_event_handler(Events.ITERATION_COMPLETED, iteration_completed)
+        engine.add_event_handler(Events.EPOCH_COMPLETED, epoch_completed)
+
+
+def _area(size):
+    if isinstance(size, int):
+        return size * size
+    return size[0] * size[1]
+
+
+class ProgressiveBatchSampler(Sampler):
+    r"""
+    Batch sampler with the batch size of the current epoch of `schedule`, yielding
+    (index, size) pairs so that the size reaches the DataLoader workers with every
+    batch, whether they are persistent or not.
+
+    Args:
+        sampler (Sampler): Sampler of the indices.
+        schedule (ResolutionSchedule): The schedule.
+        drop_last (bool): Whether to drop the last incomplete batch.
+    """
+
+    def __init__(self, sampler, schedule, drop_last=False):
+        self.sampler = sampler
+        self.schedule = schedule
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        size = self.schedule.size()
+        batch_size = self.schedule.batch_size_at()
+        batch = []
+        for idx in self.sampler:
+            batch.append((idx, size))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        batch_size = self.schedule.batch_size_at()
+        if self.drop_last:
+            return len(self.sampler) // batch_size
+        return (len(self.sampler) + batch_size - 1) // batch_size
+
+
+def set_size(transforms, size):
+    r"""
+    Set the output size of the transforms with a `size` attribute (e.g. Resize,
+    RandomResizedCrop and CenterCrop), keeping ints as ints.
+    """
+    for t in transforms:
+        if isinstance(t.size, int):
+            t.size = size if isinstance(size, int) else size[0]
+        else:
+            t.size = (size, size) if isinstance(size, int) else tuple(size)
+
+
+class ProgressiveDataset(Dataset):
+    r"""
+    Dataset indexed by the (index, size) pairs of ProgressiveBatchSampler, which resizes
+    the transforms of `dataset` before loading a sample of a new size.
+
+    Note that the transforms are changed in place, so the cached prefix of a CachedCompose
+    must not contain resized transforms (create it with `resizable=True`), which raises
+    a ValueError.
+
+    Args:
+        dataset (Dataset): The dataset.
+        transform (Compose): Transform of `dataset` containing the transforms to resize.
+        resizable (sequence, optional): Transforms to resize. Default to the transforms in
+            `transform` with a `size` attribute.
+    """
+
+    def __init__(self, dataset, transform, resizable=None):
+        self.dataset = dataset
+        if resizable is None:
+            resizable = [t for t in getattr(transform, 'transforms', [transform]) if hasattr(t, 'size')]
+        cached = getattr(transform, 'cached', [])
+        if any(t is c for t in resizable for c in cached):
+            raise ValueError("Resized transforms are cached by %s and would keep their first size, "
+                             "create it with resizable=True" % type(transform).__name__)
+        self.resizable = resizable
+        self._size = None
+
+    def __getitem__(self, item):
+        idx, size = item
+        if size != self._size:
+            set_size(self.resizable, size)
+            self._size = size
+        return self.dataset[idx]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def progressive_loader(dataset, schedule, transform, shuffle=True, drop_last=False, resizable=None, **kwargs):
+    r"""
+    DataLoader of `dataset` following `schedule`, passing the size with the indices.
+
+    Args:
+        dataset (Dataset): The dataset.
+        schedule (ResolutionSchedule): The schedule.
+        transform (Compose): Transform of `dataset` containing the transforms to resize.
+        shuffle (bool): Whether to shuffle the dataset.
+        drop_last (bool): Whether to drop the last incomplete batch.
+        resizable (sequence, optional): Transforms to resize, see ProgressiveDataset.
+        kwargs: Other arguments of DataLoader, e.g. `num_workers` and `persistent_workers`.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    batch_sampler = ProgressiveBatchSampler(sampler, schedule, drop_last)
+    return DataLoader(ProgressiveDataset(dataset, transform, resizable), batch_sampler=batch_sampler, **kwargs)
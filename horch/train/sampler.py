@@ -39,7 +39,6 @@ class IterSampler(Sampler):
     """
 
     def __init__(self, data_source, batch_size, shuffle=True, drop_last=False, num_iterations=inf, start_iter=0):
-        super().__init__(data_source)
         if shuffle:
             sampler = RandomSampler(data_source)
         else:
@@ -1,7 +1,8 @@
+from contextlib import ExitStack
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 from pathlib import Path
-from typing import Sequence, Dict, Callable, Union, Optional, Any
+from typing import Sequence, Dict, Callable, Union, Optional, Any, Tuple
 
 import torch
 import torch.nn as nn
@@ -14,21 +15,122 @@ from torch.utils.tensorboard import SummaryWriter
 
 from horch.common import CUDA
 from horch.io import fmt_path
+from horch.train.distributed import is_distributed, is_main_process, get_device, wrap_model, unwrap_model, \
+    distribute_loader, set_epoch
+from horch.train.progressive import ResolutionSchedule
+from horch.train.checkpoint import read_latest, load_checkpoint
+from horch.train.lr_scheduler import compile_schedule
+from horch.train.prefetch import DevicePrefetcher
+from horch.train.profiler import StepProfiler, record, trace
 from ignite.engine import Events, Engine
 from ignite.handlers import Checkpoint, DiskSaver
+from ignite.handlers.checkpoint import BaseSaveHandler
 from ignite.metrics import Metric
 
 
-def backward(loss, optimizer, fp16):
-    if fp16:
-        from apex import amp
-        with amp.scale_loss(loss, optimizer) as scaled_loss:
-            scaled_loss.backward()
-    else:
-        loss.backward()
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def autocast(device, precision='fp32'):
+    r"""
+    Context of `torch.autocast` on `device` with the dtype of `precision`, one of
+    "fp32" (disabled), "bf16" and "fp16".
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Precision must be one of %s, got %s" % (list(PRECISIONS), precision))
+    device = torch.device(device)
+    return torch.autocast(device.type, dtype=PRECISIONS[precision], enabled=precision != 'fp32')
+
+
+def create_grad_scaler(device, precision='fp32'):
+    r"""
+    GradScaler for `precision`, which is only needed by "fp16". Return None for the others.
+    """
+    if precision != 'fp16':
+        return None
+    device = torch.device(device)
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device.type)
+    return torch.cuda.amp.GradScaler()
+
+
+def backward(loss, scaler=None):
+    with record("backward"):
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
     return
 
 
+def unscale(optimizer, scaler=None):
+    r"""
+    Unscale the gradients of `optimizer` in place before clipping or inspecting them.
+    """
+    if scaler is not None:
+        scaler.unscale_(optimizer)
+
+
+def optimizer_step(optimizer, scaler=None):
+    r"""
+    Step `optimizer`, skipped by `scaler` if the gradients contain infs or NaNs.
+    Call `scaler.update()` once after all optimizers have stepped.
+    """
+    with record("optimizer"):
+        if scaler is not None:
+            scaler.step(optimizer)
+        else:
+            optimizer.step()
+
+
+def estimate_sample_memory(model, x, precision='fp32'):
+    r"""
+    Estimate the activation memory in bytes of one sample in training, as the size of
+    the outputs of the leaf modules of `model` for the first sample of batch `x`.
+    """
+    total = 0
+
+    def hook(module, input, output):
+        nonlocal total
+        for t in output if isinstance(output, (tuple, list)) else [output]:
+            if torch.is_tensor(t):
+                total += t.numel() * t.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad(), autocast(x.device, precision):
+            model(x[:1])
+    finally:
+        model.train(training)
+        for h in handles:
+            h.remove()
+    return total
+
+
+def micro_batch_size_for(model, x, memory_budget, precision='fp32'):
+    r"""
+    The largest micro-batch size of `x` whose activations of `model` fit in `memory_budget` bytes.
+    """
+    return max(1, min(x.size(0), int(memory_budget // estimate_sample_memory(model, x, precision))))
+
+
+def split_batch(batch, size):
+    r"""
+    Split a tensor or (nested) tuple of tensors along the first dimension into chunks of `size`.
+    """
+    if torch.is_tensor(batch):
+        return batch.split(size)
+    if isinstance(batch, (tuple, list)):
+        return list(zip(*[split_batch(b, size) for b in batch]))
+    raise TypeError("Can't split %s" % type(batch))
+
+
 class StatefulList:
 
     def __init__(self, xs):
@@ -75,7 +177,7 @@ class TrainerBase:
                  metrics: Dict[str, Metric],
                  test_metrics: Dict[str, Metric],
                  save_path: Union[Path, str] = ".",
-                 fp16: bool = False,
+                 precision: str = 'fp32',
                  lr_step_on_iter: bool = False,
                  device: Optional[str] = None,
                  **kwargs):
@@ -86,14 +188,17 @@ class TrainerBase:
         if not isinstance(lr_schedulers, Sequence):
             lr_schedulers = [lr_schedulers]
         if device is None:
-            device = 'cuda' if CUDA else 'cpu'
+            device = get_device() if is_distributed() else 'cuda' if CUDA else 'cpu'
         device = torch.device(device)
         save_path = fmt_path(save_path)
         model.to(device)
+        # In distributed mode, train by DistributedDataParallel and only log and save on rank 0
+        model = wrap_model(model, device)
 
-        if fp16:
-            from apex import amp
-            model, optimizer = amp.initialize(model, optimizers, opt_level="O1", verbosity=0)
+        if kwargs.pop('fp16', False):
+            precision = 'fp16'
+        if precision not in PRECISIONS:
+            raise ValueError("Precision must be one of %s, got %s" % (list(PRECISIONS), precision))
 
         # Set Arguments
 
@@ -104,33 +209,37 @@ class TrainerBase:
         self.metrics = metrics
         self.test_metrics = test_metrics
         self.save_path = save_path
-        self.fp16 = fp16
+        self.precision = precision
+        self.scaler = create_grad_scaler(device, precision)
         self.lr_step_on_iter = lr_step_on_iter
         self.device = device
 
         self.log_path = self.save_path / "runs"
         current_time = datetime.now().strftime('%b%d_%H-%M-%S')
-        self.writer = SummaryWriter(str(self.log_path / current_time), flush_secs=10)
+        self.writer = SummaryWriter(str(self.log_path / current_time), flush_secs=10) if is_main_process() else None
 
         self._train_engine_state = None
         self._eval_engine_state = None
 
         self._traier_state = TrainerState.INIT
         self._epochs = 0
+        self._epoch_start_iteration = None
+        self._resolution_schedule_state = None
 
         self._kwargs = kwargs
 
     def to_save(self):
-        d = {'model': self.model, 'optimizers': StatefulList(self.optimizers),
+        d = {'model': unwrap_model(self.model), 'optimizers': StatefulList(self.optimizers),
              'lr_schedulers': StatefulList(self.lr_schedulers)}
-        if self.fp16:
-            from apex import amp
-            d['amp'] = amp
+        if self.scaler is not None:
+            d['scaler'] = self.scaler
         return d
 
     def resume(self, fp=None):
         assert self._traier_state == TrainerState.INIT
 
+        if fp is None:
+            fp = read_latest(self.save_path)
         if fp is None:
             d = Path(self.save_path)
             pattern = "checkpoint_*.pt*"
@@ -139,18 +248,23 @@ class TrainerBase:
                 raise FileNotFoundError("No checkpoint to load in %s" % self.save_path)
             fp = max(saves, key=lambda f: f.stat().st_mtime)
 
-        checkpoint = torch.load(fp)
+        # Flat checkpoints are memory-mapped and copied into the parameters by load_state_dict
+        checkpoint = load_checkpoint(fp, map_location=self.device)
 
-        if not self.fp16 and 'amp' in checkpoint:
-            del checkpoint['amp']
+        to_load = self.to_save()
+        if 'scaler' in to_load and 'scaler' not in checkpoint:
+            # Resume a checkpoint of other precisions with a new scaler
+            del to_load['scaler']
 
-        Checkpoint.load_objects(self.to_save(), checkpoint)
+        Checkpoint.load_objects(to_load, checkpoint)
 
         self._train_engine_state = checkpoint['train_engine']
         self._eval_engine_state = checkpoint['eval_engine']
+        self._resolution_schedule_state = checkpoint.get('resolution_schedule')
         self._traier_state = TrainerState.FITTING
 
-        print("Load trainer from %s" % fp)
+        if is_main_process():
+            print("Load trainer from %s" % fp)
 
     def _create_train_engine(self) -> Engine:
         raise NotImplementedError
@@ -164,6 +278,8 @@ class TrainerBase:
 
     @curry
     def _log_epoch_start(self, engine):
+        if not is_main_process():
+            return
         lrs = "".join(", lr %f" % lr_scheduler.get_last_lr()[0] for lr_scheduler in self.lr_schedulers)
         print("Epoch %d%s" % (engine.state.epoch, lrs))
 
@@ -171,15 +287,60 @@ class TrainerBase:
     def _lr_scheduler_step(self, engine):
         iteration = engine.state.iteration
         iters_per_epoch = engine.state.epoch_length
+        # Step per logical batch when gradients are accumulated across iterations
+        accumulation_steps = self._kwargs.get('accumulation_steps', 1)
+        if iteration % accumulation_steps != 0:
+            return
+        if self._epoch_start_iteration is not None:
+            # Epochs have different lengths under a resolution schedule
+            epochs = engine.state.epoch - 1 + (iteration - self._epoch_start_iteration) / iters_per_epoch
+        else:
+            epochs = iteration / iters_per_epoch
         for lr_scheduler in self.lr_schedulers:
-            steps = iteration if self.lr_step_on_iter else iteration / iters_per_epoch
+            steps = iteration // accumulation_steps if self.lr_step_on_iter else epochs
             lr_scheduler.step(steps)
 
+    def _compile_lr_schedulers(self, train_loader, epochs):
+        if self._traier_state == TrainerState.FITTING:
+            epochs = self._train_engine_state['max_epochs']
+        iters_per_epoch = len(train_loader)
+        accumulation_steps = self._kwargs.get('accumulation_steps', 1)
+        if self.lr_step_on_iter:
+            num_steps, steps_per_epoch = epochs * iters_per_epoch // accumulation_steps, None
+        else:
+            num_steps, steps_per_epoch = epochs * iters_per_epoch, iters_per_epoch
+        self.lr_schedulers = [compile_schedule(lr_scheduler, num_steps, steps_per_epoch)
+                              for lr_scheduler in self.lr_schedulers]
+
+    def _set_epoch_start_iteration(self, engine):
+        self._epoch_start_iteration = engine.state.iteration
+
+    def _restore_iteration(self, engine, iteration):
+        # Ignite resumes an epoch at `epoch * epoch_length` iterations and counts the iterations
+        # of the epoch from there, so the real count is set once the epoch has started
+        restored = []
+
+        def restore(engine):
+            if not restored:
+                engine.state.iteration = self._epoch_start_iteration = iteration
+                restored.append(True)
+
+        engine.add_event_handler(Events.GET_BATCH_STARTED, restore)
+
     def _set_epochs(self, engine):
         self._epochs = engine.state.epoch
 
+    def _prefetch(self, loader):
+        # Stage the batches to the device ahead of the steps, unless `prefetch=False` is given
+        if not self._kwargs.get('prefetch', True):
+            return loader
+        return DevicePrefetcher(loader, self.device, self._kwargs.get('prefetch_transform'))
+
     @curry
     def log_metrics(self, engine: Engine, writer: Optional[SummaryWriter], stage: str):
+        # Metrics are reduced over all processes, so only rank 0 logs them
+        if not is_main_process():
+            return
         log_str = "%s %s - " % (
             datetime.now(timezone(timedelta(hours=8))).strftime("%H:%M:%S"), stage)
         metric_logs = []
@@ -198,15 +359,46 @@ class TrainerBase:
             save_freq: Optional[Union[int, Epochs, Iters]] = None,
             n_saved: int = 1,
             progress_bar: bool = False,
-            callbacks: Sequence[Callable] = ()):
+            callbacks: Sequence[Callable] = (),
+            resolution_schedule: Optional[ResolutionSchedule] = None,
+            saver: Optional[BaseSaveHandler] = None,
+            profile: bool = False,
+            profile_trace: Optional[Tuple[int, int]] = None):
+
+        train_loader = distribute_loader(train_loader)
+        if val_loader is not None:
+            val_loader = distribute_loader(val_loader)
 
         train_engine = self._create_train_engine()
         eval_engine = self._create_eval_engine()
 
+        if self._kwargs.get('compile_lr_schedule') and resolution_schedule is None:
+            # Epochs have the same length without a resolution schedule, so the schedules can be tabulated
+            self._compile_lr_schedulers(train_loader, epochs)
+
         if self._traier_state == TrainerState.FITTING:
             train_engine.load_state_dict(self._train_engine_state)
             eval_engine.load_state_dict(self._eval_engine_state)
 
+        if is_distributed():
+            train_engine.add_event_handler(
+                Events.EPOCH_STARTED, lambda engine: set_epoch(train_loader, engine.state.epoch))
+
+        if resolution_schedule is not None:
+            if self._traier_state == TrainerState.FITTING and self._resolution_schedule_state is not None:
+                # Iterations are not a multiple of the epoch length, so resume from the completed epoch
+                resolution_schedule.load_state_dict(self._resolution_schedule_state)
+                epoch = resolution_schedule.epoch
+                resolution_schedule.set_epoch(epoch + 1)
+                train_engine.load_state_dict({
+                    "epoch": epoch, "epoch_length": len(train_loader),
+                    "max_epochs": self._train_engine_state['max_epochs']})
+                if resolution_schedule.iteration is not None:
+                    self._restore_iteration(train_engine, resolution_schedule.iteration)
+            train_engine.add_event_handler(
+                Events.EPOCH_STARTED, self._set_epoch_start_iteration)
+            resolution_schedule.attach(train_engine, train_loader, self.writer)
+
         if not progress_bar:
             train_engine.add_event_handler(
                 Events.EPOCH_STARTED, self._log_epoch_start),
@@ -217,46 +409,69 @@ class TrainerBase:
         train_engine.add_event_handler(
             Events.EPOCH_COMPLETED, self.log_metrics(writer=self.writer, stage='train'))
 
-        if save_freq:
+        if save_freq and is_main_process():
             def global_step_transform(engine, event_name):
                 return engine.state.iteration if isinstance(save_freq, Iters) else engine.state.epoch
 
-            saver = DiskSaver(str(self.save_path), create_dir=True, require_empty=False)
+            if saver is None:
+                saver = DiskSaver(str(self.save_path), create_dir=True, require_empty=False)
             to_save = {**self.to_save(), "train_engine": train_engine, "eval_engine": eval_engine}
+            if resolution_schedule is not None:
+                to_save['resolution_schedule'] = resolution_schedule
 
             checkpoint_handler = Checkpoint(to_save, saver, n_saved=n_saved,
                                             global_step_transform=global_step_transform)
 
             train_engine.add_event_handler(get_event_by_freq(save_freq), checkpoint_handler)
+            if hasattr(saver, "wait"):
+                # Flush background writes before returning from fit
+                train_engine.add_event_handler(Events.COMPLETED, lambda _: saver.wait())
 
         if val_loader is not None:
+            val_data = self._prefetch(val_loader)
             train_engine.add_event_handler(
-                get_event_by_freq(eval_freq), lambda _: eval_engine.run(val_loader))
+                get_event_by_freq(eval_freq), lambda _: eval_engine.run(val_data))
             eval_engine.add_event_handler(
                 Events.EPOCH_COMPLETED, self.log_metrics(writer=self.writer, stage='valid'))
 
-        if progress_bar:
+        if progress_bar and is_main_process():
             self._attach_prograss_bar(train_engine)
 
         for callback in callbacks:
             train_engine.add_event_handler(
                 Events.ITERATION_COMPLETED, callback, self)
 
-        try:
-            max_epochs = epochs if self._traier_state == TrainerState.INIT else None
-            self._traier_state = TrainerState.FITTING
-            train_engine.run(train_loader, max_epochs)
-        except KeyboardInterrupt as e:
-            self._train_engine_state = train_engine.state_dict()
-            self._eval_engine_state = eval_engine.state_dict()
-            self._traier_state = TrainerState.FITTING
-            raise e
+        if profile:
+            # Attached last to time all the other handlers
+            log_freq = self._kwargs.get('log_freq', 10)
+            StepProfiler(self.device).attach(
+                train_engine, self.writer, 'train', log_freq=log_freq, verbose=is_main_process())
+            if val_loader is not None:
+                StepProfiler(self.device).attach(
+                    eval_engine, self.writer, 'valid', log_freq=0,
+                    global_step=lambda: train_engine.state.iteration, verbose=is_main_process())
+
+        with ExitStack() as stack:
+            if profile_trace and is_main_process():
+                prof = stack.enter_context(trace(self.log_path / "trace", *profile_trace))
+                train_engine.add_event_handler(Events.ITERATION_COMPLETED, lambda _: prof.step())
+
+            try:
+                max_epochs = epochs if self._traier_state == TrainerState.INIT else None
+                self._traier_state = TrainerState.FITTING
+                train_engine.run(self._prefetch(train_loader), max_epochs)
+            except KeyboardInterrupt as e:
+                self._train_engine_state = train_engine.state_dict()
+                self._eval_engine_state = eval_engine.state_dict()
+                self._traier_state = TrainerState.FITTING
+                raise e
 
     def evaluate(self, val_loader):
+        val_loader = distribute_loader(val_loader)
         eval_engine = self._create_eval_engine()
         eval_engine.add_event_handler(
             Events.EPOCH_COMPLETED, self.log_metrics(writer=None, stage='test'))
-        eval_engine.run(val_loader)
+        eval_engine.run(self._prefetch(val_loader))
 
 
 def get_event_by_freq(freq: Union[int, Epochs, Iters]):
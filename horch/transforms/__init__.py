@@ -1,5 +1,11 @@
+import os
+import threading
+import time
 import uuid
 import random
+from collections import defaultdict
+
+import numpy as np
 
 
 class Transform(object):
@@ -49,19 +55,127 @@ class TargetTransform(Transform):
 
 
 class Compose(Transform):
+    r"""
+    Compose joint and input transforms.
+
+    Parameters
+    ----------
+    transforms : ``list``
+        Transforms to apply in order. Instances of `Transform` are called with
+        (img, target), others only with img.
+    profiler : ``TransformProfiler``
+        If provided, time every transform and every call.
+    fuse : ``bool``
+        Whether to fuse runs of consecutive geometric transforms (those defining
+        `get_affine`, e.g. in horch.transforms.segmentation) into one affine warp
+        per sample. The output is equivalent up to interpolation error.
+    cache : ``MemoryCache`` or ``DiskCache`` or ``SharedMemoryCache``
+        If provided, cache outputs of the longest deterministic prefix of the transforms
+        (see horch.transforms.cache), and only run the rest live.
+    """
 
-    def __init__(self, transforms):
+    def __init__(self, transforms, profiler=None, fuse=False, cache=None):
         super().__init__()
         self.transforms = transforms
+        self.profiler = profiler
+        self.fuse = fuse
+        self.cache = cache
+        self._stages = fuse_affine(transforms) if fuse else transforms
+        self._n_cached = 0
+        if cache is not None:
+            from horch.transforms.cache import deterministic_prefix, fingerprint
+            self._n_cached = deterministic_prefix(self._stages)
+            self._namespace = fingerprint(self._stages[:self._n_cached])
 
     def __call__(self, img, target):
-        for t in self.transforms:
+        if self.profiler is not None:
+            return self._profiled_call(img, target)
+        if self._n_cached:
+            img, target = self._cached_prefix(img, target)
+        for t in self._stages[self._n_cached:]:
             if isinstance(t, Transform):
                 img, target = t(img, target)
             else:
                 img = t(img)
         return img, target
 
+    def _profiled_call(self, img, target):
+        start = time.perf_counter()
+        if self._n_cached:
+            img, target = self._cached_prefix(img, target)
+        for i in range(self._n_cached, len(self._stages)):
+            t = self._stages[i]
+            t_start = time.perf_counter()
+            if isinstance(t, Transform):
+                img, target = t(img, target)
+            else:
+                img = t(img)
+            self.profiler.record(transform_id(t, i), time.perf_counter() - t_start)
+        self.profiler.record(self._id, time.perf_counter() - start)
+        return img, target
+
+    def _cached_prefix(self, img, target):
+        from horch.transforms.cache import cache_key
+        key = cache_key(self._namespace, img, target)
+        out = self.cache.get(key)
+        if out is None:
+            for t in self._stages[:self._n_cached]:
+                if isinstance(t, Transform):
+                    img, target = t(img, target)
+                else:
+                    img = t(img)
+            out = img, target
+            self.cache.set(key, out)
+        return out
+
+
+class FusedAffine(Transform):
+    r"""
+    Consecutive geometric transforms applied as one affine warp. Random parameters
+    of the transforms are drawn in order, then the matrices are composed and
+    the image and the target are resampled once by `transforms[0].warp`. Pixels
+    that would fall outside of an intermediate output are filled as the transforms
+    would fill them, so the output only differs by interpolation.
+    """
+
+    def __init__(self, transforms):
+        super().__init__("FusedAffine")
+        self.transforms = transforms
+
+    def __call__(self, img, target):
+        size = img.size
+        matrix = np.eye(3)
+        windows = []
+        for i, t in enumerate(self.transforms):
+            if i:
+                windows.append((matrix, size))
+            m, size = t.get_affine(size)
+            matrix = matrix @ m
+        # Output to the coordinates of every intermediate output
+        windows = [(np.linalg.solve(prefix, matrix), window_size) for prefix, window_size in windows]
+        interpolations = [getattr(t, 'interpolation', None) for t in self.transforms]
+        return self.transforms[0].warp(img, target, matrix, size, windows, interpolations)
+
+
+def fuse_affine(transforms):
+    r"""
+    Replace runs of two or more geometric transforms in `transforms` with `FusedAffine`.
+    """
+    stages = []
+    run = []
+    for t in list(transforms) + [None]:
+        if t is not None and hasattr(t, 'get_affine'):
+            run.append(t)
+            continue
+        if len(run) > 1:
+            stages.append(FusedAffine(run))
+        else:
+            stages.extend(run)
+        run = []
+        if t is not None:
+            stages.append(t)
+    return stages
+
 
 class UseOriginal(Transform):
     """Use the original image and annotations.
@@ -119,3 +233,159 @@ def pprint(t, level=0, sep='    '):
     else:
         format_string += ')'
     return format_string
+
+
+def transform_id(t, index):
+    r"""
+    Id of the `index`-th transform `t` of a Compose. Transforms other than
+    `Transform` (e.g. torchvision transforms) are identified by their positions.
+    """
+    if isinstance(t, Transform):
+        return t._id
+    return "%s_%d" % (type(t).__name__, index)
+
+
+class ProfiledCompose(object):
+    """torchvision Compose with its transforms timed by `profiler`, called with img only."""
+
+    def __init__(self, transforms, profiler):
+        self._id = 'Compose_' + str(uuid.uuid4())[-6:]
+        self.transforms = transforms
+        self.profiler = profiler
+
+    def __call__(self, img):
+        start = time.perf_counter()
+        for i, t in enumerate(self.transforms):
+            t_start = time.perf_counter()
+            img = t(img)
+            self.profiler.record(transform_id(t, i), time.perf_counter() - t_start)
+        self.profiler.record(self._id, time.perf_counter() - start)
+        return img
+
+
+class TransformProfiler:
+    r"""
+    Record wall time of every transform of a Compose and every call of it.
+
+    Records made in DataLoader workers are sent back through a queue, which is
+    flushed every `flush_every` records and when the worker exits, and drained
+    continuously by a daemon thread of the main process, so that the workers never
+    block on a full pipe.
+
+    Examples:
+        >>> profiler = TransformProfiler()
+        >>> transform = profiler.profile(Compose([...]))
+        >>> ...
+        >>> profiler.attach(train_engine, writer)
+    """
+
+    def __init__(self, flush_every=64):
+        import multiprocessing as mp
+        self.flush_every = flush_every
+        self._queue = mp.get_context().SimpleQueue()
+        self._pid = os.getpid()
+        self._times = defaultdict(list)
+        self._buffer = defaultdict(list)
+        self._n_buffered = 0
+        self._finalizer = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def profile(self, transform):
+        r"""
+        Enable profiling of `transform`, which may be a horch or a torchvision Compose.
+        """
+        if isinstance(transform, Compose):
+            transform.profiler = self
+            return transform
+        return ProfiledCompose(transform.transforms, self)
+
+    def record(self, key, elapsed):
+        if os.getpid() == self._pid:
+            with self._lock:
+                self._times[key].append(elapsed)
+            return
+        if self._finalizer is None:
+            from multiprocessing.util import Finalize
+            self._finalizer = Finalize(self, self.flush, exitpriority=100)
+        self._buffer[key].append(elapsed)
+        self._n_buffered += 1
+        if self._n_buffered >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._n_buffered:
+            self._queue.put(dict(self._buffer))
+            self._buffer = defaultdict(list)
+            self._n_buffered = 0
+
+    def _drain(self):
+        while True:
+            records = self._queue.get()
+            with self._lock:
+                for key, times in records.items():
+                    self._times[key].extend(times)
+
+    def reset(self):
+        with self._lock:
+            self._times = defaultdict(list)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        r"""
+        Return a dict mapping transform ids to statistics (in seconds) of their calls.
+        """
+        with self._lock:
+            times_by_key = {key: list(times) for key, times in self._times.items()}
+        stats = {}
+        for key, times in times_by_key.items():
+            times = np.asarray(times)
+            stat = {"count": len(times), "total": float(times.sum()), "mean": float(times.mean())}
+            for p, v in zip(percentiles, np.percentile(times, percentiles)):
+                stat["p%d" % p] = float(v)
+            stats[key] = stat
+        return stats
+
+    def report(self, percentiles=(50, 90, 99)):
+        stats = self.summary(percentiles)
+        keys = ["count", "total", "mean"] + ["p%d" % p for p in percentiles]
+        format_string = "%-40s" % "transform" + "".join("%12s" % k for k in keys)
+        for key, stat in sorted(stats.items(), key=lambda x: -x[1]["total"]):
+            format_string += "\n" + "%-40s" % key[:40]
+            format_string += "%12d" % stat["count"] + "%11.3fs" % stat["total"]
+            format_string += "".join("%10.3fms" % (stat[k] * 1000) for k in keys[2:])
+        return format_string
+
+    def write(self, writer, step, percentiles=(50, 90, 99)):
+        for key, stat in self.summary(percentiles).items():
+            for k, v in stat.items():
+                if k != "count":
+                    v = v * 1000
+                writer.add_scalar("transforms/%s/%s" % (key, k), v, step)
+
+    def attach(self, engine, writer=None, every=1):
+        r"""
+        Print the report and write it to `writer` every `every` epochs of `engine`.
+        """
+        from ignite.engine import Events
+
+        def log(engine):
+            print(self.report())
+            if writer is not None:
+                self.write(writer, engine.state.epoch)
+
+        engine.add_event_handler(Events.EPOCH_COMPLETED(every=every), log)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_finalizer'] = None
+        state['_buffer'] = defaultdict(list)
+        state['_n_buffered'] = 0
+        state['_times'] = defaultdict(list)
+        state['_lock'] = None
+        state['_thread'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,222 @@
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+
+class MemoryCache:
+    r"""
+    Cache in the memory of the current process.
+
+    Note that DataLoader workers have their own copies of the cache, so it only
+    survives across epochs with `num_workers=0` or `persistent_workers=True`.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key):
+        data = self._data.get(key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value):
+        self._data[key] = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def clear(self):
+        self._data = {}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache:
+    r"""
+    Cache of pickled files under `root`, shared by all processes and kept across runs.
+
+    Parameters
+    ----------
+    root : ``str``
+        Directory of the cache.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def __len__(self):
+        return sum(len(files) for _, _, files in os.walk(self.root))
+
+
+class SharedMemoryCache(DiskCache):
+    r"""
+    DiskCache in /dev/shm, shared by all DataLoader workers without touching the disk.
+    Call `clear` or `close` to release the memory.
+
+    Parameters
+    ----------
+    name : ``str``
+        Name of the cache. A random one is used if not provided.
+    """
+
+    def __init__(self, name=None):
+        name = name or uuid.uuid4().hex[:8]
+        super().__init__(os.path.join("/dev/shm", "horch_cache_" + name))
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def get_cache(kind, root=None, name=None):
+    r"""
+    Create a cache by `kind`, one of "memory", "shm" (named `name`, random if not provided)
+    and "disk" (which requires `root`).
+    """
+    if kind == 'memory':
+        return MemoryCache()
+    elif kind == 'shm':
+        return SharedMemoryCache(name)
+    elif kind == 'disk':
+        return DiskCache(root)
+    raise ValueError("No cache named %s" % kind)
+
+
+def is_deterministic(t):
+    r"""
+    Whether transform `t` always gives the same output for the same input, decided by
+    its `deterministic` attribute or the registry in horch.core.catalog.transform.
+    """
+    flag = getattr(t, 'deterministic', None)
+    if flag is not None:
+        return flag
+    from horch.core.catalog.transform import deterministic_ops
+    return type(t) in deterministic_ops
+
+
+def deterministic_prefix(transforms, resizable=False):
+    r"""
+    Length of the longest deterministic prefix of `transforms`, ending before the first
+    transform with a `size` attribute if `resizable`.
+    """
+    n = 0
+    for t in transforms:
+        if not is_deterministic(t) or (resizable and hasattr(t, 'size')):
+            break
+        n += 1
+    return n
+
+
+def fingerprint(transforms):
+    r"""
+    A string identifying `transforms` by their types and attributes, stable across processes and runs.
+    """
+    parts = []
+    for t in transforms:
+        attrs = sorted((k, repr(v)) for k, v in vars(t).items() if k != '_id')
+        parts.append("%s.%s%s" % (type(t).__module__, type(t).__qualname__, attrs))
+    return "|".join(parts)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def sample_index(index):
+    r"""
+    Within this context, transform caches key the sample by `index` instead of
+    hashing its content. Used by horch.datasets.IndexedDataset.
+    """
+    _local.index = index
+    try:
+        yield
+    finally:
+        _local.index = None
+
+
+def cache_key(namespace, *inputs):
+    r"""
+    Key of `inputs` (PIL Images, tensors, arrays or annotations) to a pipeline identified
+    by `namespace`. The current sample index is used if set by `sample_index`, otherwise
+    the content of the inputs is hashed.
+    """
+    h = hashlib.blake2b(namespace.encode(), digest_size=16)
+    index = getattr(_local, 'index', None)
+    if index is not None:
+        h.update(repr(index).encode())
+    else:
+        h.update(pickle.dumps(inputs, protocol=pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
+
+class CachedCompose(object):
+    r"""
+    Compose of single-input transforms (e.g. torchvision transforms) whose
+    longest deterministic prefix is cached. Like a torchvision Compose, it is called
+    with img only.
+
+    The outputs of the prefix are keyed by the sample index if the dataset is wrapped
+    by horch.datasets.IndexedDataset, otherwise by the content of the input, which
+    costs a hash of the input per call.
+
+    Parameters
+    ----------
+    transforms : ``list``
+        Transforms to apply in order.
+    cache : ``MemoryCache`` or ``DiskCache`` or ``SharedMemoryCache``
+        Cache of the outputs of the deterministic prefix.
+    resizable : ``bool``
+        Whether the sizes of the transforms are changed later, e.g. by a ResolutionSchedule,
+        which ends the cached prefix before the first transform with a `size` attribute.
+    """
+
+    def __init__(self, transforms, cache, resizable=False):
+        self.transforms = transforms
+        self.cache = cache
+        self._n_cached = deterministic_prefix(transforms, resizable)
+        self._namespace = fingerprint(transforms[:self._n_cached])
+
+    @property
+    def cached(self):
+        r"""
+        The transforms whose outputs are cached.
+        """
+        return self.transforms[:self._n_cached]
+
+    def __call__(self, img):
+        if self._n_cached:
+            key = cache_key(self._namespace, img)
+            out = self.cache.get(key)
+            if out is None:
+                out = img
+                for t in self.transforms[:self._n_cached]:
+                    out = t(out)
+                self.cache.set(key, out)
+            img = out
+        for t in self.transforms[self._n_cached:]:
+            img = t(img)
+        return img
@@ -0,0 +1,397 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+from horch.transforms.classification.autoaugment import RANGES, IMAGENET_POLICIES, CIFAR10_POLICIES, SVHN_POLICIES
+
+__all__ = ["Compose", "Normalize", "AutoAugment", "Cutout", "RandomErasing", "RandomCrop",
+           "RandomHorizontalFlip", "batch_collate"]
+
+
+class Compose:
+    """Compose batch transforms, which take and return a batch of images (N, C, H, W).
+
+    Batch transforms run after collation, on the training device (see the `batch_transform`
+    of ``create_supervised_trainer``) or in the DataLoader workers (see ``batch_collate``).
+
+    Args:
+        transforms (list): Batch transforms to apply in order.
+    """
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + '('
+        for t in self.transforms:
+            format_string += '\n    {0}'.format(t)
+        format_string += '\n)'
+        return format_string
+
+
+class Normalize:
+    """Convert a uint8 batch to float in [0, 1] and normalize it with mean and std per channel.
+
+    Args:
+        mean (sequence): Means of the channels.
+        std (sequence): Standard deviations of the channels.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, x):
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255)
+        mean = x.new_tensor(self.mean).view(1, -1, 1, 1)
+        std = x.new_tensor(self.std).view(1, -1, 1, 1)
+        return (x - mean) / std
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
+
+
+def _box_mask(top, left, bottom, right, height, width):
+    # (N, K) boxes to (N, height, width) mask of the pixels in any of the boxes
+    rows = torch.arange(height, device=top.device)
+    cols = torch.arange(width, device=top.device)
+    in_rows = (rows >= top[..., None]) & (rows < bottom[..., None])
+    in_cols = (cols >= left[..., None]) & (cols < right[..., None])
+    return (in_rows[..., :, None] & in_cols[..., None, :]).any(dim=1)
+
+
+class Cutout:
+    """Randomly mask out one or more patches of every image in the batch.
+
+    Args:
+        n_holes (int): Number of patches to cut out of each image.
+        length (int): The length (in pixels) of each square patch.
+        value (float): Value of the masked pixels.
+    """
+
+    def __init__(self, n_holes, length, value=0):
+        self.n_holes = n_holes
+        self.length = length
+        self.value = value
+
+    def __call__(self, x):
+        n, _, h, w = x.shape
+        cy = torch.randint(h, (n, self.n_holes), device=x.device)
+        cx = torch.randint(w, (n, self.n_holes), device=x.device)
+        half = self.length // 2
+        mask = _box_mask(cy - half, cx - half, cy + half, cx + half, h, w)
+        return x.masked_fill(mask[:, None], self.value)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(n_holes={0}, length={1})'.format(self.n_holes, self.length)
+
+
+class RandomErasing:
+    """Randomly erase a rectangle of every image in the batch with probability p,
+    as torchvision's RandomErasing does per image.
+
+    Args:
+        p (float): Probability that an image is erased.
+        scale (tuple): Range of proportion of erased area against input image.
+        ratio (tuple): Range of aspect ratio of erased area.
+        value (float or str): Erasing value, or 'random' to erase with normal noise.
+        max_attempts (int): Number of attempts to find a rectangle inside the image.
+    """
+
+    def __init__(self, p=0.5, scale=(0.02, 0.33), ratio=(0.3, 3.3), value=0, max_attempts=10):
+        self.p = p
+        self.scale = scale
+        self.ratio = ratio
+        self.value = value
+        self.max_attempts = max_attempts
+
+    def __call__(self, x):
+        n, c, h, w = x.shape
+        device = x.device
+        k = self.max_attempts
+        areas = torch.empty(n, k, device=device).uniform_(*self.scale) * (h * w)
+        ratios = torch.empty(n, k, device=device).uniform_(*self.ratio)
+        eh = torch.sqrt(areas * ratios).round_().long()
+        ew = torch.sqrt(areas / ratios).round_().long()
+        valid = (eh < h) & (ew < w)
+
+        # The first valid attempt of each image
+        attempt = valid.long().argmax(dim=1, keepdim=True)
+        erase = valid.any(dim=1) & (torch.rand(n, device=device) < self.p)
+        eh = eh.gather(1, attempt)[:, 0]
+        ew = ew.gather(1, attempt)[:, 0]
+        top = (torch.rand(n, device=device) * (h - eh + 1)).long()
+        left = (torch.rand(n, device=device) * (w - ew + 1)).long()
+        mask = _box_mask(top[:, None], left[:, None], (top + eh)[:, None], (left + ew)[:, None], h, w)
+        mask &= erase[:, None, None]
+        mask = mask[:, None]
+        if self.value == 'random':
+            return torch.where(mask, torch.randn_like(x, dtype=torch.float).to(x.dtype), x)
+        return x.masked_fill(mask, self.value)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={0}, scale={1}, ratio={2}, value={3})'.format(
+            self.p, self.scale, self.ratio, self.value)
+
+
+class RandomCrop:
+    """Pad the batch and crop every image at its own random location.
+
+    Args:
+        size (int or tuple): Size (h, w) of the crops.
+        padding (int): Padding on each border.
+        fill (float): Value of the padded pixels if padding_mode is constant.
+        padding_mode (str): constant, reflect or replicate.
+    """
+
+    def __init__(self, size, padding=0, fill=0, padding_mode='constant'):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.padding = padding
+        self.fill = fill
+        self.padding_mode = padding_mode
+
+    def __call__(self, x):
+        if self.padding:
+            p = self.padding
+            if self.padding_mode == 'constant':
+                x = F.pad(x, (p, p, p, p), value=self.fill)
+            else:
+                x = F.pad(x.float(), (p, p, p, p), mode=self.padding_mode).to(x.dtype)
+        n, c, h, w = x.shape
+        th, tw = self.size
+        top = torch.randint(h - th + 1, (n, 1), device=x.device)
+        left = torch.randint(w - tw + 1, (n, 1), device=x.device)
+        rows = top + torch.arange(th, device=x.device)
+        cols = left + torch.arange(tw, device=x.device)
+        index = (rows[:, :, None] * w + cols[:, None, :]).view(n, 1, th * tw).expand(n, c, th * tw)
+        return x.reshape(n, c, h * w).gather(2, index).view(n, c, th, tw)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0}, padding={1})'.format(self.size, self.padding)
+
+
+class RandomHorizontalFlip:
+    """Horizontally flip every image in the batch with probability p.
+
+    Args:
+        p (float): Probability of an image being flipped.
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = torch.rand(x.size(0), device=x.device) < self.p
+        return torch.where(flip[:, None, None, None], x.flip(3), x)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
+
+
+POLICIES = {
+    "imagenet": IMAGENET_POLICIES,
+    "cifar10": CIFAR10_POLICIES,
+    "svhn": SVHN_POLICIES,
+}
+
+OPS = ["shearX", "shearY", "translateX", "translateY", "rotate", "color", "posterize",
+       "solarize", "contrast", "sharpness", "brightness", "autocontrast", "equalize", "invert"]
+
+# Operations whose magnitudes are negated with probability 0.5, as in SubPolicy
+SIGNED_OPS = ["shearX", "shearY", "translateX", "translateY", "color", "contrast", "sharpness", "brightness"]
+
+
+class AutoAugment:
+    """Batched AutoAugment with the policies of ``CIFAR10Policy``, ``ImageNetPolicy`` and ``SVHNPolicy``.
+
+    Each sample draws its own sub-policy, and the two operations of the sub-policy are applied
+    with their probabilities and random signs as ``SubPolicy`` does. Every operation is
+    applied at once to all the samples selecting it, on the device of the batch.
+
+    Args:
+        policy (str): One of "cifar10", "imagenet" and "svhn".
+        fillcolor (tuple): Color of the pixels outside of the transformed images.
+
+    Inputs:
+        x (Tensor): uint8 images of size (N, C, H, W).
+
+    Examples:
+        >>> batch_transform = Compose([
+        >>>     AutoAugment("cifar10"),
+        >>>     Normalize((0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261)),
+        >>> ])
+    """
+
+    def __init__(self, policy="cifar10", fillcolor=(128, 128, 128)):
+        self.policy = policy
+        self.fillcolor = fillcolor
+        policies = POLICIES[policy]
+        self._probs = torch.tensor([[p[0], p[3]] for p in policies], dtype=torch.float32)
+        self._ops = torch.tensor([[OPS.index(p[1]), OPS.index(p[4])] for p in policies])
+        self._magnitudes = torch.tensor(
+            [[float(RANGES[p[1]][p[2]]), float(RANGES[p[4]][p[5]])] for p in policies], dtype=torch.float32)
+        self._signed = torch.tensor([op in SIGNED_OPS for op in OPS])
+
+    def __call__(self, x):
+        assert x.dtype == torch.uint8, "AutoAugment expects uint8 images"
+        device = x.device
+        n = x.size(0)
+        policy = torch.randint(len(self._probs), (n,), device=device)
+        probs = self._probs.to(device)[policy]
+        ops = self._ops.to(device)[policy]
+        magnitudes = self._magnitudes.to(device)[policy]
+        signs = torch.randint(2, (n, 2), device=device) * 2 - 1
+        magnitudes = torch.where(self._signed.to(device)[ops], magnitudes * signs, magnitudes)
+        applied = torch.rand(n, 2, device=device) < probs
+
+        x = x.float()
+        for stage in range(2):
+            stage_ops = torch.where(applied[:, stage], ops[:, stage], ops.new_tensor(-1))
+            for op in stage_ops.unique().tolist():
+                if op < 0:
+                    continue
+                idx = (stage_ops == op).nonzero(as_tuple=True)[0]
+                fn = getattr(self, "_" + OPS[op])
+                x[idx] = fn(x[idx], magnitudes[idx, stage]).clamp_(0, 255)
+        return x.to(torch.uint8)
+
+    def _fill(self, x):
+        return x.new_tensor(self.fillcolor[:x.size(1)]).view(1, -1, 1, 1)
+
+    def _affine(self, x, matrix, mode):
+        # matrix: (n, 2, 3) from output to input pixel coordinates, as PIL's Image.transform
+        n, c, h, w = x.shape
+        ys, xs = torch.meshgrid(
+            torch.arange(h, device=x.device, dtype=x.dtype) + 0.5,
+            torch.arange(w, device=x.device, dtype=x.dtype) + 0.5, indexing='ij')
+        coords = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, h * w, 3)
+        coords = coords @ matrix.transpose(1, 2)
+        grid = coords / coords.new_tensor([w / 2, h / 2]) - 1
+        fill = self._fill(x)
+        x = F.grid_sample(x - fill, grid.view(n, h, w, 2), mode=mode, padding_mode='zeros', align_corners=False)
+        return x + fill
+
+    def _shear(self, x, m, axis, mode):
+        matrix = torch.zeros(len(m), 2, 3, device=x.device)
+        matrix[:, 0, 0] = 1
+        matrix[:, 1, 1] = 1
+        matrix[:, axis, 1 - axis] = m
+        return self._affine(x, matrix, mode)
+
+    def _shearX(self, x, m):
+        return self._shear(x, m, 0, 'bicubic').round_()
+
+    def _shearY(self, x, m):
+        return self._shear(x, m, 1, 'bicubic').round_()
+
+    def _translate(self, x, t, axis):
+        matrix = torch.zeros(len(t), 2, 3, device=x.device)
+        matrix[:, 0, 0] = 1
+        matrix[:, 1, 1] = 1
+        matrix[:, axis, 2] = t * x.size(3 - axis)
+        return self._affine(x, matrix, 'nearest')
+
+    def _translateX(self, x, m):
+        return self._translate(x, m, 0)
+
+    def _translateY(self, x, m):
+        return self._translate(x, m, 1)
+
+    def _rotate(self, x, m):
+        # Same as PIL's Image.rotate, counter-clockwise around the center
+        h, w = x.shape[2:]
+        a = -m * (math.pi / 180)
+        cos, sin = torch.cos(a), torch.sin(a)
+        cx, cy = w / 2, h / 2
+        matrix = torch.stack([
+            torch.stack([cos, sin, cx - cos * cx - sin * cy], dim=1),
+            torch.stack([-sin, cos, cy + sin * cx - cos * cy], dim=1),
+        ], dim=1)
+        return self._affine(x, matrix, 'nearest')
+
+    @staticmethod
+    def _blend(degenerate, x, factor):
+        # Same as PIL's Image.blend used by ImageEnhance
+        factor = factor.view(-1, 1, 1, 1)
+        return (degenerate + factor * (x - degenerate)).floor_()
+
+    @staticmethod
+    def _grayscale(x):
+        if x.size(1) == 1:
+            return x
+        weights = x.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+        return (x * weights).sum(dim=1, keepdim=True).round_()
+
+    def _color(self, x, m):
+        return self._blend(self._grayscale(x).expand_as(x), x, 1 + m)
+
+    def _contrast(self, x, m):
+        mean = self._grayscale(x).mean(dim=(1, 2, 3), keepdim=True).add_(0.5).floor_()
+        return self._blend(mean.expand_as(x), x, 1 + m)
+
+    def _sharpness(self, x, m):
+        c = x.size(1)
+        kernel = x.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]).div_(13).expand(c, 1, 3, 3)
+        smooth = x.clone()
+        smooth[:, :, 1:-1, 1:-1] = F.conv2d(x, kernel, groups=c).round_()
+        return self._blend(smooth, x, 1 + m)
+
+    def _brightness(self, x, m):
+        return self._blend(torch.zeros_like(x), x, 1 + m)
+
+    def _posterize(self, x, m):
+        step = (2 ** (8 - m)).view(-1, 1, 1, 1)
+        return torch.div(x, step, rounding_mode='floor') * step
+
+    def _solarize(self, x, m):
+        return torch.where(x >= m.view(-1, 1, 1, 1), 255 - x, x)
+
+    def _autocontrast(self, x, m):
+        lo = x.amin(dim=(2, 3), keepdim=True)
+        hi = x.amax(dim=(2, 3), keepdim=True)
+        scale = 255 / (hi - lo).clamp_(min=1)
+        out = ((x - lo) * scale).floor_()
+        return torch.where(hi > lo, out, x)
+
+    def _equalize(self, x, m):
+        # Same as PIL's ImageOps.equalize, per channel
+        n, c, h, w = x.shape
+        flat = x.reshape(n * c, h * w).long()
+        hist = torch.zeros(n * c, 256, device=x.device).scatter_add_(1, flat, torch.ones_like(x).reshape(n * c, -1))
+        bins = torch.arange(256, device=x.device).expand_as(hist)
+        last = torch.where(hist > 0, bins, torch.zeros_like(bins)).amax(dim=1, keepdim=True)
+        step = torch.div(h * w - hist.gather(1, last), 255, rounding_mode='floor')
+        cum = hist.cumsum(dim=1) - hist
+        lut = torch.div(torch.div(step, 2, rounding_mode='floor') + cum, step.clamp(min=1), rounding_mode='floor')
+        lut = torch.where(step > 0, lut.clamp_(max=255), bins.float())
+        return lut.gather(1, flat).view(n, c, h, w)
+
+    def _invert(self, x, m):
+        return 255 - x
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(policy={0}, fillcolor={1})'.format(self.policy, self.fillcolor)
+
+
+def batch_collate(transform):
+    """Collate function applying `transform` to the collated images, so that a batch
+    transform runs vectorized on CPU in the DataLoader workers.
+
+    Examples:
+        >>> DataLoader(ds, batch_size=128, num_workers=2, collate_fn=batch_collate(AutoAugment("cifar10")))
+    """
+
+    def collate(batch):
+        x, y = default_collate(batch)
+        with torch.no_grad():
+            return transform(x), y
+
+    return collate
@@ -10,36 +10,22 @@ from torchvision.transforms import ColorJitter
 
 from horch.transforms import JointTransform, Compose, InputTransform, RandomChoice, RandomApply, UseOriginal
 from horch.transforms.detection import functional as HF
-
-
-class BoxList:
-    def __init__(self, boxes):
-        super().__init__()
-        self.boxes = boxes
-
-    def __len__(self):
-        return len(self.boxes)
-
-    def __getitem__(self, item):
-        return self.boxes[item]
-
-    def __iter__(self):
-        return iter(self.boxes)
-
-    def __repr__(self):
-        return repr(self.boxes)
+from horch.transforms.detection.boxlist import BoxList, to_boxlist
 
 
 class ToTensor(JointTransform):
+    deterministic = True
 
     def __init__(self):
         super().__init__()
 
     def __call__(self, img, anns):
-        return VF.to_tensor(img), BoxList(anns)
+        return VF.to_tensor(img), to_boxlist(anns)
 
 
 class SubtractMeans(JointTransform):
+    deterministic = True
+
     def __init__(self, mean=(123, 117, 104)):
         super().__init__()
         self.mean = mean
@@ -248,6 +234,8 @@ class Resize(JointTransform):
         (output_size * width / height, output_size)
     """
 
+    deterministic = True
+
     def __init__(self, size):
         super().__init__()
         self.size = size
@@ -279,6 +267,8 @@ class CenterCrop(JointTransform):
         a square crop (size, size) is made.
     """
 
+    deterministic = True
+
     def __init__(self, size):
         super().__init__()
         self.size = size
@@ -288,8 +278,8 @@ class CenterCrop(JointTransform):
             size = self.size[::-1]
         else:
             size = self.size
+        anns = HF.center_crop(anns, img.size, size)
         img = VF.center_crop(img, size)
-        anns = HF.center_crop(anns, self.size)
         return img, anns
 
     def __repr__(self):
@@ -297,6 +287,7 @@ class CenterCrop(JointTransform):
 
 
 class ToPercentCoords(JointTransform):
+    deterministic = True
 
     def __init__(self):
         super().__init__()
@@ -309,6 +300,7 @@ class ToPercentCoords(JointTransform):
 
 
 class ToAbsoluteCoords(JointTransform):
+    deterministic = True
 
     def __init__(self):
         super().__init__()
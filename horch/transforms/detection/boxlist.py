@@ -0,0 +1,111 @@
+import numpy as np
+
+
+class BoxList:
+    r"""
+    Annotations of objects in an image, stored as parallel arrays.
+
+    Parameters
+    ----------
+    bboxes : ``array_like``
+        (N, 4) bounding boxes of [l, t, w, h].
+    labels : ``array_like``
+        (N,) category ids.
+    areas : ``array_like``
+        (N,) areas of the objects, or None if not annotated. They are kept as they are by
+        the box transforms, like the other fields.
+    iscrowd : ``array_like``
+        (N,) crowd flags, or None if not annotated.
+    extras : ``array_like``
+        (N,) object array of dicts containing the other fields of the annotations,
+        e.g. `segmentation` and `image_id`.
+    """
+
+    def __init__(self, bboxes, labels=None, areas=None, iscrowd=None, extras=None):
+        super().__init__()
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        n = len(bboxes)
+        self.bboxes = bboxes
+        self.labels = np.zeros(n, dtype=np.int64) if labels is None else np.asarray(labels, dtype=np.int64)
+        self.areas = None if areas is None else np.asarray(areas, dtype=np.float64)
+        self.iscrowd = None if iscrowd is None else np.asarray(iscrowd, dtype=np.int64)
+        if extras is None:
+            extras = np.empty(n, dtype=object)
+            extras[:] = [{} for _ in range(n)]
+        self.extras = extras
+
+    @classmethod
+    def from_anns(cls, anns):
+        r"""
+        Create from a sequence of COCO-style annotation dicts, containing `bbox` of [l, t, w, h]
+        and optionally `category_id`, `area` and `iscrowd`. `area` and `iscrowd` are stored
+        as arrays if all the annotations have them, otherwise with the other fields.
+        """
+        n = len(anns)
+        bboxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(n, 4)
+        labels = np.array([ann.get('category_id', 0) for ann in anns], dtype=np.int64)
+        fields = ["bbox", "category_id"]
+        areas = iscrowd = None
+        if all('area' in ann for ann in anns):
+            areas = np.array([ann['area'] for ann in anns], dtype=np.float64)
+            fields.append("area")
+        if all('iscrowd' in ann for ann in anns):
+            iscrowd = np.array([ann['iscrowd'] for ann in anns], dtype=np.int64)
+            fields.append("iscrowd")
+        extras = np.empty(n, dtype=object)
+        extras[:] = [{k: v for k, v in ann.items() if k not in fields} for ann in anns]
+        return cls(bboxes, labels, areas, iscrowd, extras)
+
+    def to_anns(self):
+        return [self._ann(i) for i in range(len(self))]
+
+    def _ann(self, i):
+        ann = {
+            **self.extras[i],
+            "bbox": self.bboxes[i].tolist(),
+            "category_id": int(self.labels[i]),
+        }
+        if self.areas is not None:
+            ann["area"] = float(self.areas[i])
+        if self.iscrowd is not None:
+            ann["iscrowd"] = int(self.iscrowd[i])
+        return ann
+
+    def replace(self, bboxes):
+        r"""
+        Return a new BoxList with `bboxes` and the other fields of this one.
+        """
+        return BoxList(bboxes, self.labels, self.areas, self.iscrowd, self.extras)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self._ann(item)
+        if isinstance(item, (list, tuple)):
+            # A list of bools is a mask, and an empty list selects nothing
+            item = np.asarray(item)
+            if item.dtype != np.bool_:
+                item = item.astype(np.int64)
+        return BoxList(self.bboxes[item], self.labels[item], _take(self.areas, item),
+                       _take(self.iscrowd, item), self.extras[item])
+
+    def __iter__(self):
+        return (self._ann(i) for i in range(len(self)))
+
+    def __repr__(self):
+        return repr(self.to_anns())
+
+
+def _take(x, item):
+    return None if x is None else x[item]
+
+
+def to_boxlist(anns):
+    r"""
+    Convert a sequence of annotation dicts to BoxList, and return BoxList as it is.
+    """
+    if isinstance(anns, BoxList):
+        return anns
+    return BoxList.from_anns(anns)
@@ -1,12 +1,11 @@
 from typing import List, Dict, Sequence, Union, Tuple
 from numbers import Number
-import random
 
 import numpy as np
 from toolz import curry
-from toolz.curried import get
 
 from horch.common import tuplify
+from horch.transforms.detection.boxlist import to_boxlist
 
 __all__ = [
     "resize", "resized_crop", "center_crop", "drop_boundary_bboxes",
@@ -49,6 +48,39 @@ def iou_1m(box, boxes):
     return iou
 
 
+def iou_mn(boxes1, boxes2):
+    r"""
+    Calculates many-to-many ious.
+
+    Parameters
+    ----------
+    boxes1 : ``array_like``
+        (M, 4) bounding boxes of [l, t, r, b].
+    boxes2 : ``array_like``
+        (N, 4) bounding boxes of [l, t, r, b].
+
+    Returns
+    -------
+    ious : ``array_like``
+        (M, N) IoUs between boxes1 and boxes2.
+    """
+    boxes1 = boxes1[:, None, :]
+    xi1 = np.maximum(boxes1[..., 0], boxes2[..., 0])
+    yi1 = np.maximum(boxes1[..., 1], boxes2[..., 1])
+    xi2 = np.minimum(boxes1[..., 2], boxes2[..., 2])
+    yi2 = np.minimum(boxes1[..., 3], boxes2[..., 3])
+    xdiff = xi2 - xi1
+    ydiff = yi2 - yi1
+    inter_area = xdiff * ydiff
+    boxes1_area = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    boxes2_area = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    union_area = boxes1_area + boxes2_area - inter_area
+
+    iou = inter_area / union_area
+    iou[(xdiff < 0) | (ydiff < 0)] = 0
+    return iou
+
+
 def random_sample_crop(anns, size, min_iou, min_ar, max_ar, max_attemps=50):
     """
     Crop the given PIL Image to random size and aspect ratio.
@@ -60,8 +92,8 @@ def random_sample_crop(anns, size, min_iou, min_ar, max_ar, max_attemps=50):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     min_iou : ``float``
@@ -74,34 +106,36 @@ def random_sample_crop(anns, size, min_iou, min_ar, max_ar, max_attemps=50):
         Maximum attemps to try.
     """
     width, height = size
-    bboxes = np.stack([ann['bbox'] for ann in anns])
+    anns = to_boxlist(anns)
+    if len(anns) == 0:
+        return None
+    bboxes = anns.bboxes.copy()
     bboxes[:, 2:] += bboxes[:, :2]
-    for _ in range(max_attemps):
-        w = random.uniform(0.3 * width, width)
-        h = random.uniform(0.3 * height, height)
 
-        if h / w < min_ar or h / w > max_ar:
-            continue
+    # All attempts are sampled at once and the first valid one is taken,
+    # which has the same distribution as trying them one by one.
+    w = np.random.uniform(0.3 * width, width, max_attemps)
+    h = np.random.uniform(0.3 * height, height, max_attemps)
+    l = np.random.uniform(0, width - w)
+    t = np.random.uniform(0, height - h)
+    r = l + w
+    b = t + h
 
-        l = random.uniform(0, width - w)
-        t = random.uniform(0, height - h)
-        r = l + w
-        b = t + h
+    valid = (h / w >= min_ar) & (h / w <= max_ar)
 
-        patch = np.array([l, t, r, b])
-        ious = iou_1m(patch, bboxes)
-        if ious.min() < min_iou:
-            continue
+    patches = np.stack([l, t, r, b], axis=1)
+    ious = iou_mn(patches, bboxes)
+    valid &= ious.min(axis=1) >= min_iou
 
-        centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2.0
-        mask = (l < centers[:, 0]) & (centers[:, 0] < r) & (
-                t < centers[:, 1]) & (centers[:, 1] < b)
+    centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2.0
+    mask = (l[:, None] < centers[:, 0]) & (centers[:, 0] < r[:, None]) & (
+            t[:, None] < centers[:, 1]) & (centers[:, 1] < b[:, None])
+    valid &= mask.any(axis=1)
 
-        if not mask.any():
-            continue
-        indices = np.nonzero(mask)[0].tolist()
-        return get(indices, anns), l, t, w, h
-    return None
+    if not valid.any():
+        return None
+    i = np.argmax(valid)
+    return anns[mask[i]], float(l[i]), float(t[i]), float(w[i]), float(h[i])
 
 
 @curry
@@ -117,24 +151,22 @@ def resized_crop(anns, left, upper, width, height, output_size, min_area_frac):
 @curry
 def drop_boundary_bboxes(anns, size):
     r"""
-    Drop bounding boxes whose centers are out of the image boundary.
+    Drop bounding boxes whose centers (l + w / 2, t + h / 2) are out of the image boundary.
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     width, height = size
-    new_anns = []
-    for ann in anns:
-        l, t, w, h = ann['bbox']
-        x = (l + w) / 2.
-        y = (t + h) / 2.
-        if 0 <= x <= width and 0 <= y <= height:
-            new_anns.append({**ann, "bbox": [l, t, w, h]})
-    return new_anns
+    anns = to_boxlist(anns)
+    bboxes = anns.bboxes
+    x = bboxes[:, 0] + bboxes[:, 2] / 2.
+    y = bboxes[:, 1] + bboxes[:, 3] / 2.
+    mask = (0 <= x) & (x <= width) & (0 <= y) & (y <= height)
+    return anns[mask]
 
 
 @curry
@@ -144,8 +176,8 @@ def center_crop(anns, size, output_size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     output_size : ``Union[Number, Sequence[int]]``
@@ -158,7 +190,7 @@ def center_crop(anns, size, output_size):
     th, tw = output_size
     upper = int(round((h - th) / 2.))
     left = int(round((w - tw) / 2.))
-    return crop(anns, left, upper, th, tw)
+    return crop(anns, left, upper, tw, th)
 
 
 @curry
@@ -168,8 +200,8 @@ def crop(anns, left, upper, width, height, minimal_area_fraction=0.25):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     left: ``int``
         Left pixel coordinate.
     upper: ``int``
@@ -181,25 +213,20 @@ def crop(anns, left, upper, width, height, minimal_area_fraction=0.25):
     minimal_area_fraction : ``int``
         Minimal area fraction requirement.
     """
-    new_anns = []
-    for ann in anns:
-        l, t, w, h = ann['bbox']
-        area = w * h
-        l -= left
-        t -= upper
-        if l + w >= 0 and l <= width and t + h >= 0 and t <= height:
-            if l < 0:
-                w += l
-                l = 0
-            if t < 0:
-                h += t
-                t = 0
-            w = min(width - l, w)
-            h = min(height - t, h)
-            if w * h < area * minimal_area_fraction:
-                continue
-            new_anns.append({**ann, "bbox": [l, t, w, h]})
-    return new_anns
+    anns = to_boxlist(anns)
+    l, t, w, h = anns.bboxes.T
+    area = w * h
+    l = l - left
+    t = t - upper
+    keep = (l + w >= 0) & (l <= width) & (t + h >= 0) & (t <= height)
+    w = np.where(l < 0, w + l, w)
+    h = np.where(t < 0, h + t, h)
+    l = np.maximum(l, 0)
+    t = np.maximum(t, 0)
+    w = np.minimum(width - l, w)
+    h = np.minimum(height - t, h)
+    keep &= w * h >= area * minimal_area_fraction
+    return anns.replace(np.stack([l, t, w, h], axis=1))[keep]
 
 
 @curry
@@ -207,8 +234,8 @@ def resize(anns, size, output_size):
     """
     Parameters
     ----------
-    anns : List[Dict]
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : Union[BoxList, List[Dict]]
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : Sequence[int]
         Size of the original image.
     output_size : Union[Number, Sequence[int]]
@@ -218,6 +245,7 @@ def resize(anns, size, output_size):
         (output_size * width / height, output_size)
     """
     w, h = size
+    anns = to_boxlist(anns)
     if isinstance(output_size, int):
         if (w <= h and w == output_size) or (h <= w and h == output_size):
             return anns
@@ -231,15 +259,7 @@ def resize(anns, size, output_size):
         ow, oh = output_size
         sw = ow / w
         sh = oh / h
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[0] *= sw
-        bbox[1] *= sh
-        bbox[2] *= sw
-        bbox[3] *= sh
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    return anns.replace(anns.bboxes * [sw, sh, sw, sh])
 
 
 @curry
@@ -249,21 +269,14 @@ def to_percent_coords(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[0] /= w
-        bbox[1] /= h
-        bbox[2] /= w
-        bbox[3] /= h
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    return anns.replace(anns.bboxes / [w, h, w, h])
 
 
 @curry
@@ -273,21 +286,14 @@ def to_absolute_coords(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[0] *= w
-        bbox[1] *= h
-        bbox[2] *= w
-        bbox[3] *= h
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    return anns.replace(anns.bboxes * [w, h, w, h])
 
 
 @curry
@@ -297,18 +303,16 @@ def hflip(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[0] = w - (bbox[0] + bbox[2])
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    bboxes = anns.bboxes.copy()
+    bboxes[:, 0] = w - (bboxes[:, 0] + bboxes[:, 2])
+    return anns.replace(bboxes)
 
 
 @curry
@@ -318,20 +322,17 @@ def hflip2(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, r, b].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, r, b].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        l = bbox[0]
-        bbox[0] = w - bbox[2]
-        bbox[2] = w - l
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    bboxes = anns.bboxes.copy()
+    bboxes[:, 0] = w - anns.bboxes[:, 2]
+    bboxes[:, 2] = w - anns.bboxes[:, 0]
+    return anns.replace(bboxes)
 
 
 @curry
@@ -341,18 +342,16 @@ def vflip(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[1] = h - (bbox[1] + bbox[3])
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    bboxes = anns.bboxes.copy()
+    bboxes[:, 1] = h - (bboxes[:, 1] + bboxes[:, 3])
+    return anns.replace(bboxes)
 
 
 @curry
@@ -362,21 +361,17 @@ def vflip2(anns, size):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     size : ``Sequence[int]``
         Size of the original image.
     """
     w, h = size
-
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        t = bbox[1]
-        bbox[1] = h - bbox[3]
-        bbox[3] = h - t
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
+    anns = to_boxlist(anns)
+    bboxes = anns.bboxes.copy()
+    bboxes[:, 1] = h - anns.bboxes[:, 3]
+    bboxes[:, 3] = h - anns.bboxes[:, 1]
+    return anns.replace(bboxes)
 
 
 @curry
@@ -386,19 +381,12 @@ def move(anns, x, y):
 
     Parameters
     ----------
-    anns : ``List[Dict]``
-        Sequences of annotation of objects, containing `bbox` of [l, t, w, h].
+    anns : ``Union[BoxList, List[Dict]]``
+        Annotations of objects, containing `bbox` of [l, t, w, h].
     x : ``Number``
         How many to move along the horizontal axis.
     y : ``Number``
         How many to move along the vertical axis.
     """
-
-    new_anns = []
-    for ann in anns:
-        bbox = list(ann['bbox'])
-        bbox[0] += x
-        bbox[1] += y
-        new_anns.append({**ann, "bbox": bbox})
-    return new_anns
-
+    anns = to_boxlist(anns)
+    return anns.replace(anns.bboxes + [x, y, 0, 0])
@@ -6,8 +6,6 @@ import math
 
 import torch
 import numpy as np
-from scipy.ndimage.interpolation import map_coordinates
-from scipy.ndimage.filters import gaussian_filter
 
 import torchvision.transforms.functional as TF
 from PIL import Image
@@ -27,10 +25,147 @@ class SameTransform(JointTransform):
         return self.t(img), self.t(mask)
 
 
+class GeometricTransform(JointTransform):
+    """Base class of joint transforms that are affine maps of the image and the mask.
+
+    Subclasses implement ``get_affine``, which draws the random parameters and returns
+    the matrix mapping output coordinates to input coordinates, and set ``interpolation``
+    to (image, label) interpolations if they resample. ``horch.transforms.Compose``
+    with ``fuse=True`` composes the matrices of consecutive geometric transforms and
+    resamples the image and the mask only once.
+    """
+
+    interpolation = None
+
+    def get_affine(self, size):
+        """
+        Args:
+            size (tuple): (w, h) of the input image.
+
+        Returns:
+            tuple: (matrix, size), the 3x3 matrix mapping output to input coordinates
+                and (w, h) of the output image.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def warp(img, mask, matrix, size, windows=(), interpolations=()):
+        """Apply `matrix` to the image and the mask, as the transforms would one after another.
+
+        Args:
+            matrix (ndarray): 3x3 matrix mapping output to input coordinates.
+            size (tuple): (w, h) of the output.
+            windows (sequence): (matrix, (w, h)) of every intermediate output, the matrix
+                mapping the output to its coordinates. Pixels outside of any of them are
+                filled with 0 in the image and the mask, as the transforms would.
+            interpolations (sequence): (image, label) interpolations of the transforms
+                which resample, or None. The most precise of those supported by affine
+                transforms (nearest, bilinear and bicubic) is used for the image, and the
+                label interpolation if all agree, otherwise nearest.
+        """
+        image_resample, label_resample = _fused_interpolation(interpolations)
+        if np.allclose(matrix[:2, :2], np.eye(2)) and np.allclose(matrix[:2, 2], np.round(matrix[:2, 2])):
+            l, t = int(round(matrix[0, 2])), int(round(matrix[1, 2]))
+            if not ((l, t) == (0, 0) and size == img.size):
+                box = (l, t, l + size[0], t + size[1])
+                img, mask = img.crop(box), mask.crop(box)
+        else:
+            data = tuple(matrix[:2].ravel())
+            mask = mask.transform(size, Image.AFFINE, data, resample=label_resample)
+            img, matrix = _antialias(img, matrix, size, image_resample)
+            data = tuple(matrix[:2].ravel())
+            img = img.transform(size, Image.AFFINE, data, resample=image_resample)
+        invalid = _invalid_mask(windows, size)
+        if invalid is not None:
+            invalid = Image.fromarray(invalid.astype(np.uint8) * 255)
+            img, mask = img.copy(), mask.copy()
+            img.paste(0, None, invalid)
+            mask.paste(0, None, invalid)
+        return img, mask
+
+
+_AFFINE_RESAMPLE = {
+    Image.NEAREST: Image.NEAREST,
+    Image.BOX: Image.BILINEAR,
+    Image.BILINEAR: Image.BILINEAR,
+    Image.HAMMING: Image.BILINEAR,
+    Image.BICUBIC: Image.BICUBIC,
+    Image.LANCZOS: Image.BICUBIC,
+}
+_AFFINE_RESAMPLE_ORDER = [Image.NEAREST, Image.BILINEAR, Image.BICUBIC]
+
+
+def _fused_interpolation(interpolations):
+    interpolations = [i for i in interpolations if i is not None]
+    if not interpolations:
+        return Image.BILINEAR, Image.NEAREST
+    image = max((_AFFINE_RESAMPLE[i] for i, _ in interpolations), key=_AFFINE_RESAMPLE_ORDER.index)
+    labels = {l for _, l in interpolations}
+    label = _AFFINE_RESAMPLE[labels.pop()] if len(labels) == 1 else Image.NEAREST
+    return image, label
+
+
+def _antialias(img, matrix, size, resample):
+    # The affine transform samples the input without a filter, so when it downscales,
+    # first resize (with antialiasing) the region it samples to about the output scale.
+    fx = math.hypot(matrix[0, 0], matrix[0, 1])
+    fy = math.hypot(matrix[1, 0], matrix[1, 1])
+    if max(fx, fy) <= 1 or resample == Image.NEAREST:
+        return img, matrix
+    w, h = size
+    corners = matrix[:2] @ np.array([[0, w, w, 0], [0, 0, h, h], [1, 1, 1, 1]])
+    l, t = max(math.floor(corners[0].min()) - 1, 0), max(math.floor(corners[1].min()) - 1, 0)
+    r, b = min(math.ceil(corners[0].max()) + 1, img.width), min(math.ceil(corners[1].max()) + 1, img.height)
+    if r <= l or b <= t:
+        return img, matrix
+    cw, ch = r - l, b - t
+    nw, nh = max(int(round(cw / max(fx, 1))), 1), max(int(round(ch / max(fy, 1))), 1)
+    img = img.resize((nw, nh), resample, box=(l, t, r, b))
+    return img, _scale(nw / cw, nh / ch) @ _translate(-l, -t) @ matrix
+
+
+def _invalid_mask(windows, size):
+    # Pixels (by their centers) of the output mapped outside of an intermediate output, or None
+    w, h = size
+    corners = np.array([[0, w, w, 0], [0, 0, h, h], [1, 1, 1, 1]], dtype=np.float64)
+    points = None
+    invalid = None
+    for matrix, (ww, hh) in windows:
+        # Windows are convex, so all pixels are inside if the corners are
+        u = matrix[:2] @ corners
+        if np.all(u >= -1e-6) and np.all(u[0] <= ww + 1e-6) and np.all(u[1] <= hh + 1e-6):
+            continue
+        if points is None:
+            xs, ys = np.meshgrid(np.arange(w) + 0.5, np.arange(h) + 0.5)
+            points = np.stack([xs.ravel(), ys.ravel(), np.ones(w * h)])
+            invalid = np.zeros(w * h, dtype=bool)
+        u = matrix[:2] @ points
+        invalid |= (u[0] < 0) | (u[0] >= ww) | (u[1] < 0) | (u[1] >= hh)
+    return None if invalid is None else invalid.reshape(h, w)
+
+
+def _translate(tx, ty):
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], dtype=np.float64)
+
+
+def _scale(sx, sy):
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
+
+def _resized_size(size, w, h):
+    if not isinstance(size, int):
+        return size[1], size[0]
+    if w <= h:
+        return size, int(size * h / w)
+    return int(size * w / h), size
+
+
 class ToTensor(JointTransform):
     """Convert the input ``PIL Image`` to tensor and the target segmentation image to labels.
     """
 
+    deterministic = True
+
     def __init__(self):
         super().__init__()
 
@@ -41,7 +176,7 @@ class ToTensor(JointTransform):
         return input, target
 
 
-class Resize(JointTransform):
+class Resize(GeometricTransform):
     """Resize the input PIL Image to the given size.
 
     Args:
@@ -54,6 +189,8 @@ class Resize(JointTransform):
             ``PIL.Image.BILINEAR``
     """
 
+    deterministic = True
+
     def __init__(self, size, image_interpolation=Image.BILINEAR, label_interpolation=Image.NEAREST):
         super().__init__()
         assert isinstance(size, int) or (isinstance(size, Iterable) and len(size) == 2)
@@ -61,6 +198,10 @@ class Resize(JointTransform):
         self.image_interpolation = image_interpolation
         self.label_interpolation = label_interpolation
 
+    @property
+    def interpolation(self):
+        return self.image_interpolation, self.label_interpolation
+
     def __call__(self, img, mask):
         """
         Args:
@@ -73,6 +214,11 @@ class Resize(JointTransform):
         mask = TF.resize(mask, self.size, self.label_interpolation)
         return img, mask
 
+    def get_affine(self, size):
+        w, h = size
+        ow, oh = _resized_size(self.size, w, h)
+        return _scale(w / ow, h / oh), (ow, oh)
+
     def __repr__(self):
         return self.__class__.__name__ + '(size={}, image_interpolation={}, label_interpolation={})'.format(
             self.size, self.image_interpolation, self.label_interpolation)
@@ -175,7 +321,7 @@ class RandomCrop(JointTransform):
         return self.__class__.__name__ + '(size={0}, padding={1})'.format(self.size, self.padding)
 
 
-class CenterCrop(JointTransform):
+class CenterCrop(GeometricTransform):
     """Crops the given PIL Image at the center.
 
     Args:
@@ -184,6 +330,8 @@ class CenterCrop(JointTransform):
             made.
     """
 
+    deterministic = True
+
     def __init__(self, size):
         super().__init__()
         if isinstance(size, numbers.Number):
@@ -203,11 +351,18 @@ class CenterCrop(JointTransform):
         mask = TF.center_crop(mask, self.size)
         return img, mask
 
+    def get_affine(self, size):
+        w, h = size
+        th, tw = self.size
+        t = int(round((h - th) / 2.))
+        l = int(round((w - tw) / 2.))
+        return _translate(l, t), (tw, th)
+
     def __repr__(self):
         return self.__class__.__name__ + '(size={0})'.format(self.size)
 
 
-class RandomHorizontalFlip(JointTransform):
+class RandomHorizontalFlip(GeometricTransform):
     """Horizontally flip the given PIL Image randomly with a given probability.
 
     Args:
@@ -230,11 +385,17 @@ class RandomHorizontalFlip(JointTransform):
             return TF.hflip(img), TF.hflip(mask)
         return img, mask
 
+    def get_affine(self, size):
+        w, h = size
+        if random.random() < self.p:
+            return np.array([[-1, 0, w], [0, 1, 0], [0, 0, 1]], dtype=np.float64), size
+        return np.eye(3), size
+
     def __repr__(self):
         return self.__class__.__name__ + '(p={})'.format(self.p)
 
 
-class RandomVerticalFlip(JointTransform):
+class RandomVerticalFlip(GeometricTransform):
     """Vertically flip the given PIL Image randomly with a given probability.
 
     Args:
@@ -257,11 +418,17 @@ class RandomVerticalFlip(JointTransform):
             return TF.vflip(img), TF.vflip(mask)
         return img, mask
 
+    def get_affine(self, size):
+        w, h = size
+        if random.random() < self.p:
+            return np.array([[1, 0, 0], [0, -1, h], [0, 0, 1]], dtype=np.float64), size
+        return np.eye(3), size
+
     def __repr__(self):
         return self.__class__.__name__ + '(p={})'.format(self.p)
 
 
-class RandomRotation(JointTransform):
+class RandomRotation(GeometricTransform):
     """Rotate the image by angle.
 
     Args:
@@ -284,6 +451,7 @@ class RandomRotation(JointTransform):
     """
 
     def __init__(self, degrees, resample=False, label_resample=Image.NEAREST, expand=False, center=None, center_crop=False):
+        super().__init__()
         if isinstance(degrees, numbers.Number):
             if degrees < 0:
                 raise ValueError("If degrees is a single number, it must be positive.")
@@ -303,6 +471,10 @@ class RandomRotation(JointTransform):
         self.expand = expand
         self.center = center
 
+    @property
+    def interpolation(self):
+        return self.resample or Image.NEAREST, self.label_resample
+
 
     @staticmethod
     def get_params(degrees):
@@ -331,6 +503,26 @@ class RandomRotation(JointTransform):
             label = center_crop_from_rotated(label, angle)
         return image, label
 
+    def get_affine(self, size):
+        # Same matrix as PIL.Image.rotate
+        angle = self.get_params(self.degrees)
+        w, h = size
+        cx, cy = self.center or (w / 2, h / 2)
+        a = -math.radians(angle)
+        rotate = np.array([[math.cos(a), math.sin(a), 0], [-math.sin(a), math.cos(a), 0], [0, 0, 1]])
+        matrix = _translate(cx, cy) @ rotate @ _translate(-cx, -cy)
+        if self.expand:
+            corners = matrix[:2, :2] @ np.array([[0, w, w, 0], [0, 0, h, h]]) + matrix[:2, 2:]
+            nw = math.ceil(corners[0].max()) - math.floor(corners[0].min())
+            nh = math.ceil(corners[1].max()) - math.floor(corners[1].min())
+            matrix = matrix @ _translate(-(nw - w) / 2, -(nh - h) / 2)
+            size = w, h = nw, nh
+        if self.center_crop:
+            l, t, r, b = center_crop_box(w, angle)
+            matrix = matrix @ _translate(l, t)
+            size = r - l, b - t
+        return matrix, size
+
     def __repr__(self):
         format_string = self.__class__.__name__ + '(degrees={0}'.format(self.degrees)
         format_string += ', resample={0}'.format(self.resample)
@@ -346,16 +538,19 @@ class RandomRotation(JointTransform):
 def center_crop_from_rotated(img, angle):
     w, h = img.size
     assert w == h
+    img = img.crop(center_crop_box(w, angle))
+    return img
+
+
+def center_crop_box(L, angle):
     radian = math.fabs(angle / 180 * math.pi)
-    L = w
     s = L / (np.sin(radian) + np.cos(radian))
     l = t = math.ceil((L - s) / 2)
     r = b = math.floor((L + s) / 2)
-    img = img.crop([l, t, r, b])
-    return img
+    return l, t, r, b
 
 
-class RandomResizedCrop(JointTransform):
+class RandomResizedCrop(GeometricTransform):
     """Crop the given PIL Image to random size and aspect ratio.
 
     A crop of random size (default: of 0.08 to 1.0) of the original size and a random
@@ -371,6 +566,7 @@ class RandomResizedCrop(JointTransform):
     """
 
     def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), image_interpolation=Image.BILINEAR, label_interpolation=Image.NEAREST):
+        super().__init__()
         if isinstance(size, tuple):
             self.size = size
         else:
@@ -383,6 +579,10 @@ class RandomResizedCrop(JointTransform):
         self.scale = scale
         self.ratio = ratio
 
+    @property
+    def interpolation(self):
+        return self.image_interpolation, self.label_interpolation
+
     @staticmethod
     def get_params(img, scale, ratio):
         """Get parameters for ``crop`` for a random sized crop.
@@ -397,6 +597,10 @@ class RandomResizedCrop(JointTransform):
                 sized crop.
         """
         width, height = _get_image_size(img)
+        return RandomResizedCrop.get_params_from_size(width, height, scale, ratio)
+
+    @staticmethod
+    def get_params_from_size(width, height, scale, ratio):
         area = height * width
 
         for attempt in range(10):
@@ -440,6 +644,12 @@ class RandomResizedCrop(JointTransform):
         label = TF.resized_crop(label, i, j, h, w, self.size, self.label_interpolation)
         return image, label
 
+    def get_affine(self, size):
+        width, height = size
+        i, j, h, w = self.get_params_from_size(width, height, self.scale, self.ratio)
+        oh, ow = self.size
+        return _translate(j, i) @ _scale(w / ow, h / oh), (ow, oh)
+
     def __repr__(self):
         image_interpolate_str = _pil_interpolation_to_str[self.image_interpolation]
         label_interpolate_str = _pil_interpolation_to_str[self.label_interpolation]
@@ -546,61 +756,150 @@ class RandomErasing(JointTransform):
         return image, label
 
 
-def elastic_transform(image, label, alpha=100, sigma=10):
+def _gaussian_kernel1d(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def elastic_displacement(n, height, width, alpha, sigma, grid_step=None, device=None):
+    """Random smooth displacement fields of [Simard2003]_ in pixels.
+
+    Uniform noise is smoothed by a gaussian filter on a grid coarser by `grid_step`
+    than the image and upsampled bilinearly. Since the smoothed field has no details
+    finer than `sigma`, this matches the full resolution field in distribution at
+    a fraction of the cost.
+
+    Args:
+        n (int): Number of fields.
+        height (int): Height of the images.
+        width (int): Width of the images.
+        alpha (float): Scale of the displacements.
+        sigma (float): Standard deviation of the gaussian filter, in pixels.
+        grid_step (int, optional): Spacing of the coarse grid in pixels.
+            Default is sigma / 2. Use 1 for full resolution fields.
+        device (torch.device, optional): Device of the fields.
+
+    Returns:
+        Tensor: (n, 2, height, width) displacements along y and x.
+    """
+    if grid_step is None:
+        grid_step = max(int(sigma / 2), 1)
+    ch, cw = math.ceil(height / grid_step) + 1, math.ceil(width / grid_step) + 1
+    noise = torch.rand(n * 2, 1, ch, cw, device=device) * 2 - 1
+
+    kernel = _gaussian_kernel1d(sigma / grid_step).to(noise.device)
+    k = len(kernel)
+    noise = torch.nn.functional.conv2d(noise, kernel.view(1, 1, k, 1), padding=(k // 2, 0))
+    noise = torch.nn.functional.conv2d(noise, kernel.view(1, 1, 1, k), padding=(0, k // 2))
+    # The smoothed noise is grid_step times stronger on the coarse grid.
+    noise = noise * (alpha / grid_step)
+
+    if grid_step != 1:
+        noise = torch.nn.functional.interpolate(
+            noise, size=((ch - 1) * grid_step + 1, (cw - 1) * grid_step + 1), mode='bilinear', align_corners=True)
+    return noise[:, 0, :height, :width].view(n, 2, height, width)
+
+
+def elastic_grid(displacement):
+    """Sampling grid of ``grid_sample`` from displacements (n, 2, height, width) in pixels."""
+    n, _, height, width = displacement.shape
+    ys = torch.arange(height, dtype=displacement.dtype, device=displacement.device).view(1, height, 1)
+    xs = torch.arange(width, dtype=displacement.dtype, device=displacement.device).view(1, 1, width)
+    y = (ys + displacement[:, 0]) * (2 / max(height - 1, 1)) - 1
+    x = (xs + displacement[:, 1]) * (2 / max(width - 1, 1)) - 1
+    return torch.stack([x, y], dim=-1)
+
+
+def elastic_transform_batch(images, masks=None, alpha=100, sigma=10, grid_step=None):
+    """Elastic deformation of a batch of tensors, with an independent field per sample.
+
+    Args:
+        images (Tensor): (N, C, H, W) float images.
+        masks (Tensor, optional): (N, H, W) label masks, resampled by nearest neighbor
+            with the same fields as the images.
+        alpha (float): Scale of the displacements.
+        sigma (float): Smoothness of the displacements.
+        grid_step (int, optional): See ``elastic_displacement``.
+
+    Returns:
+        Tensor or tuple: The deformed images, and the deformed masks if given.
+    """
+    n, _, height, width = images.shape
+    displacement = elastic_displacement(n, height, width, alpha, sigma, grid_step, images.device)
+    grid = elastic_grid(displacement.to(images.dtype))
+    images = torch.nn.functional.grid_sample(
+        images, grid, mode='bilinear', padding_mode='reflection', align_corners=True)
+    if masks is None:
+        return images
+    dtype = masks.dtype
+    masks = torch.nn.functional.grid_sample(
+        masks[:, None].to(grid.dtype), grid, mode='nearest', padding_mode='reflection', align_corners=True)
+    return images, masks[:, 0].to(dtype)
+
+
+def elastic_transform(image, label, alpha=100, sigma=10, grid_step=None):
     """Elastic deformation of images as described in [Simard2003]_.
     .. [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
        Convolutional Neural Networks applied to Visual Document Analysis", in
        Proc. of the International Conference on Document Analysis and
        Recognition, 2003.
+
+    The image (of any number of channels) and the label are remapped once by
+    the same displacement field, bilinearly and by nearest neighbor respectively.
     """
 
     image = np.asarray(image)
     label = np.asarray(label)
 
-    shape = image.shape
-
-    dx = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-    dy = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-
-    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
-
-    indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
+    x = torch.from_numpy(image.astype(np.float32))
+    x = x.permute(2, 0, 1)[None] if x.ndim == 3 else x[None, None]
+    y = torch.from_numpy(label.astype(np.int64))[None]
+    x, y = elastic_transform_batch(x, y, alpha, sigma, grid_step)
 
-    image = map_coordinates(image, indices, order=1, mode='reflect').reshape(shape)
-    label = map_coordinates(label, indices, order=1, mode='reflect').reshape(shape)
-    return Image.fromarray(image), Image.fromarray(label)
+    x = x[0].permute(1, 2, 0) if image.ndim == 3 else x[0, 0]
+    x = x.round_().clamp_(0, 255).numpy().astype(image.dtype) if image.dtype == np.uint8 else x.numpy()
+    y = y[0].numpy().astype(label.dtype)
+    return Image.fromarray(x), Image.fromarray(y)
 
 
 class ElasticTransform(JointTransform):
-    """Vertically flip the given PIL Image randomly with a given probability.
+    """Elastic deformation of the image and the label with a random displacement field.
 
     Args:
-        p (float): probability of the image being flipped. Default value is 0.5
+        alpha (float or tuple): Scale of the displacements. If a tuple of (min, max),
+            a random integer in the range is used.
+        sigma (float): Smoothness of the displacements.
+        grid_step (int, optional): Spacing of the grid where the displacements are
+            generated before upsampling. Default is sigma / 2.
     """
 
-    def __init__(self, alpha=100, sigma=10):
+    def __init__(self, alpha=100, sigma=10, grid_step=None):
         super().__init__()
         self.alpha = alpha
         self.sigma = sigma
+        self.grid_step = grid_step
 
     def __call__(self, image, label):
         """
         Args:
-            img (PIL Image): Image to be flipped.
+            image (PIL Image): Image to be deformed.
+            label (PIL Image): Label to be deformed.
 
         Returns:
-            PIL Image: Randomly flipped image.
+            tuple: Deformed image and label.
         """
-        assert len(image.size) == 2
         alpha = self.alpha
         if isinstance(alpha, tuple):
             alpha = random.randint(*alpha)
-        image, label = elastic_transform(image, label, alpha, self.sigma)
+        image, label = elastic_transform(image, label, alpha, self.sigma, self.grid_step)
 
         return image, label
 
     def __repr__(self):
         format_string = self.__class__.__name__ + '(alpha={0}'.format(self.alpha)
         format_string += ', sigma={0}'.format(self.sigma)
+        format_string += ', grid_step={0})'.format(self.grid_step)
 
         return format_string
@@ -142,6 +142,11 @@ setup(
     install_requires=parse_requirements("requirements.txt"),
     extras_require=EXTRAS,
     dependency_links=DEPENDENCY_LINKS,
+    entry_points={
+        'console_scripts': [
+            'horch-bench=horch.models.bench:main',
+        ],
+    },
     # include_package_data=True,
     license='MIT',
 )
@@ -0,0 +1,51 @@
+import numpy as np
+
+from horch.transforms.detection import BoxList
+from horch.transforms.detection.functional import drop_boundary_bboxes, resize, crop
+
+ANNS = [
+    {"bbox": [0, 0, 4, 4], "category_id": 1, "image_id": 7},
+    {"bbox": [2, 2, 4, 6], "category_id": 2, "image_id": 7},
+    {"bbox": [5, 1, 2, 2], "category_id": 3, "image_id": 7},
+]
+
+
+def test_round_trip():
+    anns = [{**ann, "area": 10.0, "iscrowd": 0} for ann in ANNS]
+    assert BoxList.from_anns(anns).to_anns() == anns
+
+
+def test_no_synthesized_fields():
+    boxes = BoxList.from_anns(ANNS)
+    assert boxes.to_anns() == ANNS
+    assert resize(boxes, (10, 10), (20, 20))[0] == {"bbox": [0, 0, 8, 8], "category_id": 1, "image_id": 7}
+    # Fields missing in some annotations are kept as they are
+    anns = [dict(ANNS[0], area=3.0), ANNS[1]]
+    assert BoxList.from_anns(anns).to_anns() == anns
+
+
+def test_getitem():
+    boxes = BoxList.from_anns(ANNS)
+    assert boxes[1] == ANNS[1]
+    assert boxes[[True, False, True]].to_anns() == [ANNS[0], ANNS[2]]
+    assert boxes[(False, True, False)].to_anns() == [ANNS[1]]
+    assert boxes[[2, 0]].to_anns() == [ANNS[2], ANNS[0]]
+    assert boxes[np.array([False, False, True])].to_anns() == [ANNS[2]]
+    assert len(boxes[[]]) == 0
+
+
+def test_drop_boundary_bboxes():
+    # By the centers l + w / 2, which (l + w) / 2 got wrong for the last three
+    anns = [
+        {"bbox": [1, 1, 2, 2]},
+        {"bbox": [6, 1, 10, 2]},
+        {"bbox": [-6, 1, 8, 2]},
+        {"bbox": [-2, 1, 23, 2]},
+    ]
+    kept = drop_boundary_bboxes(anns, (10, 10)).to_anns()
+    assert [ann["bbox"] for ann in kept] == [[1, 1, 2, 2], [-2, 1, 23, 2]]
+
+
+def test_crop():
+    kept = crop(ANNS, 1, 1, 4, 4).to_anns()
+    assert [ann["bbox"] for ann in kept] == [[0, 0, 3, 3], [1, 1, 3, 3]]
@@ -0,0 +1,68 @@
+import pytest
+import torch
+from torch.utils.data import Dataset
+
+from horch.datasets import IndexedDataset
+from horch.train.progressive import ResolutionSchedule, progressive_loader
+from horch.transforms.cache import CachedCompose, MemoryCache
+
+
+class Scale:
+    deterministic = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        return x * 2
+
+
+class Resize:
+    deterministic = True
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        return x.expand(self.size, self.size)
+
+
+class Samples(Dataset):
+
+    def __init__(self, n, transform):
+        self.n = n
+        self.transform = transform
+
+    def __getitem__(self, idx):
+        return self.transform(torch.full((1, 1), float(idx))), idx
+
+    def __len__(self):
+        return self.n
+
+
+def test_resizable_prefix():
+    scale, resize = Scale(), Resize(8)
+    assert CachedCompose([scale, resize], MemoryCache()).cached == [scale, resize]
+    assert CachedCompose([scale, resize], MemoryCache(), resizable=True).cached == [scale]
+
+
+def test_cache_with_resolution_schedule():
+    scale = Scale()
+    transform = CachedCompose([scale, Resize(8)], MemoryCache(), resizable=True)
+    schedule = ResolutionSchedule([(1, 4), (2, 8)], 4)
+    loader = progressive_loader(IndexedDataset(Samples(8, transform)), schedule, transform, shuffle=False)
+    for epoch, size in [(1, 4), (2, 8), (3, 8)]:
+        schedule.set_epoch(epoch)
+        for x, idx in loader:
+            assert x.shape[1:] == (size, size)
+            assert torch.equal(x, (idx * 2.).view(-1, 1, 1).expand_as(x))
+    # The prefix before the resized transform is computed once per sample
+    assert scale.calls == 8
+
+
+def test_cached_resizable_rejected():
+    transform = CachedCompose([Scale(), Resize(8)], MemoryCache())
+    schedule = ResolutionSchedule([(1, 4), (2, 8)], 4)
+    with pytest.raises(ValueError):
+        progressive_loader(IndexedDataset(Samples(8, transform)), schedule, transform)
@@ -0,0 +1,241 @@
+import copy
+import os
+import pickle
+
+import pytest
+import torch
+import torch.nn as nn
+from ignite.engine import Engine, Events
+from ignite.handlers import Checkpoint
+
+from horch.train.checkpoint import (
+    ALIGNMENT, META, TENSORS, TensorRef, AsyncDiskSaver, DeltaDiskSaver, save_flat, load_flat,
+    load_checkpoint, read_latest, is_flat, is_delta,
+)
+from horch.train.optimizer import AdamW, Nadam, AdaBound
+
+
+def assert_equal(a, b):
+    if torch.is_tensor(a):
+        assert torch.is_tensor(b) and a.dtype == b.dtype and a.shape == b.shape
+        assert torch.equal(a.contiguous().view(-1).view(torch.uint8), b.contiguous().view(-1).view(torch.uint8))
+    elif isinstance(a, dict):
+        assert type(a) == type(b) and list(a) == list(b)
+        for k in a:
+            assert_equal(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert type(a) == type(b) and len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_equal(x, y)
+    else:
+        assert a == b
+
+
+def make_objects():
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Linear(16, 64), nn.ReLU(), nn.Linear(64, 4))
+    # Frozen, so that deltas only have the chunks of the trained layer
+    net[0].requires_grad_(False)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-2)
+    return net, optimizer
+
+
+def train(saver, iterations, n_saved):
+    net, optimizer = make_objects()
+    x, y = torch.randn(8, 16), torch.randn(8, 4)
+
+    def step(engine, batch):
+        optimizer.zero_grad()
+        loss = (net(x) - y).pow(2).mean()
+        loss.backward()
+        optimizer.step()
+
+    engine = Engine(step)
+    to_save = {'model': net, 'optimizer': optimizer}
+    saves = {}
+
+    def record(engine):
+        saves[engine.state.iteration] = copy.deepcopy({k: v.state_dict() for k, v in to_save.items()})
+
+    engine.add_event_handler(Events.ITERATION_COMPLETED, record)
+    engine.add_event_handler(Events.ITERATION_COMPLETED, Checkpoint(
+        to_save, saver, n_saved=n_saved, global_step_transform=lambda e, _: e.state.iteration))
+    engine.run(range(iterations), max_epochs=1)
+    saver.wait()
+    return saves
+
+
+def test_flat_round_trip(tmp_path):
+    obj = {
+        'a': torch.randn(3, 5),
+        'b': [torch.arange(7, dtype=torch.int64), (torch.randn(2, 3).bfloat16(), 'name')],
+        'empty': torch.empty(0, 4),
+        'scalar': torch.tensor(3.5, dtype=torch.float64),
+        'strided': torch.randn(6, 4).t(),
+        'mask': torch.rand(9) > 0.5,
+        'step': 12,
+    }
+    path = tmp_path / 'flat'
+    save_flat(obj, path)
+    assert is_flat(path) and not is_delta(path)
+    assert sorted(os.listdir(tmp_path)) == ['flat']
+
+    loaded = load_flat(path)
+    assert_equal(loaded, obj)
+    assert load_checkpoint(path)['step'] == 12
+
+
+def test_flat_layout(tmp_path):
+    tensors = [torch.randn(3), torch.randn(5).double(), torch.randint(0, 9, (7,), dtype=torch.uint8)]
+    path = tmp_path / 'flat'
+    save_flat({'xs': tensors}, path)
+
+    with open(path / META, 'rb') as f:
+        meta = pickle.load(f)
+    refs = meta['xs']
+    assert all(isinstance(r, TensorRef) for r in refs)
+    assert all(r.offset % ALIGNMENT == 0 for r in refs)
+    data = (path / TENSORS).read_bytes()
+    for t, r in zip(tensors, refs):
+        assert data[r.offset:r.offset + r.nbytes] == t.numpy().tobytes()
+
+
+def test_flat_copy_on_write(tmp_path):
+    path = tmp_path / 'flat'
+    x = torch.randn(1 << 15)
+    save_flat({'x': x}, path)
+    loaded = load_flat(path)['x']
+    loaded.add_(1)
+    assert_equal(load_flat(path)['x'], x)
+
+
+def test_async_flat_saver(tmp_path):
+    saver = AsyncDiskSaver(tmp_path, flat=True)
+    try:
+        saves = train(saver, 5, n_saved=2)
+    finally:
+        saver.close()
+    kept = sorted(p for p in os.listdir(tmp_path) if p.startswith('checkpoint'))
+    assert kept == ['checkpoint_4.pt', 'checkpoint_5.pt']
+    for name in kept:
+        assert is_flat(tmp_path / name)
+        assert_equal(load_checkpoint(tmp_path / name), saves[int(name[11:-3])])
+    assert read_latest(tmp_path) == tmp_path / 'checkpoint_5.pt'
+
+
+def test_delta_round_trip(tmp_path):
+    saver = DeltaDiskSaver(tmp_path, full_every=3, chunk_size=256, verbose=False)
+    try:
+        saves = train(saver, 8, n_saved=8)
+    finally:
+        saver.close()
+    assert [full for _, _, full in saver.history] == [True, False, False] * 2 + [True, False]
+    # The frozen layer isn't rewritten by the deltas
+    assert all(n < saver.history[0][1] for _, n, full in saver.history if not full)
+    for i in range(1, 9):
+        path = tmp_path / ('checkpoint_%d.pt' % i)
+        assert is_delta(path) == (i % 3 != 1)
+        assert_equal(load_checkpoint(path), saves[i])
+
+
+def test_delta_rotation(tmp_path):
+    saver = DeltaDiskSaver(tmp_path, full_every=3, chunk_size=256, verbose=False)
+    try:
+        saves = train(saver, 8, n_saved=2)
+    finally:
+        saver.close()
+    # 7 is a full save and 8 its delta, the older saves are deleted as no chain depends on them
+    on_disk = sorted(p for p in os.listdir(tmp_path) if p.startswith('checkpoint'))
+    assert on_disk == ['checkpoint_7.pt', 'checkpoint_8.pt']
+    for name in on_disk:
+        assert_equal(load_checkpoint(tmp_path / name), saves[int(name[11:-3])])
+
+    latest = read_latest(tmp_path)
+    assert latest == tmp_path / 'checkpoint_8.pt'
+    checkpoint = load_checkpoint(latest)
+    net, optimizer = make_objects()
+    net.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    assert_equal(net.state_dict(), saves[8]['model'])
+    assert_equal(optimizer.state_dict(), saves[8]['optimizer'])
+
+
+def test_delta_rotation_keeps_chain(tmp_path):
+    saver = DeltaDiskSaver(tmp_path, full_every=4, chunk_size=256, verbose=False)
+    try:
+        saves = train(saver, 7, n_saved=2)
+    finally:
+        saver.close()
+    # 6 and 7 are deltas of the chain starting at the full save 5, which is kept for them
+    on_disk = sorted(p for p in os.listdir(tmp_path) if p.startswith('checkpoint'))
+    assert on_disk == ['checkpoint_5.pt', 'checkpoint_6.pt', 'checkpoint_7.pt']
+    for i in (6, 7):
+        assert_equal(load_checkpoint(tmp_path / ('checkpoint_%d.pt' % i)), saves[i])
+    assert_equal(load_checkpoint(read_latest(tmp_path)), saves[7])
+
+
+def low_precision_step(optimizer_cls, state_dtype, state_dict=None):
+    torch.manual_seed(0)
+    # Large enough for the moments to be quantized
+    net = nn.Linear(64, 64)
+    optimizer = optimizer_cls(net.parameters(), lr=1e-2, state_dtype=state_dtype)
+    if state_dict is not None:
+        net.load_state_dict(state_dict['model'])
+        optimizer.load_state_dict(state_dict['optimizer'])
+    x = torch.randn(8, 64)
+
+    def step():
+        optimizer.zero_grad()
+        net(x).pow(2).mean().backward()
+        optimizer.step()
+    return net, optimizer, step
+
+
+@pytest.mark.parametrize('optimizer_cls', [AdamW, Nadam, AdaBound])
+@pytest.mark.parametrize('state_dtype', ['int8', 'bfloat16'])
+@pytest.mark.parametrize('layout', ['flat', 'delta'])
+def test_resume_low_precision_states(tmp_path, optimizer_cls, state_dtype, layout):
+    net, optimizer, step = low_precision_step(optimizer_cls, state_dtype)
+    for _ in range(3):
+        step()
+    checkpoint = {'model': net.state_dict(), 'optimizer': optimizer.state_dict()}
+    assert 'generators' in checkpoint['optimizer']
+    if layout == 'flat':
+        save_flat(checkpoint, tmp_path / 'checkpoint')
+    else:
+        saver = DeltaDiskSaver(tmp_path, verbose=False)
+        try:
+            saver(checkpoint, 'checkpoint_0')
+            step()
+            saver({'model': net.state_dict(), 'optimizer': optimizer.state_dict()}, 'checkpoint')
+            saver.wait()
+        finally:
+            saver.close()
+        assert is_delta(tmp_path / 'checkpoint')
+    saved = copy.deepcopy({'model': net.state_dict(), 'optimizer': optimizer.state_dict()})
+    step()
+
+    resumed, resumed_optimizer, resumed_step = low_precision_step(
+        optimizer_cls, state_dtype, load_checkpoint(tmp_path / 'checkpoint'))
+    assert_equal(resumed_optimizer.state_dict(), saved['optimizer'])
+    resumed_step()
+    assert_equal(resumed.state_dict(), net.state_dict())
+    assert_equal(resumed_optimizer.state_dict(), optimizer.state_dict())
+
+
+def test_flat_owning_small_tensors(tmp_path):
+    generator = torch.Generator().manual_seed(3)
+    obj = {'weight': torch.randn(256, 256), 'bias': torch.randn(4),
+           'step': torch.tensor(5), 'rng': generator.get_state()}
+    save_flat(obj, tmp_path / 'flat')
+    loaded = load_flat(tmp_path / 'flat')
+    assert_equal(loaded, obj)
+    for k in ('bias', 'step', 'rng'):
+        assert loaded[k].storage_offset() == 0
+        assert loaded[k].untyped_storage().nbytes() == loaded[k].nbytes
+    # The large float tensors stay views of the mapping
+    assert loaded['weight'].untyped_storage().nbytes() > loaded['weight'].nbytes
+
+    restored = torch.Generator()
+    restored.set_state(loaded['rng'])
+    assert torch.equal(torch.rand(8, generator=restored), torch.rand(8, generator=generator))
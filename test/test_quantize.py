@@ -0,0 +1,83 @@
+import torch
+
+from horch.train.optimizer.utils import BLOCK_SIZE, quantize, dequantize, _code
+
+
+def round_trip(x, signed, generator=None):
+    codes, absmax = quantize(x, signed, generator)
+    return codes, absmax, dequantize(codes, absmax, signed, x)
+
+
+def neighbours(x, absmax, signed):
+    # The codes around every value scaled by the absmax of its block, scaled back
+    code = _code(signed, x.device)
+    scale = absmax.repeat_interleave(BLOCK_SIZE)[:x.numel()].view_as(x)
+    hi = torch.searchsorted(code, (x / scale.clamp_min(1e-30)).contiguous()).clamp_(1, code.numel() - 1)
+    return code[hi - 1] * scale, code[hi] * scale
+
+
+def test_shapes_and_absmax():
+    x = torch.randn(3, BLOCK_SIZE + 5)
+    codes, absmax, y = round_trip(x, True)
+    blocks = -(-x.numel() // BLOCK_SIZE)
+    assert codes.dtype == torch.uint8 and codes.numel() == blocks * BLOCK_SIZE
+    assert absmax.dtype == torch.float32 and absmax.shape == (blocks,)
+    assert y.shape == x.shape and y.dtype == torch.float32
+    padded = torch.cat([x.view(-1), x.new_zeros(blocks * BLOCK_SIZE - x.numel())])
+    assert torch.equal(absmax, padded.view(blocks, BLOCK_SIZE).abs().amax(dim=1))
+
+
+def test_signed_bounds():
+    torch.manual_seed(0)
+    x = torch.randn(10 * BLOCK_SIZE + 3) * torch.logspace(-6, 2, 10 * BLOCK_SIZE + 3)
+    for generator in (None, torch.Generator().manual_seed(0)):
+        codes, absmax, y = round_trip(x, True, generator)
+        lo, hi = neighbours(x, absmax, True)
+        # Every value is rounded to one of the codes around it and keeps its sign
+        assert ((y == lo) | (y == hi)).all()
+        assert (y * x >= 0).all()
+        assert (y.abs() <= absmax.repeat_interleave(BLOCK_SIZE)[:x.numel()]).all()
+        if generator is None:
+            assert ((y - x).abs() <= (hi - lo) / 2 * (1 + 1e-5)).all()
+
+
+def test_unsigned_bounds():
+    torch.manual_seed(0)
+    x = torch.rand(4 * BLOCK_SIZE) ** 8
+    for generator in (None, torch.Generator().manual_seed(0)):
+        codes, absmax, y = round_trip(x, False, generator)
+        lo, hi = neighbours(x, absmax, False)
+        assert ((y == lo) | (y == hi)).all()
+        assert (y >= 0).all()
+
+
+def test_exact_values():
+    x = torch.zeros(2 * BLOCK_SIZE)
+    x[0], x[BLOCK_SIZE + 1] = -3.0, 0.5
+    for signed in (True, False):
+        x = x.abs() if not signed else x
+        codes, absmax, y = round_trip(x, signed, torch.Generator().manual_seed(0))
+        # The absmax of every block and zeros are exact
+        assert torch.equal(y, x)
+    # All-zero blocks don't divide by zero
+    assert torch.equal(round_trip(torch.zeros(BLOCK_SIZE), True)[2], torch.zeros(BLOCK_SIZE))
+
+
+def test_stochastic_rounding_unbiased():
+    torch.manual_seed(0)
+    x = torch.randn(BLOCK_SIZE) * 1e-3
+    x[0] = 1
+    generator = torch.Generator().manual_seed(0)
+    mean = torch.stack([round_trip(x, True, generator)[2] for _ in range(2000)]).mean(0)
+    lo, hi = neighbours(x, torch.ones(1), True)
+    assert ((mean - x).abs() <= 0.05 * (hi - lo) + 1e-12).all()
+
+
+def test_generator_is_deterministic():
+    x = torch.randn(3 * BLOCK_SIZE)
+    state = torch.get_rng_state()
+    a = quantize(x, True, torch.Generator().manual_seed(1))[0]
+    b = quantize(x, True, torch.Generator().manual_seed(1))[0]
+    assert torch.equal(a, b)
+    # The global generator isn't used
+    assert torch.equal(state, torch.get_rng_state())
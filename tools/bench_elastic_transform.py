@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+from horch.transforms.segmentation import elastic_transform, elastic_transform_batch, elastic_displacement
+
+
+def elastic_transform_full(image, label, alpha=100, sigma=10):
+    # The full resolution implementation, kept as the reference of time and distribution.
+    image = np.asarray(image)
+    label = np.asarray(label)
+
+    shape = image.shape[:2]
+
+    dx = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    dy = gaussian_filter((np.random.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+
+    indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
+
+    if image.ndim == 3:
+        image = np.stack([map_coordinates(image[..., c], indices, order=1, mode='reflect').reshape(shape)
+                          for c in range(image.shape[2])], axis=-1)
+    else:
+        image = map_coordinates(image, indices, order=1, mode='reflect').reshape(shape)
+    label = map_coordinates(label, indices, order=0, mode='reflect').reshape(shape)
+    return Image.fromarray(image), Image.fromarray(label)
+
+
+def bench(f, repeats):
+    f()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def displacement_stats(field):
+    # Standard deviation and correlation with the field shifted by sigma pixels
+    field = field.numpy()
+    std = field.std()
+    corr = np.mean(field[..., :-args.sigma] * field[..., args.sigma:]) / field.var()
+    return std, corr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ElasticTransform.')
+    parser.add_argument('-s', '--size', type=int, default=512, help='size of the square images')
+    parser.add_argument('--alpha', type=float, default=100)
+    parser.add_argument('--sigma', type=int, default=10)
+    parser.add_argument('-b', '--batch-size', type=int, default=16, help='batch size of the tensor version')
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    image = Image.fromarray(rng.randint(0, 256, (args.size, args.size, 3), dtype=np.uint8))
+    label = Image.fromarray(rng.randint(0, 21, (args.size, args.size), dtype=np.uint8))
+
+    print("full resolution: %8.2fms" % bench(
+        lambda: elastic_transform_full(image, label, args.alpha, args.sigma), args.repeats))
+    print("coarse grid:     %8.2fms" % bench(
+        lambda: elastic_transform(image, label, args.alpha, args.sigma), args.repeats))
+
+    images = torch.rand(args.batch_size, 3, args.size, args.size)
+    masks = torch.randint(21, (args.batch_size, args.size, args.size))
+    t = bench(lambda: elastic_transform_batch(images, masks, args.alpha, args.sigma), args.repeats)
+    print("batched:         %8.2fms per image" % (t / args.batch_size))
+
+    for name, grid_step in [("full resolution", 1), ("coarse grid", None)]:
+        field = elastic_displacement(64, args.size, args.size, args.alpha, args.sigma, grid_step)
+        print("%-16s displacement std %.3f, correlation at sigma %.3f" % ((name + ":",) + displacement_stats(field)))
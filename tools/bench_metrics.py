@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from horch.train.classification.trainer import create_supervised_trainer
+from horch.train.metrics import TrainLoss, Loss
+from horch.train.metrics.classification import Accuracy, TopKAccuracy
+
+
+def synced(metric):
+    # Read the values of the metric from the device at every iteration, as before
+    update = metric.update
+
+    def synced_update(output):
+        val, n = output
+        update((val.item() if torch.is_tensor(val) else val, n))
+
+    metric.update = synced_update
+    return metric
+
+
+def create_model(num_classes):
+    return nn.Sequential(
+        nn.Conv2d(3, 32, 3, padding=1),
+        nn.BatchNorm2d(32),
+        nn.ReLU(inplace=True),
+        nn.Conv2d(32, 64, 3, stride=2, padding=1),
+        nn.BatchNorm2d(64),
+        nn.ReLU(inplace=True),
+        nn.AdaptiveAvgPool2d(1),
+        nn.Flatten(),
+        nn.Linear(64, num_classes),
+    )
+
+
+def bench(sync, device, batches, repeats):
+    model = create_model(10).to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    metrics = {
+        'loss': TrainLoss(),
+        'acc': Accuracy(),
+        'top5': TopKAccuracy(5),
+        'ce': Loss(criterion),
+    }
+    if sync:
+        metrics = {k: synced(m) for k, m in metrics.items()}
+    engine = create_supervised_trainer(model, criterion, optimizer, metrics, device)
+    engine.run(batches[:2], 1)
+
+    start = time.perf_counter()
+    engine.run(batches, repeats)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return len(batches) * repeats / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark training steps with synced and device-side metrics.')
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-b', '--batch-size', type=int, default=128)
+    parser.add_argument('-s', '--size', type=int, default=32, help='size of the square images')
+    parser.add_argument('-n', '--iterations', type=int, default=50, help='iterations per epoch')
+    parser.add_argument('--repeats', type=int, default=3, help='epochs to run')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    batches = [(torch.randn(args.batch_size, 3, args.size, args.size, device=device),
+                torch.randint(10, (args.batch_size,), device=device))
+               for _ in range(args.iterations)]
+
+    for name, sync in [("synced every step", True), ("device-side", False)]:
+        print("%-18s %8.1f steps/s" % (name + ":", bench(sync, device, batches, args.repeats)))
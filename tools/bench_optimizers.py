@@ -0,0 +1,69 @@
+import argparse
+import time
+
+import torch
+
+from horch.models.cifar import ResNet, ShuffleNetV2, EfficientNet
+from horch.models.cifar.mobilenetv3 import MobileNetV3
+from horch.train.optimizer.adamw import AdamW
+from horch.train.optimizer.sgdw import SGDW
+from horch.train.optimizer.nadam import Nadam
+from horch.train.optimizer.adabound import AdaBound, AdaBoundW
+
+MODELS = {
+    'resnet20': lambda: ResNet(20),
+    'shufflenetv2': lambda: ShuffleNetV2(24, (116, 232, 464), (4, 8, 4), 1024),
+    'efficientnet': lambda: EfficientNet(),
+    'mobilenetv3': lambda: MobileNetV3(),
+}
+
+OPTIMIZERS = {
+    'AdamW': lambda params, foreach: AdamW(params, lr=1e-3, weight_decay=1e-4, foreach=foreach),
+    'SGDW': lambda params, foreach: SGDW(params, lr=0.1, momentum=0.9, nesterov=True, weight_decay=1e-4,
+                                         foreach=foreach),
+    'Nadam': lambda params, foreach: Nadam(params, lr=2e-3, weight_decay=1e-4, foreach=foreach),
+    'AdaBound': lambda params, foreach: AdaBound(params, lr=1e-3, weight_decay=1e-4, foreach=foreach),
+    'AdaBoundW': lambda params, foreach: AdaBoundW(params, lr=1e-3, weight_decay=1e-4, foreach=foreach),
+}
+
+
+def bench(model_fn, optimizer_fn, foreach, device, iterations, warmup=5):
+    # Time of the optimizer step only, with fixed random gradients
+    torch.manual_seed(0)
+    model = model_fn().to(device)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+    optimizer = optimizer_fn(model.parameters(), foreach)
+    for group in optimizer.param_groups:
+        group.setdefault('initial_lr', group['lr'])
+    for _ in range(warmup):
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations * 1000, list(model.parameters())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the per-parameter and foreach optimizer steps.')
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-m', '--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('-o', '--optimizers', nargs='+', default=list(OPTIMIZERS), choices=list(OPTIMIZERS))
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print("%-14s %-10s %7s %10s %10s %8s %s" % (
+        "model", "optimizer", "tensors", "loop ms", "foreach ms", "speedup", "identical"))
+    for model_name in args.models:
+        for opt_name in args.optimizers:
+            t_loop, params_loop = bench(MODELS[model_name], OPTIMIZERS[opt_name], False, device, args.iterations)
+            t_foreach, params_foreach = bench(
+                MODELS[model_name], OPTIMIZERS[opt_name], True, device, args.iterations)
+            identical = all(torch.equal(p, q) for p, q in zip(params_loop, params_foreach))
+            print("%-14s %-10s %7d %10.2f %10.2f %7.2fx %s" % (
+                model_name, opt_name, len(params_loop), t_loop, t_foreach, t_loop / t_foreach, identical))
@@ -0,0 +1,83 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+from horch.datasets import VOCDetection
+from horch.transforms.detection import RandomSampleCrop
+from horch.transforms.detection import functional as HF
+
+
+def random_sample_crop_loop(anns, size, min_iou, min_ar, max_ar, max_attemps=50):
+    # The sequential implementation, kept as the reference of time and distribution.
+    width, height = size
+    anns = HF.to_boxlist(anns)
+    bboxes = anns.bboxes.copy()
+    bboxes[:, 2:] += bboxes[:, :2]
+    for _ in range(max_attemps):
+        w = random.uniform(0.3 * width, width)
+        h = random.uniform(0.3 * height, height)
+
+        if h / w < min_ar or h / w > max_ar:
+            continue
+
+        l = random.uniform(0, width - w)
+        t = random.uniform(0, height - h)
+        r = l + w
+        b = t + h
+
+        patch = np.array([l, t, r, b])
+        ious = HF.iou_1m(patch, bboxes)
+        if ious.min() < min_iou:
+            continue
+
+        centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2.0
+        mask = (l < centers[:, 0]) & (centers[:, 0] < r) & (
+                t < centers[:, 1]) & (centers[:, 1] < b)
+
+        if not mask.any():
+            continue
+        return anns[mask], l, t, w, h
+    return None
+
+
+def bench(f, samples, min_ious, repeats):
+    stats = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for size, anns in samples:
+            min_iou = random.choice(min_ious)
+            returns = f(anns, size, min_iou, 0.5, 2)
+            if returns is not None:
+                _, l, t, w, h = returns
+                stats.append((w * h / (size[0] * size[1]), h / w))
+    elapsed = time.perf_counter() - start
+    stats = np.array(stats)
+    return elapsed / (repeats * len(samples)), len(stats) / (repeats * len(samples)), stats.mean(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark RandomSampleCrop on VOC.')
+    parser.add_argument('-r', '--root', help='root of VOC dataset')
+    parser.add_argument('-y', '--year', default='2012')
+    parser.add_argument('-n', '--num-samples', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    ds = VOCDetection(args.root, year=args.year, image_set='trainval')
+    samples = []
+    for i in range(min(args.num_samples, len(ds))):
+        img_id = ds.ids[i]
+        img = ds.coco.loadImgs([img_id])[0]
+        anns = ds.coco.loadAnns(ds.coco.getAnnIds(imgIds=img_id))
+        if anns:
+            samples.append(((img['width'], img['height']), HF.to_boxlist(anns)))
+
+    min_ious = RandomSampleCrop().min_ious
+    for name, f in [("loop", random_sample_crop_loop), ("vectorized", HF.random_sample_crop)]:
+        random.seed(0)
+        np.random.seed(0)
+        t, accept, (area, ar) = bench(f, samples, min_ious, args.repeats)
+        print("%-10s %8.1f us/sample, accepted %.3f, mean area %.4f, mean aspect ratio %.4f" % (
+            name, t * 1e6, accept, area, ar))
@@ -8,17 +8,29 @@ from torchvision.datasets import CIFAR10
 
 from horch.core import load_yaml_config
 from horch.config import cfg as global_cfg, load_from_dict
-from horch.datasets import train_test_split
+from horch.datasets import train_test_split, IndexedDataset
 from horch.nn.loss import CrossEntropyLoss
 from horch.train import manual_seed
+from horch.train.distributed import init_distributed
+from horch.train.checkpoint import AsyncDiskSaver, DeltaDiskSaver
 from horch.train.classification.mix import get_mix
 from horch.train.classification.trainer import Trainer
 from horch.train.metrics import TrainLoss, Loss
 from horch.train.metrics.classification import Accuracy
+from horch.train.progressive import ResolutionSchedule, progressive_loader
 
 import horch.models.cifar
 
 from torchvision.transforms import Compose
+from horch.transforms.cache import CachedCompose, get_cache
+
+
+def build_transform(cfg, resizable=False):
+    if cfg.get("cache"):
+        return CachedCompose(cfg.transforms, get_cache(cfg.cache, cfg.get("cache_root"), cfg.get("cache_name")),
+                             resizable=resizable)
+    return Compose(cfg.transforms)
+
 
 if __name__ == '__main__':
 
@@ -29,6 +41,9 @@ if __name__ == '__main__':
 
     cfg = load_yaml_config(args.config)
 
+    # Set up by `python -m horch.train.distributed -n N tools/train_cifar10.py ...`
+    init_distributed()
+
     if cfg.get("Global"):
         global_cfg.merge_from_other_cfg(load_from_dict(cfg.get("Global")))
 
@@ -37,8 +52,9 @@ if __name__ == '__main__':
     if cfg.get("benchmark"):
         torch.backends.cudnn.benchmark = True
 
-    train_transform = Compose(cfg.Dataset.Train.transforms)
-    test_transform = Compose(cfg.Dataset.Test.transforms)
+    # The sizes of the train transforms are changed by the resolution schedule, so they aren't cached
+    train_transform = build_transform(cfg.Dataset.Train, resizable=bool(cfg.get("ResolutionSchedule")))
+    test_transform = build_transform(cfg.Dataset.Test)
 
     data_home = cfg.Dataset.data_home
     ds_train = CIFAR10(data_home, train=True, download=True, transform=train_transform)
@@ -49,7 +65,24 @@ if __name__ == '__main__':
         ds_train = train_test_split(ds_train, test_ratio=ratio, random=True)[1]
         ds_test = train_test_split(ds_test, test_ratio=ratio, random=True)[1]
 
-    train_loader = get_dataloader(cfg.Dataset.Train, ds_train)
+    if cfg.Dataset.Train.get("cache"):
+        ds_train = IndexedDataset(ds_train, "train")
+    if cfg.Dataset.Test.get("cache"):
+        ds_test = IndexedDataset(ds_test, "test")
+
+    resolution_schedule = None
+    if cfg.get("ResolutionSchedule"):
+        resolution_schedule = ResolutionSchedule(
+            cfg.ResolutionSchedule.phases, cfg.Dataset.Train.batch_size,
+            keep_memory=cfg.ResolutionSchedule.get("keep_memory", True),
+            max_batch_size=cfg.ResolutionSchedule.get("max_batch_size"))
+        num_workers = cfg.Dataset.Train.get("num_workers", 1)
+        train_loader = progressive_loader(
+            ds_train, resolution_schedule, train_transform,
+            shuffle=cfg.Dataset.Train.get("shuffle", True), num_workers=num_workers,
+            pin_memory=cfg.Dataset.Train.get("pin_memory", True), persistent_workers=num_workers > 0)
+    else:
+        train_loader = get_dataloader(cfg.Dataset.Train, ds_train)
     test_loader = get_dataloader(cfg.Dataset.Test, ds_test)
 
     net = get_model(cfg, horch.models.cifar)
@@ -73,7 +106,8 @@ if __name__ == '__main__':
 
     trainer = Trainer(net, criterion, optimizer, lr_scheduler,
                       metrics, test_metrics, save_path=cfg.save_path, mix=mix,
-                      fp16=cfg.get("fp16", False))
+                      precision=cfg.get("precision", "fp16" if cfg.get("fp16") else "fp32"),
+                      compile_lr_schedule=cfg.get("compile_lr_schedule", False))
 
     if args.resume:
         if args.resume == 'default':
@@ -81,6 +115,14 @@ if __name__ == '__main__':
         else:
             trainer.resume(args.resume)
 
+    saver = None
+    if cfg.get("delta_checkpoint"):
+        saver = DeltaDiskSaver(cfg.save_path, full_every=cfg.delta_checkpoint)
+    elif cfg.get("async_save"):
+        saver = AsyncDiskSaver(cfg.save_path, flat=cfg.get("flat_checkpoint", False))
+
     trainer.fit(train_loader, cfg.epochs, val_loader=test_loader,
                 eval_freq=cfg.get("eval_freq", 1), save_freq=cfg.get("save_freq"),
-                n_saved=cfg.get("n_saved", 1), progress_bar=cfg.get("prograss_bar", False))
+                n_saved=cfg.get("n_saved", 1), progress_bar=cfg.get("prograss_bar", False),
+                resolution_schedule=resolution_schedule,
+                saver=saver, profile=cfg.get("profile", False), profile_trace=cfg.get("profile_trace"))